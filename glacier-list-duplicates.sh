@@ -12,13 +12,7 @@ set -e
 # is useful to work around this bug:
 # http://git-annex.branchable.com/bugs/Glacier_remote_uploads_duplicates/
 
-vault="$1"
+# This is now done by "glacier archive duplicates", which keeps the oldest
+# archive of each name by default. See its --keep and --by options.
 
-all=$(mktemp list-duplicates.XXXXXXXXXX)
-keep=$(mktemp list-duplicates.XXXXXXXXXX)
-
-trap "rm -f -- '$all' '$keep'" EXIT
-
-glacier archive list --force-ids "$vault"|sort -k2|uniq -f1 -D > "$all"
-uniq -f1 < "$all" | cut -f1 | sort > "$keep"
-cut -f1 < "$all" | sort | comm -23 - "$keep"
+exec glacier archive duplicates "$1"
@@ -25,19 +25,28 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import argparse
+import binascii
 import calendar
+import codecs
+import collections
+import contextlib
 import errno
+import hashlib
 import itertools
+import json
 import os
 import os.path
+import sqlite3
+import stat
 import sys
+import threading
 import time
 
-import boto.glacier
-import iso8601
-import sqlalchemy
-import sqlalchemy.ext.declarative
-import sqlalchemy.orm
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 
 
 __version__ = '0.1.0'
@@ -52,6 +61,89 @@ INVENTORY_LAG = 24 * 60 * 60 * 3
 
 PROGRAM_NAME = 'glacier'
 
+# Number of inventory entries staged per statement when reconciling a vault
+# inventory with the cache.
+INVENTORY_BATCH_SIZE = 10000
+
+# Maximum number of values bound in a single "IN (...)" condition, to stay
+# within SQLite's limit on the number of parameters in a statement.
+SQL_IN_CHUNK_SIZE = 500
+
+# Maximum number of names read from stdin and answered together by
+# "archive checkpresent --batch".
+CHECKPRESENT_BATCH_SIZE = 1000
+
+# Seconds that SQLite waits for another process to release a lock on the
+# cache before failing with "database is locked", and the number of times a
+# cache write transaction is attempted in all before giving up.
+CACHE_BUSY_TIMEOUT = 30
+CACHE_WRITE_TRIES = 5
+
+# Within Cache.group_commit, queued writes are committed together once there
+# are this many of them or the oldest has waited this many seconds.
+GROUP_COMMIT_MAX_WRITES = 100
+GROUP_COMMIT_MAX_DELAY = 2
+
+# Commands that a running "glacier daemon" may run on a client's behalf.
+DAEMON_COMMANDS = frozenset([
+    'archive_checkpresent',
+    'archive_delete',
+    'archive_duplicates',
+    'archive_list',
+    'job_list',
+    'upload_abort',
+    'upload_list',
+    'vault_list',
+    'vault_sync',
+])
+
+MEGABYTE = 1024 * 1024
+
+# Glacier requires multipart upload part sizes to be a megabyte multiplied by
+# a power of two, from 1 MB up to 4 GB.
+MIN_PART_SIZE = MEGABYTE
+MAX_PART_SIZE = 4096 * MEGABYTE
+MAX_PARTS = 10000
+DEFAULT_PART_SIZE = 8 * MEGABYTE
+DEFAULT_CONCURRENCY = 4
+
+# Number of vaults worked on at once by "job list" and "vault sync --all"
+DEFAULT_VAULT_CONCURRENCY = 8
+
+# Upper bound on the size of each archive made by "archive upload --pack".
+# A single file larger than this is packed on its own.
+DEFAULT_PACK_SIZE = 256 * MEGABYTE
+
+# Attempts at each deletion by "archive delete", which may be throttled when
+# many archives are deleted at once
+DELETE_TRIES = 5
+
+# Number of archives downloaded at once by "archive retrieve --wait" of many
+# archives. Each download also fetches --concurrency ranges in parallel.
+DEFAULT_PARALLEL_ARCHIVES = 2
+
+# How long jobs of each retrieval tier are expected to take to complete.
+# Jobs without a tier, such as inventory retrievals, are taken to be
+# Standard.
+JOB_TIER_DURATIONS = {
+    'Expedited': 5 * 60,
+    'Standard': 4 * 60 * 60,
+    'Bulk': 12 * 60 * 60,
+}
+
+# Pending jobs are checked at half the time remaining until they are expected
+# to complete, within these bounds, and after that at JOB_POLL_MIN_INTERVAL,
+# doubling after each check up to JOB_POLL_INTERVAL.
+JOB_POLL_MIN_INTERVAL = 60
+JOB_POLL_INTERVAL = 600
+JOB_POLL_MAX_INTERVAL = 60 * 60
+
+# How long to wait for a job before giving up
+JOB_WAIT_TIMEOUT = 24 * 60 * 60
+
+# How often to check for job completion notifications, when they are used
+JOB_NOTIFICATION_INTERVAL = 20
+
 class ConsoleError(RuntimeError):
     def __init__(self, m):
         self.message = m
@@ -84,9 +176,770 @@ def insert_prefix_to_lines(prefix, lines):
 
 
 def iso8601_to_unix_timestamp(iso8601_date_str):
+    import iso8601
     return calendar.timegm(iso8601.parse_date(iso8601_date_str).utctimetuple())
 
 
+def retry(func, tries=5, sleep=1, description=None):
+    """Call func(), retrying up to tries times if it raises an exception"""
+    for attempt in range(1, tries + 1):
+        try:
+            return func()
+        except Exception as e:
+            if attempt == tries:
+                raise
+            if description:
+                warn('%s failed (%s); retrying' % (description, e))
+            time.sleep(sleep * attempt)
+
+
+def tree_hash(hashes):
+    """Combine SHA256 digests pairwise, level by level, into one digest"""
+    while len(hashes) > 1:
+        hashes = [hashlib.sha256(b''.join(hashes[i:i + 2])).digest()
+                  if i + 1 < len(hashes) else hashes[i]
+                  for i in range(0, len(hashes), 2)]
+    return hashes[0]
+
+
+def tree_hash_hex(data):
+    """Return the Glacier SHA256 tree hash of data as a hex string"""
+    view = memoryview(data)
+    chunk_hashes = [hashlib.sha256(view[i:i + MEGABYTE]).digest()
+                    for i in range(0, len(data), MEGABYTE)]
+    return hash_to_hex(tree_hash(chunk_hashes or [hashlib.sha256().digest()]))
+
+
+def hash_file(file_obj, copy_to=None):
+    """Return (tree_hash, size) of the rest of file_obj.
+
+    If copy_to is given, the data read is also written to it.
+    """
+    chunk_hashes = []
+    size = 0
+    while True:
+        data = read_exactly(file_obj, MEGABYTE)
+        if not data:
+            break
+        chunk_hashes.append(hashlib.sha256(data).digest())
+        size += len(data)
+        if copy_to is not None:
+            copy_to.write(data)
+    tree = tree_hash(chunk_hashes or [hashlib.sha256().digest()])
+    return hash_to_hex(tree), size
+
+
+def combine_tree_hashes(hex_hashes):
+    """Combine the tree hashes of consecutive parts into one tree hash.
+
+    This is only valid if every part except the last is a megabyte multiplied
+    by a power of two, which Glacier requires of multipart uploads anyway.
+    """
+    return hash_to_hex(tree_hash([binascii.unhexlify(h) for h in hex_hashes]))
+
+
+def hash_to_hex(digest):
+    return binascii.hexlify(digest).decode('ascii')
+
+
+def valid_part_size(part_size):
+    return (MIN_PART_SIZE <= part_size <= MAX_PART_SIZE and
+            part_size % MEGABYTE == 0 and
+            (part_size // MEGABYTE) & (part_size // MEGABYTE - 1) == 0)
+
+
+def choose_part_size(part_size, total_size=None):
+    """Return part_size, grown if needed to fit total_size into MAX_PARTS"""
+    if not valid_part_size(part_size):
+        raise ConsoleError(
+            'part size must be a power of two megabytes between 1 MB and 4 GB')
+    if total_size is not None:
+        while (part_size * MAX_PARTS < total_size and
+               part_size < MAX_PART_SIZE):
+            part_size *= 2
+    return part_size
+
+
+def get_file_size(file_obj):
+    """Return the size of a regular file, or None for pipes and the like"""
+    try:
+        st = os.fstat(file_obj.fileno())
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    return st.st_size
+
+
+class TransferProgress(object):
+    """Report bytes transferred and throughput on stderr.
+
+    update() may be called from multiple threads. Nothing is printed unless
+    enabled is set, so callers can always use one.
+    """
+    def __init__(self, verb, total=None, enabled=False, interval=1):
+        self.verb = verb
+        self.total = total
+        self.enabled = enabled
+        self.interval = interval
+        self.done = 0
+        self.start = time.time()
+        self.last_report = self.start
+        self.lock = threading.Lock()
+
+    def _rate(self, now):
+        elapsed = max(now - self.start, 1e-6)
+        return self.done / elapsed / MEGABYTE
+
+    def _report(self, now):
+        if self.total:
+            message = '%s %.1f/%.1f MB (%.1f MB/s)' % (
+                self.verb, self.done / float(MEGABYTE),
+                self.total / float(MEGABYTE), self._rate(now))
+        else:
+            message = '%s %.1f MB (%.1f MB/s)' % (
+                self.verb, self.done / float(MEGABYTE), self._rate(now))
+        info(message)
+
+    def update(self, nbytes):
+        with self.lock:
+            self.done += nbytes
+            now = time.time()
+            if self.enabled and now - self.last_report >= self.interval:
+                self.last_report = now
+                self._report(now)
+
+    def finish(self):
+        if self.enabled:
+            self._report(time.time())
+
+
+# Glacier API operation names by HTTP method and resource path, with vault,
+# job, upload and archive ids replaced by '*'
+API_OPERATIONS = {
+    ('GET', 'vaults'): 'list_vaults',
+    ('GET', 'vaults/*'): 'describe_vault',
+    ('PUT', 'vaults/*'): 'create_vault',
+    ('DELETE', 'vaults/*'): 'delete_vault',
+    ('GET', 'vaults/*/jobs'): 'list_jobs',
+    ('POST', 'vaults/*/jobs'): 'initiate_job',
+    ('GET', 'vaults/*/jobs/*'): 'describe_job',
+    ('GET', 'vaults/*/jobs/*/output'): 'get_output',
+    ('GET', 'vaults/*/multipart-uploads'): 'list_multipart_uploads',
+    ('POST', 'vaults/*/multipart-uploads'): 'initiate_multipart_upload',
+    ('GET', 'vaults/*/multipart-uploads/*'): 'list_parts',
+    ('PUT', 'vaults/*/multipart-uploads/*'): 'upload_part',
+    ('POST', 'vaults/*/multipart-uploads/*'): 'complete_multipart_upload',
+    ('DELETE', 'vaults/*/multipart-uploads/*'): 'abort_multipart_upload',
+    ('DELETE', 'vaults/*/archives/*'): 'delete_archive',
+}
+
+
+def api_operation(method, path):
+    """Return the name of the Glacier API operation for a request"""
+    # /account-id/vaults/name/jobs/id/output
+    parts = path.split('?')[0].strip('/').split('/')[1:]
+    resource = '/'.join('*' if i % 2 else part for i, part in enumerate(parts))
+    return API_OPERATIONS.get((method, resource),
+                              '%s %s' % (method, resource))
+
+
+class Stats(object):
+    """Record wall time per phase and count events, for --stats and --trace.
+
+    phase(name) times a block of code; time spent in the same phase by
+    several threads at once is added together. count(name, n) adds to a
+    counter. If trace_file is given, each timed phase is written to it as a
+    JSON line as it ends, followed by a summary line from close(). If
+    summary is set, close() also prints the summary on stderr.
+
+    Use NULL_STATS when neither is wanted: its methods do nothing, and the
+    hooks that would feed a Stats (see instrument_connection) are not
+    installed at all.
+    """
+    enabled = True
+
+    def __init__(self, trace_file=None, summary=False, clock=time.time):
+        self.trace_file = trace_file
+        self.summary = summary
+        self.clock = clock
+        self.start = clock()
+        # {name: [count, seconds]}
+        self.phases = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def record(self, name, start, end):
+        with self.lock:
+            totals = self.phases.setdefault(name, [0, 0.0])
+            totals[0] += 1
+            totals[1] += end - start
+            if self.trace_file:
+                self._trace({
+                    'event': 'phase', 'phase': name,
+                    'start': round(start - self.start, 6),
+                    'seconds': round(end - start, 6),
+                    'thread': threading.current_thread().name,
+                })
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.record(name, start, self.clock())
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def _trace(self, record):
+        self.trace_file.write(json.dumps(record, sort_keys=True) + '\n')
+
+    def summary_record(self):
+        return {
+            'event': 'summary',
+            'wall_seconds': round(self.clock() - self.start, 6),
+            'phases': dict((name, {'count': count,
+                                   'seconds': round(seconds, 6)})
+                           for name, (count, seconds) in self.phases.items()),
+            'counters': dict(self.counters),
+        }
+
+    def format_summary(self):
+        record = self.summary_record()
+        lines = ['wall time %.3fs' % record['wall_seconds']]
+        for name, (count, seconds) in sorted(
+                self.phases.items(), key=lambda item: -item[1][1]):
+            lines.append('%-32s %6d %10.3fs' % (name, count, seconds))
+        for name, value in sorted(self.counters.items()):
+            lines.append('%-32s %6d' % (name, value))
+        return '\n'.join(lines)
+
+    def instrument_connection(self, connection):
+        """Count and time the HTTP requests made by a boto connection.
+
+        Every Glacier request, including open_job_output(), goes through
+        layer1._mexe, so it is wrapped to record each as a phase named
+        after its API operation, up to the response headers. Reads of the
+        response body are recorded as a separate phase with ".body" added,
+        since for job output that is where most of the time goes.
+        """
+        layer1 = connection.layer1
+        mexe = layer1._mexe
+        stats = self
+
+        def instrumented_mexe(request, *args, **kwargs):
+            name = 'api.' + api_operation(request.method, request.path)
+            stats.count('api_calls')
+            if request.body:
+                stats.count('bytes_sent', len(request.body))
+            with stats.phase(name):
+                response = mexe(request, *args, **kwargs)
+            read = response.read
+
+            def instrumented_read(*args, **kwargs):
+                with stats.phase(name + '.body'):
+                    data = read(*args, **kwargs)
+                stats.count('bytes_received', len(data))
+                return data
+
+            response.read = instrumented_read
+            return response
+
+        layer1._mexe = instrumented_mexe
+
+    def instrument_engine(self, engine):
+        import sqlalchemy
+
+        def before_cursor_execute(*args):
+            self.count('sql_statements')
+
+        sqlalchemy.event.listen(engine, 'before_cursor_execute',
+                                before_cursor_execute)
+
+    def instrument_session(self, session):
+        import sqlalchemy
+        commit_start = []
+
+        def before_commit(session):
+            commit_start.append(self.clock())
+
+        def after_commit(session):
+            self.record('commit', commit_start.pop(), self.clock())
+
+        sqlalchemy.event.listen(session, 'before_commit', before_commit)
+        sqlalchemy.event.listen(session, 'after_commit', after_commit)
+
+    def close(self):
+        if self.trace_file:
+            with self.lock:
+                self._trace(self.summary_record())
+            self.trace_file.close()
+        if self.summary:
+            print(insert_prefix_to_lines('%s: stats: ' % PROGRAM_NAME,
+                                         self.format_summary()),
+                  file=sys.stderr)
+
+
+class NullStats(object):
+    """A Stats that records nothing"""
+    enabled = False
+
+    def phase(self, name):
+        return self
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def count(self, name, n=1):
+        pass
+
+    def close(self):
+        pass
+
+
+NULL_STATS = NullStats()
+
+
+def read_parts(file_obj, part_size):
+    """Yield (index, data) for each part_size chunk read from file_obj"""
+    index = 0
+    while True:
+        data = read_exactly(file_obj, part_size)
+        if not data:
+            return
+        yield index, data
+        index += 1
+
+
+def read_exactly(file_obj, size):
+    """Read size bytes, or fewer only at EOF (pipes return short reads)"""
+    chunks = []
+    remaining = size
+    while remaining:
+        chunk = file_obj.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+
+def iter_workers(func, items, concurrency, window=None, ordered=True):
+    """Yield func(item) for each item, computed by a pool of threads.
+
+    Results are yielded in the order of items if ordered is set, or otherwise
+    as soon as they complete. items is consumed lazily and at most window
+    items (default: twice concurrency) are in flight or waiting to be yielded
+    at once, so items may be a generator over a large stream and reordering
+    buffers stay bounded. Results are always yielded in the calling thread.
+    The first exception raised by func is re-raised here. If results are
+    unordered, those of the items already in flight are yielded first, so
+    that work that completed is not lost.
+    """
+    if window is None:
+        window = concurrency * 2
+    window = max(1, window)
+
+    def call(item):
+        try:
+            return True, func(item)
+        except BaseException as e:
+            return False, e
+
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(max(1, concurrency))
+    pending = collections.deque()
+    completed = queue.Queue()
+
+    def next_result():
+        async_result = pending.popleft()
+        if ordered:
+            return async_result.get()
+        return completed.get()
+
+    error = None
+    try:
+        for item in items:
+            if ordered:
+                pending.append(pool.apply_async(call, (item,)))
+            else:
+                pending.append(
+                    pool.apply_async(call, (item,), callback=completed.put))
+            if len(pending) >= window:
+                ok, value = next_result()
+                if not ok:
+                    error = value
+                    break
+                yield value
+        while pending and not (error and ordered):
+            ok, value = next_result()
+            if ok:
+                yield value
+            elif error is None:
+                error = value
+        if error is not None:
+            raise error
+    finally:
+        pool.terminate()
+
+
+def input_ready(f):
+    """Return False if reading from f now would block, else True"""
+    try:
+        import select
+        return bool(select.select([f], [], [], 0)[0])
+    except Exception:
+        return True
+
+
+def iter_line_batches(f, batch_size):
+    """Yield lists of up to batch_size lines read from f.
+
+    A batch is cut short when no more input is immediately available, so
+    that a caller feeding one line at a time and waiting for each answer is
+    not left waiting for a full batch.
+    """
+    batch = []
+    for line in iter(f.readline, ''):
+        batch.append(line.rstrip('\r\n'))
+        if len(batch) >= batch_size or not input_ready(f):
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def run_workers(func, items, concurrency, window=None):
+    """Call func(item) for each item from a pool of threads.
+
+    Return the results in completion order. See iter_workers.
+    """
+    return list(iter_workers(func, items, concurrency, window, ordered=False))
+
+
+def byte_ranges(size, part_size):
+    """Yield (start, end) for each part_size slice of size bytes"""
+    for start in range(0, size, part_size):
+        yield start, min(start + part_size, size)
+
+
+def parse_byte_range(value):
+    """argparse type for a byte range START-END, as Glacier writes them.
+
+    END is inclusive. Return (start, end) with end exclusive, as elsewhere.
+    Glacier requires ranges to start on a megabyte boundary; see
+    check_byte_range for the end.
+    """
+    try:
+        start, end = [int(n) for n in value.split('-')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid byte range %r' % value)
+    if start % MEGABYTE or end < start:
+        raise argparse.ArgumentTypeError(
+            'byte range %r must start on a megabyte boundary' % value)
+    return start, end + 1
+
+
+def check_byte_range(byte_range, archive_size):
+    """Raise ConsoleError unless Glacier can retrieve byte_range.
+
+    A range must end on a megabyte boundary or at the end of the archive.
+    archive_size may be None if it is not known, in which case only the
+    first is accepted.
+    """
+    start, end = byte_range
+    if archive_size is not None and end > archive_size:
+        raise ConsoleError('byte range %d-%d is beyond the end of the '
+                           'archive (%d bytes)' % (start, end - 1,
+                                                   archive_size))
+    if end % MEGABYTE and end != archive_size:
+        raise ConsoleError('byte range %d-%d must end on a megabyte '
+                           'boundary or at the end of the archive' %
+                           (start, end - 1))
+
+
+def aligned_byte_range(start, end, archive_size):
+    """Return the smallest range Glacier can retrieve that covers start-end"""
+    return (start - start % MEGABYTE,
+            min(end + -end % MEGABYTE, archive_size))
+
+
+def preallocate(f, size):
+    """Set the size of file f and reserve its disk blocks if possible"""
+    f.truncate(size)
+    if size and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+        except OSError as e:
+            if e.errno not in [errno.EINVAL, errno.EOPNOTSUPP]:
+                raise
+
+
+class PositionalWriter(object):
+    """Write data at arbitrary offsets of a file from multiple threads"""
+    def __init__(self, f):
+        f.flush()
+        self.f = f
+        self.lock = threading.Lock()
+
+    def write(self, offset, data):
+        if hasattr(os, 'pwrite'):
+            view = memoryview(data)
+            while view:
+                written = os.pwrite(self.f.fileno(), view, offset)
+                view = view[written:]
+                offset += written
+        else:
+            with self.lock:
+                self.f.seek(offset)
+                self.f.write(data)
+                self.f.flush()
+
+
+def fetch_range_with_tree_hash(job, start, end):
+    """Fetch bytes start to end-1 of job's output, checking its tree hash.
+
+    Glacier returns a tree hash for ranges that are aligned to a megabyte
+    tree; for other ranges the tree hash is computed locally. Return (data,
+    tree_hash).
+    """
+    response = job.get_output((start, end - 1))
+    data = response.read()
+    tree_hash = tree_hash_hex(data)
+    expected_tree_hash = response.get('TreeHash')
+    if expected_tree_hash and expected_tree_hash != tree_hash:
+        raise IOError('tree hash mismatch for bytes %d-%d' % (start, end - 1))
+    return data, tree_hash
+
+
+def verified_ranges(f, ranges, done_ranges):
+    """Return the set of ranges whose data in f matches done_ranges.
+
+    done_ranges maps an offset to the (length, tree_hash) recorded when that
+    range was written.
+    """
+    present = set()
+    for start, end in ranges:
+        try:
+            length, tree_hash = done_ranges[start]
+        except KeyError:
+            continue
+        if length != end - start:
+            continue
+        f.seek(start)
+        if tree_hash_hex(read_exactly(f, length)) == tree_hash:
+            present.add((start, end))
+    return present
+
+
+def pack_member_header(path, size, mtime, mode):
+    """Return the tar header for a member of a pack"""
+    import tarfile
+    info = tarfile.TarInfo(path)
+    info.size = size
+    info.mtime = int(mtime)
+    info.mode = mode & 0o7777
+    # PAX headers allow long and non-ASCII paths
+    return info.tobuf(format=tarfile.PAX_FORMAT)
+
+
+def plan_packs(directory, pack_size):
+    """Group the regular files under directory into packs.
+
+    Yield (members, size) for each pack in turn, where members is a list of
+    (path, filename, offset, size, mtime, mode) for each file, path is
+    relative to directory with / separators, offset is where the file's
+    data starts in the pack and size is the size of the whole pack, a tar
+    stream. Packs are at most pack_size bytes, unless a single file needs
+    more. The directory is walked lazily, so only one pack is planned at a
+    time.
+    """
+    import tarfile
+    members = []
+    offset = 0
+    end_size = 2 * tarfile.BLOCKSIZE
+
+    def pack_end():
+        size = offset + end_size
+        return members, size + -size % tarfile.RECORDSIZE
+
+    for dirpath, dirnames, filenames in os.walk(directory):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            filename = os.path.join(dirpath, filename)
+            st = os.stat(filename)
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            path = os.path.relpath(filename, directory).replace(os.sep, '/')
+            header_size = len(pack_member_header(path, st.st_size,
+                                                 st.st_mtime, st.st_mode))
+            entry_size = (header_size + st.st_size +
+                          -st.st_size % tarfile.BLOCKSIZE)
+            if members and offset + entry_size + end_size > pack_size:
+                yield pack_end()
+                members = []
+                offset = 0
+            members.append((path, filename, offset + header_size,
+                            st.st_size, st.st_mtime, st.st_mode))
+            offset += entry_size
+    if members:
+        yield pack_end()
+
+
+class PackReader(object):
+    """A file object reading the tar stream of a pack planned by plan_packs.
+
+    The stream is generated as it is read, so a pack of any size can be
+    uploaded without being written out first.
+    """
+    def __init__(self, members, size):
+        self._chunks = self._iter_chunks(members, size)
+        self._buffer = b''
+
+    @staticmethod
+    def _iter_chunks(members, pack_size):
+        import tarfile
+        offset = 0
+        for path, filename, data_offset, size, mtime, mode in members:
+            header = pack_member_header(path, size, mtime, mode)
+            yield header
+            with open(filename, 'rb') as f:
+                remaining = size
+                while remaining:
+                    data = f.read(min(remaining, MEGABYTE))
+                    if not data:
+                        raise ConsoleError('%r changed while being packed' %
+                                           filename)
+                    yield data
+                    remaining -= len(data)
+            padding = -size % tarfile.BLOCKSIZE
+            yield b'\0' * padding
+            offset += len(header) + size + padding
+        yield b'\0' * (pack_size - offset)
+
+    def read(self, size=-1):
+        chunks = [self._buffer]
+        length = len(self._buffer)
+        while size < 0 or length < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            chunks.append(chunk)
+            length += len(chunk)
+        data = b''.join(chunks)
+        if size < 0:
+            self._buffer = b''
+            return data
+        self._buffer = data[size:]
+        return data[:size]
+
+
+class MultipartUploader(object):
+    """Upload an archive as a Glacier multipart upload from a thread pool.
+
+    Parts are read sequentially from the file object (which need not be
+    seekable) and uploaded concurrently. The tree hash of each part is
+    computed as it is read and the per-part hashes are combined into the
+    archive tree hash at the end, so the data is only read once.
+
+    An existing upload can be resumed by passing its upload_id and the tree
+    hashes of the parts already uploaded ({index: tree_hash}, as returned by
+    list_parts). Parts whose local tree hash matches are not sent again.
+    """
+    def __init__(self, layer1, vault_name, part_size=DEFAULT_PART_SIZE,
+                 concurrency=DEFAULT_CONCURRENCY, progress=None):
+        self.layer1 = layer1
+        self.vault_name = vault_name
+        self.part_size = part_size
+        self.concurrency = concurrency
+        self.progress = progress or TransferProgress('uploaded')
+        self.upload_id = None
+        # Set once an upload completes
+        self.tree_hash = None
+        self.size = None
+
+    def list_parts(self, upload_id):
+        """Return {index: tree_hash} for the parts uploaded so far"""
+        parts = {}
+        marker = None
+        while True:
+            response = self.layer1.list_parts(
+                self.vault_name, upload_id, marker=marker)
+            for part in response['Parts']:
+                start = int(part['RangeInBytes'].split('-')[0])
+                parts[start // self.part_size] = part['SHA256TreeHash']
+            marker = response.get('Marker')
+            if not marker:
+                return parts
+
+    def _upload_part(self, upload_id, index, data, uploaded_parts):
+        start = index * self.part_size
+        byte_range = (start, start + len(data) - 1)
+        tree_hash = tree_hash_hex(data)
+        if uploaded_parts.get(index) != tree_hash:
+            linear_hash = hashlib.sha256(data).hexdigest()
+            retry(lambda: self.layer1.upload_part(
+                    self.vault_name, upload_id, linear_hash, tree_hash,
+                    byte_range, data),
+                  description='upload of part %d' % index)
+        self.progress.update(len(data))
+        return index, len(data), tree_hash
+
+    def upload(self, file_obj, description, upload_id=None,
+               uploaded_parts=None, on_start=None):
+        """Upload file_obj and return the new archive id.
+
+        on_start(upload_id) is called, from this thread, once the upload has
+        been initiated. If it is given, the upload is left in place on
+        failure so that it can be resumed; otherwise it is aborted.
+        """
+        if upload_id is None:
+            response = self.layer1.initiate_multipart_upload(
+                self.vault_name, self.part_size, description)
+            upload_id = response['UploadId']
+            if on_start:
+                on_start(upload_id)
+        self.upload_id = upload_id
+        uploaded_parts = uploaded_parts or {}
+        try:
+            parts = []
+            for index, size, tree_hash in iter_workers(
+                    lambda part: self._upload_part(
+                        upload_id, part[0], part[1], uploaded_parts),
+                    read_parts(file_obj, self.part_size),
+                    self.concurrency, ordered=False):
+                parts.append((index, size, tree_hash))
+            if not parts:
+                raise ConsoleError('cannot upload an empty archive')
+            parts.sort()
+            archive_size = sum(size for index, size, tree_hash in parts)
+            archive_tree_hash = combine_tree_hashes(
+                [tree_hash for index, size, tree_hash in parts])
+            response = self.layer1.complete_multipart_upload(
+                self.vault_name, upload_id, archive_tree_hash, archive_size)
+        except BaseException as e:
+            if on_start and not isinstance(e, ConsoleError):
+                warn('multipart upload %r interrupted; ' % upload_id +
+                     'run the same upload again to resume it')
+                raise
+            try:
+                self.layer1.abort_multipart_upload(self.vault_name, upload_id)
+            except Exception as e:
+                warn('failed to abort multipart upload %r: %s' %
+                     (upload_id, e))
+            raise
+        self.progress.finish()
+        self.tree_hash = archive_tree_hash
+        self.size = archive_size
+        return response['ArchiveId']
+
+
 def get_user_cache_dir():
     xdg_cache_home = os.getenv('XDG_CACHE_HOME')
     if xdg_cache_home is not None:
@@ -98,134 +951,799 @@ def get_user_cache_dir():
     return os.path.join(home, '.cache')
 
 
-class Cache(object):
-    Base = sqlalchemy.ext.declarative.declarative_base()
-    class Archive(Base):
-        __tablename__ = 'archive'
-        id = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
-        name = sqlalchemy.Column(sqlalchemy.String)
-        vault = sqlalchemy.Column(sqlalchemy.String, nullable=False)
-        key = sqlalchemy.Column(sqlalchemy.String, nullable=False)
-        last_seen_upstream = sqlalchemy.Column(sqlalchemy.Integer)
-        created_here = sqlalchemy.Column(sqlalchemy.Integer)
-        deleted_here = sqlalchemy.Column(sqlalchemy.Integer)
+def get_default_db_path():
+    return os.path.join(get_user_cache_dir(), 'glacier-cli', 'db')
 
-        def __init__(self, *args, **kwargs):
-            self.created_here = time.time()
-            super(Cache.Archive, self).__init__(*args, **kwargs)
 
-    Session = sqlalchemy.orm.sessionmaker()
+def get_default_socket_path():
+    return os.path.join(get_user_cache_dir(), 'glacier-cli', 'daemon.sock')
 
-    def __init__(self, key, db_path=None):
-        self.key = key
-        if db_path is None:
-            db_path = os.path.join(get_user_cache_dir(), 'glacier-cli', 'db')
-        if db_path != ':memory:':
-            mkdir_p(os.path.dirname(db_path))
-        self.engine = sqlalchemy.create_engine('sqlite:///%s' % db_path)
-        self.Base.metadata.create_all(self.engine)
-        self.Session.configure(bind=self.engine)
-        self.session = self.Session()
-
-    def add_archive(self, vault, name, id):
-        self.session.add(self.Archive(key=self.key,
-                                      vault=vault, name=name, id=id))
-        self.session.commit()
 
-    def _get_archive_query_by_ref(self, vault, ref):
+def import_sqlalchemy():
+    """Import SQLAlchemy into the module namespace.
+
+    SQLAlchemy takes longer to import than most cache lookups take to run,
+    so it is only imported once a Cache is actually needed.
+    """
+    global sqlalchemy
+    import sqlalchemy
+    import sqlalchemy.event
+    import sqlalchemy.ext.declarative
+    import sqlalchemy.orm
+
+
+def iter_rows(result, batch_size=1000):
+    """Yield the rows of a SQLAlchemy result.
+
+    Iterating a result directly uses a generator that, in SQLAlchemy 1.0,
+    raises StopIteration at the end, which Python 3.7 turns into a
+    RuntimeError (PEP 479). Fetching in batches works with any version.
+    """
+    while True:
+        rows = result.fetchmany(batch_size)
+        if not rows:
+            return
+        for row in rows:
+            yield row
+
+
+class ArchiveQueries(object):
+    """Archive lookups shared by Cache and CacheReader.
+
+    Subclasses provide self.key and _query(sql, params), which runs a single
+    SELECT statement using :name parameters and returns an iterable of row
+    tuples.
+    """
+    @staticmethod
+    def _ref_condition(ref):
         if ref.startswith('id:'):
-            filter = {'id': ref[3:]}
+            return 'id', ref[3:]
         elif ref.startswith('name:'):
-            filter = {'name': ref[5:]}
+            return 'name', ref[5:]
         else:
-            filter = {'name': ref}
-        return self.session.query(self.Archive).filter_by(
-                key=self.key, vault=vault, deleted_here=None, **filter)
+            return 'name', ref
+
+    def _get_archive_row(self, vault, ref):
+        column, value = self._ref_condition(ref)
+        rows = list(self._query(
+            'SELECT id, name, last_seen_upstream, created_here, size '
+            'FROM archive WHERE key = :key AND vault = :vault '
+            'AND deleted_here IS NULL AND %s = :value LIMIT 2' % column,
+            {'key': self.key, 'vault': vault, 'value': value}))
+        if not rows:
+            raise KeyError(ref)
+        if len(rows) > 1:
+            raise ConsoleError('archive %r is ambiguous; ' % ref +
+                               'refer to it by id instead')
+        return rows[0]
 
     def get_archive_id(self, vault, ref):
-        try:
-            result = self._get_archive_query_by_ref(vault, ref).one()
-        except sqlalchemy.orm.exc.NoResultFound:
-            raise KeyError(ref)
-        return result.id
+        return self._get_archive_row(vault, ref)[0]
 
     def get_archive_name(self, vault, ref):
-        try:
-            result = self._get_archive_query_by_ref(vault, ref).one()
-        except sqlalchemy.orm.exc.NoResultFound:
-            raise KeyError(ref)
-        return result.name
+        return self._get_archive_row(vault, ref)[1]
 
     def get_archive_last_seen(self, vault, ref):
+        id, name, last_seen_upstream, created_here, size = (
+            self._get_archive_row(vault, ref))
+        return last_seen_upstream or created_here
+
+    def get_archive_size(self, vault, ref):
+        """Return the size of an archive, or None if it is not known"""
+        return self._get_archive_row(vault, ref)[4]
+
+    def _query_in(self, sql, column, values, params):
+        """Run sql once per chunk of values and chain the results.
+
+        sql must contain a single %s, which is replaced with a condition
+        that column is one of the chunk of values. Chunks keep each
+        statement within SQLite's limit on the number of parameters.
+        """
+        values = list(values)
+        for start in range(0, len(values), SQL_IN_CHUNK_SIZE):
+            chunk = values[start:start + SQL_IN_CHUNK_SIZE]
+            chunk_params = dict(params)
+            placeholders = []
+            for i, value in enumerate(chunk):
+                chunk_params['in_%d' % i] = value
+                placeholders.append(':in_%d' % i)
+            condition = '%s IN (%s)' % (column, ', '.join(placeholders))
+            for row in self._query(sql % condition, chunk_params):
+                yield row
+
+    def get_archives_by_content(self, vault, tree_hash, size):
+        """Return a list of (id, name) of archives with these contents"""
+        return list(self._query(
+            'SELECT id, name FROM archive WHERE key = :key AND vault = :vault '
+            'AND deleted_here IS NULL AND tree_hash = :tree_hash '
+            'AND size = :size ORDER BY id',
+            {'key': self.key, 'vault': vault, 'tree_hash': tree_hash,
+             'size': size}))
+
+    def get_duplicate_archive_ids(self, vault, by='name', keep='oldest'):
+        """Yield the ids of archives that duplicate another.
+
+        Archives are duplicates if they have the same name, or with by set
+        to 'content', the same tree hash and size. Of each set of
+        duplicates, the oldest (or with keep set to 'newest', the newest) by
+        creation date is kept and the ids of the rest are yielded.
+        """
+        same, required = {
+            'name': ('b.name = a.name', 'name'),
+            'content': ('b.tree_hash = a.tree_hash AND b.size IS a.size',
+                        'tree_hash'),
+        }[by]
+        direction = {'oldest': 'ASC', 'newest': 'DESC'}[keep]
+        # A correlated subquery picks the copy to keep rather than a window
+        # function, which would need SQLite 3.25.
+        rows = self._query(
+            'SELECT a.id FROM archive a '
+            'WHERE a.key = :key AND a.vault = :vault '
+            'AND a.deleted_here IS NULL AND a.{required} IS NOT NULL '
+            'AND a.id != ('
+            'SELECT b.id FROM archive b '
+            'WHERE b.key = a.key AND b.vault = a.vault '
+            'AND b.deleted_here IS NULL AND {same} '
+            'ORDER BY b.creation_date IS NULL, b.creation_date {direction}, '
+            'b.created_here {direction}, b.id LIMIT 1)'.format(
+                same=same, direction=direction, required=required),
+            {'key': self.key, 'vault': vault})
+        for row in rows:
+            yield row[0]
+
+    def get_archive_names_by_id(self, vault, ids):
+        """Return {id: name} for those of ids that are in the cache"""
+        return dict(self._query_in(
+            'SELECT id, name FROM archive WHERE key = :key AND vault = :vault '
+            'AND deleted_here IS NULL AND %s',
+            'id', set(ids), {'key': self.key, 'vault': vault}))
+
+    def get_archive_ids_many(self, vault, refs):
+        """Return {ref: id} for those of refs that are in the cache.
+
+        Raise ConsoleError if a name refers to more than one archive.
+        """
+        refs_by_value = {'id': {}, 'name': {}}
+        for ref in refs:
+            column, value = self._ref_condition(ref)
+            refs_by_value[column].setdefault(value, []).append(ref)
+
+        result = {}
+        for column, index in [('id', 0), ('name', 1)]:
+            for row in self._query_in(
+                    'SELECT id, name FROM archive WHERE key = :key '
+                    'AND vault = :vault AND deleted_here IS NULL AND %s',
+                    column, refs_by_value[column],
+                    {'key': self.key, 'vault': vault}):
+                for ref in refs_by_value[column][row[index]]:
+                    if ref in result and result[ref] != row[0]:
+                        raise ConsoleError('archive %r is ambiguous; ' % ref +
+                                           'refer to it by id instead')
+                    result[ref] = row[0]
+        return result
+
+    def get_archive_last_seen_many(self, vault, refs):
+        """Return {ref: last_seen} for those of refs that are in the cache.
+
+        If a name refers to more than one archive, the most recently seen
+        one counts.
+        """
+        refs_by_value = {'id': {}, 'name': {}}
+        for ref in refs:
+            column, value = self._ref_condition(ref)
+            refs_by_value[column].setdefault(value, []).append(ref)
+
+        result = {}
+        for column, index in [('id', 0), ('name', 1)]:
+            for row in self._query_in(
+                    'SELECT id, name, last_seen_upstream, created_here '
+                    'FROM archive WHERE key = :key AND vault = :vault '
+                    'AND deleted_here IS NULL AND %s',
+                    column, refs_by_value[column],
+                    {'key': self.key, 'vault': vault}):
+                last_seen = row[2] or row[3]
+                for ref in refs_by_value[column][row[index]]:
+                    if ref not in result or last_seen > result[ref]:
+                        result[ref] = last_seen
+        return result
+
+    @staticmethod
+    def _ref(name, id, force_id=False):
+        if name and not force_id:
+            if name.startswith('name:') or name.startswith('id:'):
+                return "name:%s" % name
+            else:
+                return name
+        else:
+            return 'id:' + id
+
+    @classmethod
+    def _archive_ref(cls, archive, force_id=False):
+        return cls._ref(archive.name, archive.id, force_id=force_id)
+
+    @staticmethod
+    def _glob_escape(text):
+        """Return a GLOB pattern that matches text literally"""
+        return ''.join('[%s]' % c if c in '*?[' else c for c in text)
+
+    def _get_archive_list_rows(self, vault, prefix=None, glob=None):
+        """Yield (name, id, count) ordered by name, where count is the
+        number of archives listed with that name.
+
+        prefix and glob restrict the archives listed by name. Both are done
+        with GLOB, which SQLite can answer from the name index.
+        """
+        conditions = []
+        params = {'key': self.key, 'vault': vault}
+        if prefix is not None:
+            conditions.append('AND name GLOB :prefix ')
+            params['prefix'] = self._glob_escape(prefix) + '*'
+        if glob is not None:
+            conditions.append('AND name GLOB :glob ')
+            params['glob'] = glob
+        where = ('WHERE key = :key AND vault = :vault '
+                 'AND deleted_here IS NULL ' + ''.join(conditions))
+        # Counted with GROUP BY rather than COUNT(*) OVER, which would need
+        # SQLite 3.25.
+        return self._query(
+            'SELECT a.name, a.id, c.count '
+            'FROM (SELECT name, id FROM archive ' + where + ') a '
+            'JOIN (SELECT name, COUNT(*) AS count FROM archive ' + where +
+            'GROUP BY name) c ON a.name IS c.name '
+            'ORDER BY a.name',
+            params)
+
+    def get_archive_list(self, vault, prefix=None, glob=None):
+        for name, id, count in self._get_archive_list_rows(vault, prefix,
+                                                           glob):
+            # Use self._ref(..., force_id=True) if there is more than one
+            # archive with the same name.
+            if count > 1:
+                yield "\t".join([self._ref(name, id, force_id=True),
+                                 "%s" % name])
+            else:
+                yield self._ref(name, id)
+
+    def get_archive_list_with_ids(self, vault, prefix=None, glob=None):
+        for name, id, count in self._get_archive_list_rows(vault, prefix,
+                                                           glob):
+            yield "\t".join([self._ref(name, id, force_id=True), "%s" % name])
+
+
+class CacheReader(ArchiveQueries):
+    """Read-only archive lookups using the sqlite3 module directly.
+
+    Commands that only read the cache use this to avoid importing SQLAlchemy.
+    Use open(), which returns None if the database does not exist yet or
+    needs a schema upgrade, in which case a full Cache must be used instead.
+    """
+    def __init__(self, key, connection, stats=NULL_STATS):
+        self.key = key
+        self.connection = connection
+        self.stats = stats
+
+    @classmethod
+    def open(cls, key, db_path=None, stats=NULL_STATS):
+        if db_path is None:
+            db_path = get_default_db_path()
+        if not os.path.exists(db_path):
+            return None
+        connection = sqlite3.connect(db_path, timeout=CACHE_BUSY_TIMEOUT)
+        version = connection.execute('PRAGMA user_version').fetchone()[0]
+        if version != Cache.SCHEMA_VERSION:
+            connection.close()
+            return None
+        return cls(key, connection, stats)
+
+    def _query(self, sql, params):
+        self.stats.count('sql_statements')
+        return self.connection.execute(sql, params)
+
+
+class Cache(ArchiveQueries):
+    # The schema version is kept in SQLite's user_version. Databases created
+    # before versioning was introduced are at version 0.
+    SCHEMA_VERSION = 7
+
+    # SQL statements that upgrade an existing database to each version, in
+    # order. Tables added since a database was created are created by
+    # create_all after these have been run, so migrations only need to alter
+    # tables that already existed at the previous version.
+    MIGRATIONS = [
+        # 1: indexes for lookups by name and by id within a vault
+        [
+            'CREATE INDEX IF NOT EXISTS archive_key_vault_name '
+            'ON archive (key, vault, name)',
+            'CREATE INDEX IF NOT EXISTS archive_key_vault_id '
+            'ON archive (key, vault, id)',
+        ],
+        # 2: job_listing table, created by create_all
+        [],
+        # 3: archive contents, as listed in inventories
+        [
+            'ALTER TABLE archive ADD COLUMN tree_hash VARCHAR',
+            'ALTER TABLE archive ADD COLUMN size INTEGER',
+            'CREATE INDEX IF NOT EXISTS archive_key_vault_tree_hash '
+            'ON archive (key, vault, tree_hash)',
+        ],
+        # 4: archive creation dates, as listed in inventories
+        [
+            'ALTER TABLE archive ADD COLUMN creation_date VARCHAR',
+        ],
+        # 5: vault_sync table, created by create_all
+        [],
+        # 6: pack_member table, created by create_all
+        [],
+        # 7: per-part tree hashes of uploads, which resuming never used
+        [
+            'DROP TABLE IF EXISTS upload_part',
+        ],
+    ]
+
+    # Applied to every connection. In WAL mode readers do not block the
+    # writer and vice versa, and synchronous=NORMAL is then still safe
+    # against corruption while avoiding an fsync on every commit.
+    PRAGMAS = [
+        'PRAGMA journal_mode=WAL',
+        'PRAGMA synchronous=NORMAL',
+        'PRAGMA cache_size=-65536',
+        'PRAGMA mmap_size=268435456',
+    ]
+
+    # The ORM classes (Base, Archive and so on) are set up by _define_models
+    # when the first Cache is created.
+    Base = None
+
+    @classmethod
+    def _define_models(cls):
+        if cls.Base is not None:
+            return
+        import_sqlalchemy()
+
+        Base = sqlalchemy.ext.declarative.declarative_base()
+        class Archive(Base):
+            __tablename__ = 'archive'
+            __table_args__ = (
+                sqlalchemy.Index('archive_key_vault_name',
+                                 'key', 'vault', 'name'),
+                sqlalchemy.Index('archive_key_vault_id', 'key', 'vault', 'id'),
+                sqlalchemy.Index('archive_key_vault_tree_hash',
+                                 'key', 'vault', 'tree_hash'),
+            )
+            id = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+            name = sqlalchemy.Column(sqlalchemy.String)
+            vault = sqlalchemy.Column(sqlalchemy.String, nullable=False)
+            key = sqlalchemy.Column(sqlalchemy.String, nullable=False)
+            last_seen_upstream = sqlalchemy.Column(sqlalchemy.Integer)
+            created_here = sqlalchemy.Column(sqlalchemy.Integer)
+            deleted_here = sqlalchemy.Column(sqlalchemy.Integer)
+            tree_hash = sqlalchemy.Column(sqlalchemy.String)
+            size = sqlalchemy.Column(sqlalchemy.Integer)
+            # ISO 8601 in UTC, as in inventories, so that it sorts as text
+            creation_date = sqlalchemy.Column(sqlalchemy.String)
+
+            def __init__(self, *args, **kwargs):
+                self.created_here = time.time()
+                self.creation_date = time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                                   time.gmtime())
+                super(Archive, self).__init__(*args, **kwargs)
+
+        class RetrievalRange(Base):
+            __tablename__ = 'retrieval_range'
+            key = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+            vault = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+            job_id = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+            filename = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+            offset = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+            length = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+            tree_hash = sqlalchemy.Column(sqlalchemy.String, nullable=False)
+
+        class Upload(Base):
+            __tablename__ = 'upload'
+            id = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+            key = sqlalchemy.Column(sqlalchemy.String, nullable=False)
+            vault = sqlalchemy.Column(sqlalchemy.String, nullable=False)
+            name = sqlalchemy.Column(sqlalchemy.String)
+            source = sqlalchemy.Column(sqlalchemy.String)
+            size = sqlalchemy.Column(sqlalchemy.Integer)
+            part_size = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+            created_here = sqlalchemy.Column(sqlalchemy.Integer)
+
+            def __init__(self, *args, **kwargs):
+                self.created_here = time.time()
+                super(Upload, self).__init__(*args, **kwargs)
+
+        class JobListing(Base):
+            __tablename__ = 'job_listing'
+            key = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+            vault = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+            listed = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+            # JSON list of the job descriptions returned by Glacier
+            jobs = sqlalchemy.Column(sqlalchemy.Text, nullable=False)
+
+        class VaultSync(Base):
+            # The last inventory reconciled for each vault
+            __tablename__ = 'vault_sync'
+            key = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+            vault = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+            # The last inventory job handled, which may be one whose
+            # inventory was older than this one and so was ignored
+            job_id = sqlalchemy.Column(sqlalchemy.String, nullable=False)
+            inventory_date = sqlalchemy.Column(sqlalchemy.Integer,
+                                               nullable=False)
+            # The last_seen_upstream given to the archives in it
+            last_seen_upstream = sqlalchemy.Column(sqlalchemy.Integer,
+                                                   nullable=False)
+
+        class PackMember(Base):
+            # The files in each archive uploaded by "archive upload --pack"
+            __tablename__ = 'pack_member'
+            __table_args__ = (
+                sqlalchemy.Index('pack_member_key_vault_path',
+                                 'key', 'vault', 'path'),
+            )
+            key = sqlalchemy.Column(sqlalchemy.String, nullable=False)
+            vault = sqlalchemy.Column(sqlalchemy.String, nullable=False)
+            archive_id = sqlalchemy.Column(sqlalchemy.String,
+                                           primary_key=True)
+            path = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+            # Where the member's data starts in the archive
+            offset = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+            size = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+
+        cls.Archive = Archive
+        cls.PackMember = PackMember
+        cls.RetrievalRange = RetrievalRange
+        cls.VaultSync = VaultSync
+        cls.JobListing = JobListing
+        cls.Upload = Upload
+        cls.Session = sqlalchemy.orm.sessionmaker()
+        cls.Base = Base
+
+    def __init__(self, key, db_path=None, stats=NULL_STATS):
+        self._define_models()
+        self.key = key
+        self.stats = stats
+        if db_path is None:
+            db_path = get_default_db_path()
+        if db_path != ':memory:':
+            mkdir_p(os.path.dirname(db_path))
+        self.engine = sqlalchemy.create_engine(
+            'sqlite:///%s' % db_path,
+            connect_args={'timeout': CACHE_BUSY_TIMEOUT})
+        sqlalchemy.event.listen(self.engine, 'connect', self._set_pragmas)
+        sqlalchemy.event.listen(self.engine, 'begin', self._begin)
+        if stats.enabled:
+            stats.instrument_engine(self.engine)
+        # Set while beginning a transaction that will write
+        self._begin_immediate = False
+        # Writes queued by group_commit, or None outside it
+        self._pending_writes = None
+        self._pending_since = None
+        # A single connection is kept for the life of the cache, rather than
+        # one per transaction, so that short transactions are cheap and the
+        # inventory staged by load_inventory in a temporary table survives
+        # until reconcile_inventory's own transaction.
+        self.connection = self.engine.connect()
+        self._upgrade_schema()
+        self.session = self.Session(bind=self.connection)
+        if stats.enabled:
+            stats.instrument_session(self.session)
+
+    @classmethod
+    def _set_pragmas(cls, dbapi_connection, connection_record):
+        # Transactions are begun by _begin instead of by the sqlite3 module
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for pragma in cls.PRAGMAS:
+            cursor.execute(pragma)
+        cursor.close()
+
+    def _begin(self, connection):
+        # A transaction that will write takes the write lock when it begins,
+        # waiting for other processes to finish with it if need be. A
+        # deferred transaction would only take it at its first write, and
+        # if another process had written since the transaction's first read
+        # SQLite would then fail at once with "database is locked" rather
+        # than wait.
+        # Issued on the DBAPI connection, since executing through
+        # connection here would begin a transaction again.
+        cursor = connection.connection.cursor()
+        cursor.execute('BEGIN IMMEDIATE' if self._begin_immediate
+                       else 'BEGIN')
+        cursor.close()
+
+    @staticmethod
+    def _is_busy(error):
+        message = str(getattr(error, 'orig', error))
+        return 'database is locked' in message or 'database is busy' in message
+
+    def _commit_writes(self, writes):
+        """Call each of writes in one write transaction and commit it.
+
+        Any transaction the session already has open is ended first, so
+        that the write transaction starts from the latest state of the
+        cache. If the write lock cannot be had within CACHE_BUSY_TIMEOUT,
+        the transaction is attempted again, up to CACHE_WRITE_TRIES times
+        in all, after a short random delay.
+        """
+        import random
+        for attempt in range(1, CACHE_WRITE_TRIES + 1):
+            self.session.commit()
+            self._begin_immediate = True
+            try:
+                self.session.connection()
+            except sqlalchemy.exc.OperationalError as e:
+                self.session.rollback()
+                if attempt == CACHE_WRITE_TRIES or not self._is_busy(e):
+                    raise
+                time.sleep(random.uniform(0, attempt))
+                continue
+            finally:
+                self._begin_immediate = False
+            try:
+                for write in writes:
+                    write()
+                self.session.commit()
+            except BaseException:
+                self.session.rollback()
+                raise
+            return
+
+    def _write(self, write):
+        """Call write() in a short write transaction of its own.
+
+        Within group_commit, write is queued to be committed later along
+        with others instead.
+        """
+        if self._pending_writes is None:
+            self._commit_writes([write])
+            return
+        if not self._pending_writes:
+            self._pending_since = time.time()
+        self._pending_writes.append(write)
+        if (len(self._pending_writes) >= self._group_max_writes or
+                time.time() - self._pending_since >= self._group_max_delay):
+            self.flush_writes()
+
+    def flush_writes(self):
+        """Commit the writes queued by group_commit now"""
+        if self._pending_writes:
+            writes, self._pending_writes = self._pending_writes, []
+            self._commit_writes(writes)
+
+    @contextlib.contextmanager
+    def group_commit(self, max_writes=GROUP_COMMIT_MAX_WRITES,
+                     max_delay=GROUP_COMMIT_MAX_DELAY):
+        """Commit the writes made within the block together in groups.
+
+        Writes are queued, and committed in one transaction once max_writes
+        are queued or the oldest has been queued for max_delay seconds, and
+        at the end of the block (even if it raises). This takes the write
+        lock far less often when many small records are written, such as
+        one per part of an upload. Reads made within the block do not see
+        the writes still queued.
+        """
+        if self._pending_writes is not None:
+            yield
+            return
+        self._pending_writes = []
+        self._group_max_writes = max_writes
+        self._group_max_delay = max_delay
         try:
-            result = self._get_archive_query_by_ref(vault, ref).one()
-        except sqlalchemy.orm.exc.NoResultFound:
-            raise KeyError(ref)
-        return result.last_seen_upstream or result.created_here
+            yield
+        finally:
+            try:
+                self.flush_writes()
+            finally:
+                self._pending_writes = None
+
+    def _upgrade_schema(self):
+        version = self.connection.execute(
+            sqlalchemy.text('PRAGMA user_version')).scalar()
+        if version == self.SCHEMA_VERSION:
+            return
+        # Another process may be upgrading the same database, so check the
+        # version again once holding the write lock.
+        self._begin_immediate = True
+        try:
+            transaction = self.connection.begin()
+        finally:
+            self._begin_immediate = False
+        with transaction:
+            connection = self.connection
+            version = connection.execute(
+                sqlalchemy.text('PRAGMA user_version')).scalar()
+            if version == self.SCHEMA_VERSION:
+                return
+            if version > self.SCHEMA_VERSION:
+                raise RuntimeError(
+                    'cache schema version %d is newer than this version of '
+                    '%s supports (%d)' %
+                    (version, PROGRAM_NAME, self.SCHEMA_VERSION))
+            existing = self.engine.dialect.has_table(connection, 'archive')
+            if existing:
+                for statements in self.MIGRATIONS[version:]:
+                    for statement in statements:
+                        connection.execute(sqlalchemy.text(statement))
+            self.Base.metadata.create_all(connection)
+            connection.execute(sqlalchemy.text(
+                'PRAGMA user_version = %d' % self.SCHEMA_VERSION))
+
+    def _query(self, sql, params):
+        self.session.flush()
+        return iter_rows(self.session.execute(sqlalchemy.text(sql), params))
+
+    def add_archive(self, vault, name, id, tree_hash=None, size=None):
+        self._write(lambda: self.session.add(self.Archive(
+            key=self.key, vault=vault, name=name, id=id, tree_hash=tree_hash,
+            size=size)))
+
+    def _get_archive_query_by_ref(self, vault, ref):
+        column, value = self._ref_condition(ref)
+        return self.session.query(self.Archive).filter_by(
+                key=self.key, vault=vault, deleted_here=None,
+                **{column: value})
 
     def delete_archive(self, vault, ref):
         try:
-            result = self._get_archive_query_by_ref(vault, ref).one()
+            self._get_archive_query_by_ref(vault, ref).one()
         except sqlalchemy.orm.exc.NoResultFound:
-            raise KeyError(name)
-        result.deleted_here = time.time()
-        self.session.commit()
+            raise KeyError(ref)
+        deleted_here = time.time()
+        self._write(lambda: self._get_archive_query_by_ref(vault, ref).update(
+            {'deleted_here': deleted_here}, synchronize_session=False))
+
+    def add_pack_members(self, vault, archive_id, members):
+        """Record the (path, offset, size) of each file in a pack archive"""
+        rows = [{'key': self.key, 'vault': vault, 'archive_id': archive_id,
+                 'path': path, 'offset': offset, 'size': size}
+                for path, offset, size in members]
+        self._write(lambda: self.session.execute(
+            self.PackMember.__table__.insert(), rows))
+
+    def get_pack_member(self, vault, path):
+        """Return (archive_id, offset, size, archive_size) of a packed file.
+
+        If the file is in more than one pack, the newest one counts. Raise
+        KeyError if it is in none.
+        """
+        PackMember = self.PackMember
+        row = self.session.query(
+            PackMember.archive_id, PackMember.offset, PackMember.size,
+            self.Archive.size).join(
+                self.Archive, self.Archive.id == PackMember.archive_id).filter(
+                    PackMember.key == self.key, PackMember.vault == vault,
+                    PackMember.path == path,
+                    self.Archive.deleted_here.is_(None)).order_by(
+                        self.Archive.created_here.desc()).first()
+        if row is None:
+            raise KeyError(path)
+        return tuple(row)
+
+    def delete_archive_by_id(self, vault, id):
+        """Record that the archive with this id was deleted.
+
+        Unlike delete_archive, this does not look the archive up first, so
+        that within group_commit recording many deletions costs one UPDATE
+        each and one commit per group.
+        """
+        deleted_here = time.time()
+        self._write(lambda: self.session.query(self.Archive).filter_by(
+            key=self.key, vault=vault, id=id, deleted_here=None).update(
+                {'deleted_here': deleted_here}, synchronize_session=False))
+
+    def load_inventory(self, archives, batch_size=INVENTORY_BATCH_SIZE):
+        """Stage an inventory for reconcile_inventory.
+
+        archives is an iterable of (id, name, tree_hash, size, creation_date)
+        in inventory order. They are
+        loaded into a temporary table in batches of batch_size, within the
+        current transaction, so that reconciliation can be done with a few
+        set-based statements rather than one query per archive.
+        """
+        self.session.execute(sqlalchemy.text(
+            'DROP TABLE IF EXISTS temp.inventory'))
+        self.session.execute(sqlalchemy.text(
+            'CREATE TEMP TABLE inventory ('
+            'seq INTEGER PRIMARY KEY, id VARCHAR, name VARCHAR, '
+            'tree_hash VARCHAR, size INTEGER, creation_date VARCHAR)'))
+        insert = sqlalchemy.text(
+            'INSERT INTO temp.inventory '
+            '(id, name, tree_hash, size, creation_date) '
+            'VALUES (:id, :name, :tree_hash, :size, :creation_date)')
+        archives = iter(archives)
+        while True:
+            batch = [{'id': id, 'name': name, 'tree_hash': tree_hash,
+                      'size': size, 'creation_date': creation_date}
+                     for id, name, tree_hash, size, creation_date
+                     in itertools.islice(archives, batch_size)]
+            if not batch:
+                break
+            self.session.execute(insert, batch)
+        self.session.execute(sqlalchemy.text(
+            'CREATE INDEX temp.inventory_id ON inventory (id)'))
+
+    def get_vault_sync(self, vault):
+        """Return the VaultSync recorded for vault, or None"""
+        return self.session.query(self.VaultSync).filter_by(
+            key=self.key, vault=vault).first()
 
     @staticmethod
-    def _archive_ref(archive, force_id=False):
-        if archive.name and not force_id:
-            if (archive.name.startswith('name:') or
-                    archive.name.startswith('id:')):
-                return "name:%s" % archive.name
-            else:
-                return archive.name
+    def _last_seen_upstream(upstream_inventory_date,
+                            upstream_inventory_job_creation_date):
+        # See the comment in reconcile_inventory
+        return max(
+            upstream_inventory_date,
+            upstream_inventory_job_creation_date - INVENTORY_LAG
+            )
+
+    def _set_vault_sync(self, vault, job_id, inventory_date,
+                        last_seen_upstream):
+        self.session.merge(self.VaultSync(
+            key=self.key, vault=vault, job_id=job_id,
+            inventory_date=inventory_date,
+            last_seen_upstream=last_seen_upstream))
+
+    def ignore_inventory_job(self, vault, job_id):
+        """Record that job_id's inventory is older than the one reconciled.
+
+        The job then counts as handled, so that it is not downloaded again,
+        but the state of the inventory reconciled is kept.
+        """
+        self._write(lambda: self.session.query(self.VaultSync).filter_by(
+            key=self.key, vault=vault).update(
+                {'job_id': job_id}, synchronize_session=False))
+
+    def refresh_inventory(self, vault, upstream_inventory_job_creation_date,
+                          job_id):
+        """Apply an inventory identical to the last one reconciled.
+
+        Nothing in the vault has changed, so the only effect is that the
+        archives that were in the last inventory have now been seen more
+        recently. Those are the archives given the last_seen_upstream that
+        was recorded for it.
+        """
+        self._write(lambda: self._refresh_inventory(
+            vault, upstream_inventory_job_creation_date, job_id))
+
+    def _refresh_inventory(self, vault, upstream_inventory_job_creation_date,
+                           job_id):
+        state = self.get_vault_sync(vault)
+        last_seen_upstream = self._last_seen_upstream(
+            state.inventory_date, upstream_inventory_job_creation_date)
+        if last_seen_upstream > state.last_seen_upstream:
+            self.session.execute(
+                sqlalchemy.text(
+                    'UPDATE archive SET last_seen_upstream = :new '
+                    'WHERE key = :key AND vault = :vault '
+                    'AND last_seen_upstream = :old'),
+                {'key': self.key, 'vault': vault, 'new': last_seen_upstream,
+                 'old': state.last_seen_upstream})
         else:
-            return 'id:' + archive.id
-
-    def _get_archive_list_objects(self, vault):
-        for archive in (
-                self.session.query(self.Archive).
-                             filter_by(key=self.key,
-                                       vault=vault,
-                                       deleted_here=None).
-                             order_by(self.Archive.name)):
-            yield archive
-
-    def get_archive_list(self, vault):
-        def force_id(archive):
-            return "\t".join([
-                self._archive_ref(archive, force_id=True),
-                "%s" % archive.name
-                ])
-
-        for archive_name, archive_iterator in (
-                itertools.groupby(
-                    self._get_archive_list_objects(vault),
-                    lambda archive: archive.name)):
-            # Yield self._archive_ref(..., force_id=True) if there is more than
-            # one archive with the same name; otherwise use force_id=False.
-            first_archive = next(archive_iterator)
-            try:
-                second_archive = next(archive_iterator)
-            except StopIteration:
-                yield self._archive_ref(first_archive, force_id=False)
-            else:
-                yield force_id(first_archive)
-                yield force_id(second_archive)
-                for subsequent_archive in archive_iterator:
-                    yield force_id(subsequent_archive)
-
-    def get_archive_list_with_ids(self, vault):
-        for archive in self._get_archive_list_objects(vault):
-            yield "\t".join([
-                self._archive_ref(archive, force_id=True),
-                "%s" % archive.name,
-                ])
-
-    def mark_seen_upstream(
-            self, vault, id, name, upstream_creation_date,
-            upstream_inventory_date, upstream_inventory_job_creation_date,
-            fix=False):
+            last_seen_upstream = state.last_seen_upstream
+        self._set_vault_sync(vault, job_id, state.inventory_date,
+                             last_seen_upstream)
+        self.session.expire_all()
+
+    def reconcile_inventory(
+            self, vault, upstream_inventory_date,
+            upstream_inventory_job_creation_date, fix=False, job_id=None):
+        """Reconcile the cache with the inventory staged by load_inventory.
+
+        Archives in the inventory are added to the cache or marked as seen,
+        and archives in the cache that are missing from the inventory are
+        reported (and removed where appropriate). If job_id is given, the
+        inventory is recorded as the last one reconciled for the vault.
+        This is done in a write transaction of its own.
+        """
+        self._write(lambda: self._reconcile_inventory(
+            vault, upstream_inventory_date,
+            upstream_inventory_job_creation_date, fix=fix, job_id=job_id))
+
+    def _reconcile_inventory(
+            self, vault, upstream_inventory_date,
+            upstream_inventory_job_creation_date, fix=False, job_id=None):
 
         # Inventories don't get recreated unless the vault has changed.
         # See: https://forums.aws.amazon.com/thread.jspa?threadID=106541
@@ -249,74 +1767,186 @@ class Cache(object):
         #
         # With thanks to Wolfgang Nagele.
 
-        last_seen_upstream = max(
-            upstream_inventory_date,
-            upstream_inventory_job_creation_date - INVENTORY_LAG
-            )
-
-        try:
-            archive = self.session.query(self.Archive).filter_by(
-                key=self.key, vault=vault, id=id).one()
-        except sqlalchemy.orm.exc.NoResultFound:
-            self.session.add(
-                self.Archive(
-                    key=self.key, vault=vault, name=name, id=id,
-                    last_seen_upstream=last_seen_upstream
-                    )
-                )
-        else:
-            if not archive.name:
-                archive.name = name
-            elif archive.name != name:
+        last_seen_upstream = self._last_seen_upstream(
+            upstream_inventory_date, upstream_inventory_job_creation_date)
+
+        self.session.flush()
+        params = {
+            'key': self.key,
+            'vault': vault,
+            'fix': bool(fix),
+            'last_seen_upstream': last_seen_upstream,
+            'now': time.time(),
+            'inventory_date': upstream_inventory_date,
+        }
+
+        def execute(sql):
+            return self.session.execute(sqlalchemy.text(sql), params)
+
+        # Warn about archives in the inventory that have changed name or that
+        # we have deleted, in inventory order.
+        for id, our_name, their_name, deleted_here in iter_rows(execute(
+                'SELECT a.id, a.name, i.name, a.deleted_here '
+                'FROM temp.inventory i JOIN archive a '
+                'ON a.id = i.id AND a.key = :key AND a.vault = :vault '
+                "WHERE (a.name IS NOT NULL AND a.name != '' "
+                'AND a.name IS NOT i.name) OR a.deleted_here '
+                'ORDER BY i.seq')):
+            name = our_name
+            if not our_name:
+                name = their_name
+            elif our_name != their_name:
                 if fix:
                     warn('archive %r appears to have changed name from %r ' %
-                         (archive.id, archive.name) + 'to %r (fixed)' % (name))
-                    archive.name = name
+                         (id, our_name) + 'to %r (fixed)' % (their_name))
+                    name = their_name
                 else:
                     warn('archive %r appears to have changed name from %r ' %
-                         (archive.id, archive.name) + 'to %r' % (name))
-            if archive.deleted_here:
-                archive_ref = self._archive_ref(archive)
-                if archive.deleted_here < upstream_inventory_date:
+                         (id, our_name) + 'to %r' % (their_name))
+            if deleted_here:
+                archive_ref = self._ref(name, id)
+                if deleted_here < upstream_inventory_date:
                     warn('archive %r marked deleted but still present' %
                          archive_ref)
                 else:
                     warn('archive %r deletion not yet in inventory' %
                          archive_ref)
-            archive.last_seen_upstream = last_seen_upstream
-
-    def mark_only_seen(self, vault, inventory_date, ids, fix=False):
-        upstream_ids = set(ids)
-        our_ids = set([r[0] for r in
-                self.session.query(self.Archive.id)
-                            .filter_by(key=self.key, vault=vault).all()])
-        missing_ids = our_ids - upstream_ids
-        for id in missing_ids:
-            archive = (self.session.query(self.Archive)
-                                   .filter_by(key=self.key,
-                                              vault=vault, id=id)
-                                   .one())
-            archive_ref = self._archive_ref(archive)
-            if archive.deleted_here and archive.deleted_here < inventory_date:
-                self.session.delete(archive)
+
+        execute(
+            'UPDATE archive SET last_seen_upstream = :last_seen_upstream '
+            'WHERE key = :key AND vault = :vault '
+            'AND id IN (SELECT id FROM temp.inventory)')
+        # Contents and names are only written where they differ from the
+        # inventory, which after the first sync of a vault is rarely.
+        execute(
+            "UPDATE archive SET name = CASE WHEN name IS NULL OR name = '' "
+            'OR :fix THEN (SELECT i.name FROM temp.inventory i '
+            'WHERE i.id = archive.id) ELSE name END, '
+            'tree_hash = (SELECT i.tree_hash FROM temp.inventory i '
+            'WHERE i.id = archive.id), '
+            'size = (SELECT i.size FROM temp.inventory i '
+            'WHERE i.id = archive.id), '
+            'creation_date = (SELECT i.creation_date FROM temp.inventory i '
+            'WHERE i.id = archive.id) '
+            'WHERE key = :key AND vault = :vault AND EXISTS ('
+            'SELECT 1 FROM temp.inventory i WHERE i.id = archive.id AND ('
+            'archive.tree_hash IS NOT i.tree_hash '
+            'OR archive.size IS NOT i.size '
+            'OR archive.creation_date IS NOT i.creation_date '
+            "OR ((archive.name IS NULL OR archive.name = '' OR :fix) "
+            'AND archive.name IS NOT i.name)))')
+        execute(
+            'INSERT INTO archive (id, name, vault, key, '
+            'last_seen_upstream, created_here, tree_hash, size, '
+            'creation_date) '
+            'SELECT i.id, i.name, :vault, :key, :last_seen_upstream, :now, '
+            'i.tree_hash, i.size, i.creation_date '
+            'FROM temp.inventory i WHERE NOT EXISTS ('
+            'SELECT 1 FROM archive a '
+            'WHERE a.key = :key AND a.vault = :vault AND a.id = i.id)')
+
+        # Archives in the cache but missing from the inventory
+        removed_ids = []
+        for id, name, last_seen_upstream, created_here, deleted_here in execute(
+                'SELECT a.id, a.name, a.last_seen_upstream, a.created_here, '
+                'a.deleted_here FROM archive a '
+                'WHERE a.key = :key AND a.vault = :vault AND NOT EXISTS ('
+                'SELECT 1 FROM temp.inventory i WHERE i.id = a.id) '
+                'ORDER BY a.id').fetchall():
+            archive_ref = self._ref(name, id)
+            if deleted_here and deleted_here < upstream_inventory_date:
+                removed_ids.append(id)
                 info('deleted archive %r has left inventory; ' % archive_ref +
                      'removed from cache')
-            elif not archive.deleted_here and (
-                  archive.last_seen_upstream or
-                    (archive.created_here and
-                     archive.created_here < inventory_date - INVENTORY_LAG)):
+            elif not deleted_here and (
+                  last_seen_upstream or
+                    (created_here and
+                     created_here < upstream_inventory_date - INVENTORY_LAG)):
                 if fix:
-                    self.session.delete(archive)
+                    removed_ids.append(id)
                     warn('archive disappeared: %r (removed from cache)' %
                          archive_ref)
                 else:
                     warn('archive disappeared: %r' % archive_ref)
             else:
                 warn('new archive not yet in inventory: %r' % archive_ref)
+        if removed_ids:
+            self.session.execute(
+                sqlalchemy.text('DELETE FROM archive '
+                                'WHERE key = :key AND vault = :vault '
+                                'AND id = :id'),
+                [{'key': self.key, 'vault': vault, 'id': id}
+                 for id in removed_ids])
+
+        self.session.execute(sqlalchemy.text('DROP TABLE temp.inventory'))
+        if job_id is not None:
+            self._set_vault_sync(vault, job_id, upstream_inventory_date,
+                                 params['last_seen_upstream'])
+        self.session.expire_all()
 
     def mark_commit(self):
         self.session.commit()
 
+    def _get_retrieval_range_query(self, vault, job_id, filename):
+        return self.session.query(self.RetrievalRange).filter_by(
+            key=self.key, vault=vault, job_id=job_id, filename=filename)
+
+    def get_retrieved_ranges(self, vault, job_id, filename):
+        """Return {offset: (length, tree_hash)} already written to filename"""
+        return dict(
+            (r.offset, (r.length, r.tree_hash))
+            for r in self._get_retrieval_range_query(vault, job_id, filename))
+
+    def add_retrieved_range(self, vault, job_id, filename, offset, length,
+                            tree_hash):
+        self._write(lambda: self.session.merge(self.RetrievalRange(
+            key=self.key, vault=vault, job_id=job_id, filename=filename,
+            offset=offset, length=length, tree_hash=tree_hash)))
+
+    def delete_retrieved_ranges(self, vault, job_id, filename):
+        self._write(lambda: self._get_retrieval_range_query(
+            vault, job_id, filename).delete())
+
+    def add_upload(self, vault, id, name, source, size, part_size):
+        self._write(lambda: self.session.add(self.Upload(
+            key=self.key, vault=vault, id=id, name=name, source=source,
+            size=size, part_size=part_size)))
+
+    def get_upload(self, vault, name, source, size):
+        """Return (id, part_size) of the latest matching upload, or None"""
+        upload = (self.session.query(self.Upload)
+                              .filter_by(key=self.key, vault=vault, name=name,
+                                         source=source, size=size)
+                              .order_by(self.Upload.created_here.desc())
+                              .first())
+        if upload is None:
+            return None
+        return upload.id, upload.part_size
+
+    def get_upload_list(self, vault):
+        return (self.session.query(self.Upload)
+                            .filter_by(key=self.key, vault=vault)
+                            .order_by(self.Upload.created_here)
+                            .all())
+
+    def delete_upload(self, vault, id):
+        self._write(lambda: self.session.query(self.Upload).filter_by(
+            key=self.key, vault=vault, id=id).delete())
+
+    def get_job_listing(self, vault, max_age):
+        """Return the job descriptions stored for vault by set_job_listing,
+        or None if there are none from within the last max_age seconds."""
+        listing = self.session.query(self.JobListing).filter_by(
+            key=self.key, vault=vault).first()
+        if listing is None or listing.listed < time.time() - max_age:
+            return None
+        return json.loads(listing.jobs)
+
+    def set_job_listing(self, vault, jobs):
+        listed = time.time()
+        self._write(lambda: self.session.merge(self.JobListing(
+            key=self.key, vault=vault, listed=listed, jobs=json.dumps(jobs))))
+
 
 def get_connection_account(connection):
     """Return some account key associated with the connection.
@@ -330,8 +1960,307 @@ def get_connection_account(connection):
     return connection.layer1.aws_access_key_id
 
 
-def find_retrieval_jobs(vault, archive_id):
-    return [job for job in vault.list_jobs() if job.archive_id == archive_id]
+def list_multipart_uploads(layer1, vault_name):
+    marker = None
+    while True:
+        response = layer1.list_multipart_uploads(vault_name, marker=marker)
+        for upload in response['UploadsList']:
+            yield upload
+        marker = response.get('Marker')
+        if not marker:
+            return
+
+
+def list_vault_jobs(vault, completed=None):
+    """Return the jobs in vault as boto Jobs, as vault.list_jobs() would.
+
+    boto's Vault.list_jobs returns only the first page of the listing, which
+    Glacier limits to 50 jobs, so the pages are followed here instead.
+    """
+    import boto.glacier.job
+    jobs = []
+    marker = None
+    while True:
+        response = vault.layer1.list_jobs(vault.name, completed=completed,
+                                          marker=marker)
+        jobs.extend(boto.glacier.job.Job(vault, job_data)
+                    for job_data in response['JobList'])
+        marker = response.get('Marker')
+        if not marker:
+            return jobs
+
+
+def open_job_output(job):
+    """Return the output of job as an unparsed file-like HTTP response.
+
+    job.get_output() parses a JSON response body in full before returning,
+    which is not acceptable for large inventories. This makes the same
+    request but leaves the body to be read incrementally.
+    """
+    import boto.connection
+    import boto.glacier.exceptions
+    layer1 = job.vault.layer1
+    uri = '/%s/vaults/%s/jobs/%s/output' % (
+        layer1.account_id, job.vault.name, job.id)
+    response = boto.connection.AWSAuthConnection.make_request(
+        layer1, 'GET', uri, headers={'x-amz-glacier-version': layer1.Version})
+    if response.status != 200:
+        raise boto.glacier.exceptions.UnexpectedHTTPResponseError(
+            (200,), response)
+    return response
+
+
+class InventoryReader(object):
+    """Incrementally parse a JSON vault inventory from a file-like object.
+
+    archives() yields each entry of ArchiveList as it is parsed, so that only
+    one read buffer's worth of the inventory is held in memory at a time.
+    The other top level fields (such as InventoryDate) are collected in
+    header as they are encountered; they are complete once archives() is
+    exhausted.
+    """
+    def __init__(self, stream, read_size=64 * 1024):
+        self.stream = stream
+        self.read_size = read_size
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.header = {}
+
+    def _fill(self):
+        if self.eof:
+            raise ValueError('truncated inventory')
+        data = self.stream.read(self.read_size)
+        if not data:
+            self.eof = True
+            data = b''
+        self.buffer = (self.buffer[self.pos:] +
+                       self.text_decoder.decode(data, final=self.eof))
+        self.pos = 0
+
+    def _peek(self):
+        """Skip whitespace and return the next character"""
+        while True:
+            while (self.pos < len(self.buffer) and
+                   self.buffer[self.pos].isspace()):
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            self._fill()
+
+    def _expect(self, chars):
+        c = self._peek()
+        if c not in chars:
+            raise ValueError('unexpected %r in inventory' % c)
+        self.pos += 1
+        return c
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                # Incomplete value; read more unless there is nothing left
+                self._fill()
+                continue
+            # A value at the very end of the buffer (eg. a number) might
+            # continue in the next read, but a complete inventory always
+            # ends with a closing brace.
+            if end == len(self.buffer) and not self.eof:
+                self._fill()
+                continue
+            self.pos = end
+            return value
+
+    def archives(self):
+        self._expect('{')
+        if self._peek() == '}':
+            return
+        while True:
+            key = self._value()
+            self._expect(':')
+            if key == 'ArchiveList':
+                self._expect('[')
+                if self._peek() == ']':
+                    self.pos += 1
+                else:
+                    while True:
+                        yield self._value()
+                        if self._expect(',]') == ']':
+                            break
+            else:
+                self.header[key] = self._value()
+            if self._expect(',}') == '}':
+                return
+
+
+class JobIndex(object):
+    """The jobs in a vault, indexed by action and archive id.
+
+    Listing jobs is an API call that returns every job in the vault, so an
+    index is built from one listing and then used for every archive looked
+    up, rather than listing the jobs again for each.
+
+    ranges is {job_id: (start, end)} for the archive retrieval jobs that
+    retrieve only part of their archive, as kept by track_job_ranges.
+    """
+    def __init__(self, jobs=(), ranges=None):
+        self.jobs = []
+        self.ranges = {} if ranges is None else ranges
+        self._by_key = {}
+        for job in jobs:
+            self.add(job)
+
+    def add(self, job):
+        self.jobs.append(job)
+        self._by_key.setdefault((job.action, job.archive_id), []).append(job)
+
+    def find(self, action, archive_id=None, byte_range=None):
+        """Return the jobs for archive_id that cover byte_range.
+
+        A job that retrieves the whole archive covers any range; with
+        byte_range None, only such jobs are returned.
+        """
+        def covers(job):
+            job_range = self.ranges.get(job.id)
+            if job_range is None:
+                return True
+            if byte_range is None:
+                return False
+            return job_range[0] <= byte_range[0] and \
+                byte_range[1] <= job_range[1]
+
+        return [job for job in self._by_key.get((action, archive_id), [])
+                if covers(job)]
+
+
+def record_job_ranges(ranges, response):
+    """Add the ranges of the partial retrieval jobs in response to ranges.
+
+    response is the result of a ListJobs or DescribeJob request. Glacier
+    gives every archive retrieval job a RetrievalByteRange; only those that
+    are not the whole archive are recorded.
+    """
+    if not isinstance(response, dict):
+        return
+    for job in response.get('JobList', [response]):
+        value = job.get('RetrievalByteRange')
+        if job.get('Action') != 'ArchiveRetrieval' or not value:
+            continue
+        start, end = [int(n) for n in value.split('-')]
+        if (start, end + 1) != (0, job.get('ArchiveSizeInBytes')):
+            ranges[job['JobId']] = (start, end + 1)
+
+
+def record_job_tiers(tiers, response):
+    """Add the retrieval tier of each job in response to tiers.
+
+    response is the result of a ListJobs or DescribeJob request.
+    """
+    if not isinstance(response, dict):
+        return
+    for job in response.get('JobList', [response]):
+        if job.get('Tier'):
+            tiers[job['JobId']] = job['Tier']
+
+
+def track_jobs(layer1):
+    """Record what boto's Job does not keep of the jobs seen by layer1.
+
+    boto's Job keeps neither RetrievalByteRange nor Tier, so layer1's
+    list_jobs and describe_job, from which boto's Jobs are made, are wrapped
+    to record them from their responses in layer1.job_ranges and
+    layer1.job_tiers. This is done only once for the same layer1.
+    """
+    if 'job_ranges' in layer1.__dict__:
+        return
+    ranges = layer1.job_ranges = {}
+    tiers = layer1.job_tiers = {}
+
+    def recording(method):
+        def wrapper(*args, **kwargs):
+            response = method(*args, **kwargs)
+            record_job_ranges(ranges, response)
+            record_job_tiers(tiers, response)
+            return response
+        return wrapper
+
+    layer1.list_jobs = recording(layer1.list_jobs)
+    layer1.describe_job = recording(layer1.describe_job)
+
+
+def track_job_ranges(layer1):
+    """Return {job_id: (start, end)} of the partial retrieval jobs seen"""
+    track_jobs(layer1)
+    return layer1.job_ranges
+
+
+def track_job_tiers(layer1):
+    """Return {job_id: tier} of the jobs seen, where Glacier gives one"""
+    track_jobs(layer1)
+    return layer1.job_tiers
+
+
+def job_to_response_data(job, byte_range=None, tier=None):
+    """Return the job description that boto's Job(vault, data) takes.
+
+    byte_range, if the job retrieves only part of its archive, is included
+    as RetrievalByteRange for record_job_ranges, and tier as Tier for
+    record_job_tiers.
+    """
+    data = dict((response_name, getattr(job, attr_name))
+                for response_name, attr_name, default
+                in job.ResponseDataElements)
+    if byte_range is not None:
+        data['RetrievalByteRange'] = '%d-%d' % (byte_range[0],
+                                                byte_range[1] - 1)
+    if tier is not None:
+        data['Tier'] = tier
+    return data
+
+
+def find_retrieval_jobs(vault, archive_id, job_index=None, byte_range=None):
+    """Return the retrieval jobs for archive_id that cover byte_range.
+
+    With byte_range None, these are the jobs for the whole archive.
+    """
+    if job_index is None:
+        job_index = JobIndex(list_vault_jobs(vault))
+    return job_index.find('ArchiveRetrieval', archive_id, byte_range)
+
+
+def initiate_archive_retrieval(vault, archive_id, byte_range=None,
+                               tier=None):
+    """Start a retrieval job for an archive, or byte_range of it.
+
+    tier is the retrieval tier to use, or None for Glacier's default.
+    """
+    if byte_range is None and tier is None:
+        return vault.retrieve_archive(archive_id)
+    # boto's Vault.retrieve_archive can retrieve neither a range nor with a
+    # tier
+    job_data = {
+        'Type': 'archive-retrieval',
+        'ArchiveId': archive_id,
+    }
+    if byte_range is not None:
+        start, end = byte_range
+        job_data['RetrievalByteRange'] = '%d-%d' % (start, end - 1)
+    if tier is not None:
+        job_data['Tier'] = tier
+    response = vault.layer1.initiate_job(vault.name, job_data)
+    return vault.get_job(response['JobId'])
+
+
+def copy_job_output(job, f):
+    """Write the output of job to f, truncating it first"""
+    import shutil
+    f.seek(0)
+    f.truncate()
+    shutil.copyfileobj(open_job_output(job), f)
 
 
 def find_inventory_jobs(vault, max_age_hours=0):
@@ -346,11 +2275,12 @@ def find_inventory_jobs(vault, max_age_hours=0):
         def recent_enough(job):
             return not job.completed
 
-    return [job for job in vault.list_jobs()
+    return [job for job in list_vault_jobs(vault)
             if job.action == 'InventoryRetrieval' and recent_enough(job)]
 
 
 def find_complete_job(jobs):
+    import iso8601
     for job in sorted(filter(lambda job: job.completed, jobs), key=lambda job: iso8601.parse_date(job.completion_date), reverse=True):
         return job
 
@@ -359,12 +2289,12 @@ def has_pending_job(jobs):
     return any(filter(lambda job: not job.completed, jobs))
 
 
-def update_job_list(jobs):
-    for i, job in enumerate(jobs):
-        jobs[i] = job.vault.get_job(job.id)
-
+def job_oneline(conn, cache, vault, job, archive_names=None):
+    """Return a line describing job.
 
-def job_oneline(conn, cache, vault, job):
+    Archive names are looked up in archive_names ({id: name}) if given, and
+    otherwise in cache, one query per job.
+    """
     action_letter = {'ArchiveRetrieval': 'a',
                      'InventoryRetrieval': 'i'}[job.action]
     status_letter = {'InProgress': 'p',
@@ -374,10 +2304,14 @@ def job_oneline(conn, cache, vault, job):
     if not date:
         date = job.creation_date
     if job.action == 'ArchiveRetrieval':
-        try:
-            name = cache.get_archive_name(vault.name, 'id:' + job.archive_id)
-        except KeyError:
-            name = None
+        if archive_names is not None:
+            name = archive_names.get(job.archive_id)
+        else:
+            try:
+                name = cache.get_archive_name(vault.name,
+                                              'id:' + job.archive_id)
+            except KeyError:
+                name = None
         if name is None:
             name = 'id:' + job.archive_id
     elif job.action == 'InventoryRetrieval':
@@ -386,30 +2320,376 @@ def job_oneline(conn, cache, vault, job):
             **locals())
 
 
-def wait_until_job_completed(jobs, sleep=600, tries=144):
-    update_job_list(jobs)
-    job = find_complete_job(jobs)
-    while not job:
-        tries -= 1
-        if tries < 0:
-            raise RuntimeError('Timed out waiting for job completion')
-        time.sleep(sleep)
-        update_job_list(jobs)
-        job = find_complete_job(jobs)
+class SQSJobNotifications(object):
+    """Job completion notifications read from an Amazon SQS queue.
+
+    The queue must be subscribed to the SNS topic that the vault sends its
+    job notifications to. Notifications for jobs that are not being waited
+    for are left in the queue for others.
+    """
+    def __init__(self, queue_name, region):
+        import boto.sqs
+        self.queue = boto.sqs.connect_to_region(region).get_queue(queue_name)
+        if self.queue is None:
+            raise ConsoleError('SQS queue %r not found' % queue_name)
+
+    def receive(self, job_ids):
+        """Return those of job_ids that have been reported complete"""
+        completed = set()
+        while True:
+            messages = self.queue.get_messages(10)
+            if not messages:
+                break
+            for message in messages:
+                body = json.loads(message.get_body())
+                if 'Message' in body:
+                    # Delivered through SNS
+                    body = json.loads(body['Message'])
+                if body.get('JobId') in job_ids:
+                    completed.add(body['JobId'])
+                    self.queue.delete_message(message)
+        return completed
+
+
+class JobPoller(object):
+    """Wait for any of several groups of jobs to complete.
+
+    Each group is added with a key, and is complete when any job in it is.
+    Checks are scheduled by when the jobs are expected to complete, and each
+    check lists the completed jobs of a vault once for all of the groups in
+    it rather than describing every job. If notifications (such as an
+    SQSJobNotifications) are given, they are checked more often, so that
+    jobs are picked up as soon as they are reported complete.
+
+    tiers is {job_id: tier}, as kept by track_job_tiers, from which the
+    time each job is expected to take is found.
+    """
+    def __init__(self, notifications=None, clock=time.time, tiers=None):
+        self.notifications = notifications
+        self.clock = clock
+        self.tiers = {} if tiers is None else tiers
+        self.groups = collections.OrderedDict()
+        self.last_notification_check = clock()
+
+    def __len__(self):
+        return len(self.groups)
+
+    def _expected_completion(self, jobs):
+        expected = []
+        for job in jobs:
+            duration = JOB_TIER_DURATIONS.get(self.tiers.get(job.id),
+                                              JOB_TIER_DURATIONS['Standard'])
+            try:
+                created = iso8601_to_unix_timestamp(job.creation_date)
+            except ValueError:
+                # No creation date known
+                created = self.clock()
+            expected.append(created + duration)
+        return min(expected)
+
+    def _schedule(self, group):
+        now = self.clock()
+        remaining = group['expected'] - now
+        if remaining > 0:
+            delay = min(max(remaining / 2, JOB_POLL_MIN_INTERVAL),
+                        JOB_POLL_MAX_INTERVAL)
+        else:
+            delay = min(JOB_POLL_MIN_INTERVAL * 2 ** group['late_checks'],
+                        JOB_POLL_INTERVAL)
+            group['late_checks'] += 1
+        group['next_check'] = now + delay
+
+    def add(self, key, jobs):
+        group = {
+            'jobs': list(jobs),
+            'added': self.clock(),
+            'expected': self._expected_completion(jobs),
+            'late_checks': 0,
+        }
+        self._schedule(group)
+        self.groups[key] = group
+
+    def next_check_time(self):
+        """Return when check should next be called"""
+        next_check = min(group['next_check']
+                         for group in self.groups.values())
+        if self.notifications:
+            next_check = min(next_check, self.last_notification_check +
+                             JOB_NOTIFICATION_INTERVAL)
+        return next_check
+
+    def _complete(self, key, complete_job):
+        del self.groups[key]
+        return key, complete_job
+
+    def check(self):
+        """Return a list of (key, job) for the groups that are complete.
+
+        Completed groups are no longer tracked.
+        """
+        now = self.clock()
+        completed = []
+        if self.notifications and (now - self.last_notification_check >=
+                                   JOB_NOTIFICATION_INTERVAL):
+            self.last_notification_check = now
+            job_ids = set(job.id for group in self.groups.values()
+                          for job in group['jobs'])
+            notified = self.notifications.receive(job_ids)
+            for key, group in list(self.groups.items()):
+                for job in group['jobs']:
+                    if job.id in notified:
+                        completed.append(self._complete(
+                            key, job.vault.get_job(job.id)))
+                        break
+
+        due_vaults = collections.OrderedDict()
+        for group in self.groups.values():
+            if group['next_check'] <= now:
+                for job in group['jobs']:
+                    due_vaults[job.vault.name] = job.vault
+        for vault in due_vaults.values():
+            completed_jobs = dict(
+                (job.id, job)
+                for job in list_vault_jobs(vault, completed=True))
+            for key, group in list(self.groups.items()):
+                jobs = group['jobs']
+                if not any(job.vault.name == vault.name for job in jobs):
+                    continue
+                jobs[:] = [completed_jobs.get(job.id, job) for job in jobs]
+                complete_job = find_complete_job(jobs)
+                if complete_job:
+                    completed.append(self._complete(key, complete_job))
+                elif now - group['added'] > JOB_WAIT_TIMEOUT:
+                    raise RuntimeError('Timed out waiting for job completion')
+                else:
+                    self._schedule(group)
+        return completed
+
+    def wait(self, sleep=time.sleep):
+        """Yield (key, job) for each group as it completes"""
+        while self.groups:
+            delay = self.next_check_time() - self.clock()
+            if delay > 0:
+                sleep(delay)
+            for result in self.check():
+                yield result
+
+
+def wait_until_job_completed(jobs, notifications=None, tiers=None):
+    """Wait until any of jobs is complete and return it"""
+    poller = JobPoller(notifications, tiers=tiers)
+    poller.add(None, jobs)
+    for key, job in poller.wait():
+        return job
+
 
-    return job
+class DaemonStream(object):
+    """A file-like object that sends what is written to a daemon client"""
+    def __init__(self, wfile, name):
+        self.wfile = wfile
+        self.name = name
+
+    def write(self, data):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8', 'replace')
+        if data:
+            self.wfile.write(
+                (json.dumps({self.name: data}) + '\n').encode('utf-8'))
+
+    def flush(self):
+        self.wfile.flush()
+
+
+class Daemon(object):
+    """Serve glacier commands over a Unix socket.
+
+    The connection and cache are kept open between requests, so that each
+    request costs only the work of the command itself. Requests are served
+    one at a time, since the cache session is not thread safe.
+
+    A request is a single line of JSON: {"argv": [...], "aws_access_key_id":
+    ...}. The response is a line of JSON per write to stdout or stderr, as
+    {"stdout": text} or {"stderr": text}, followed by {"exit": status}. If
+    the daemon cannot run the request as the client would have, it responds
+    with {"refused": reason} alone and the client runs the command itself.
+    """
+    def __init__(self, app, socket_path):
+        self.socket_path = socket_path
+        self.aws_access_key_id = os.getenv('AWS_ACCESS_KEY_ID')
+        self.connections = {app.args.region: app.connection}
+        self.cache = app.cache
+
+    def get_connection(self, region):
+        if region not in self.connections:
+            import boto.glacier
+            self.connections[region] = boto.glacier.connect_to_region(region)
+        return self.connections[region]
+
+    def handle(self, rfile, wfile):
+        line = rfile.readline()
+        if not line.strip():
+            # A connection made only to check that the daemon is running
+            return
+        request = json.loads(line.decode('utf-8'))
+
+        def respond(**message):
+            wfile.write((json.dumps(message) + '\n').encode('utf-8'))
+            wfile.flush()
+
+        if request.get('aws_access_key_id') != self.aws_access_key_id:
+            respond(refused='daemon is running with different credentials')
+            return
+        status = self.run(request['argv'],
+                          stdout=DaemonStream(wfile, 'stdout'),
+                          stderr=DaemonStream(wfile, 'stderr'))
+        if status is None:
+            respond(refused='command cannot be run in the daemon')
+        else:
+            respond(exit=status)
+
+    def run(self, argv, stdout, stderr):
+        """Run a command as App would, with its output sent to stdout and
+        stderr, and return its exit status.
+
+        Return None without running the command if it is not one that
+        App.can_run_in_daemon allows.
+        """
+        saved_stdout, saved_stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = stdout, stderr
+        try:
+            # Start a new transaction so that changes made to the cache by
+            # other processes since the last request are seen.
+            self.cache.session.rollback()
+            try:
+                app = App(args=argv, cache=self.cache)
+                if not app.can_run_in_daemon():
+                    return None
+                app._connection = self.get_connection(app.args.region)
+                app.main()
+            except SystemExit as e:
+                if e.code is None or isinstance(e.code, int):
+                    return e.code or 0
+                print(e.code, file=sys.stderr)
+                return 1
+            except Exception:
+                import traceback
+                traceback.print_exc()
+                self.cache.session.rollback()
+                return 1
+            return 0
+        finally:
+            sys.stdout.flush()
+            sys.stdout, sys.stderr = saved_stdout, saved_stderr
+
+    def serve_forever(self):
+        import socket
+        try:
+            import socketserver
+        except ImportError:
+            import SocketServer as socketserver
+
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                try:
+                    daemon.handle(self.rfile, self.wfile)
+                except (IOError, socket.error) as e:
+                    warn('lost connection to client: %s' % e)
+
+        if os.path.exists(self.socket_path):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.socket_path)
+            except socket.error:
+                # Left behind by a daemon that did not exit cleanly
+                os.unlink(self.socket_path)
+            else:
+                raise ConsoleError('daemon already running on %s' %
+                                   self.socket_path)
+            finally:
+                sock.close()
+        mkdir_p(os.path.dirname(self.socket_path))
+        old_umask = os.umask(0o077)
+        try:
+            server = socketserver.UnixStreamServer(self.socket_path, Handler)
+        finally:
+            os.umask(old_umask)
+        info('listening on %s' % self.socket_path)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.unlink(self.socket_path)
+
+
+def run_via_daemon(argv, socket_path=None):
+    """Run a command in a daemon if one is listening on socket_path.
+
+    Return the command's exit status, or None if there is no daemon to run
+    it, in which case the caller should run the command itself.
+    """
+    if socket_path is None:
+        socket_path = get_default_socket_path()
+    if not os.path.exists(socket_path):
+        return None
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(socket_path)
+        except socket.error:
+            return None
+        f = sock.makefile('rwb')
+        f.write((json.dumps({
+            'argv': argv,
+            'aws_access_key_id': os.getenv('AWS_ACCESS_KEY_ID'),
+        }) + '\n').encode('utf-8'))
+        f.flush()
+        for line in f:
+            message = json.loads(line.decode('utf-8'))
+            if 'stdout' in message:
+                sys.stdout.write(message['stdout'])
+            elif 'stderr' in message:
+                sys.stderr.write(message['stderr'])
+            elif 'refused' in message:
+                return None
+            elif 'exit' in message:
+                sys.stdout.flush()
+                return message['exit']
+        # The command may have been partly run, so it is not safe to run it
+        # again here.
+        raise ConsoleError('lost connection to daemon')
+    finally:
+        sock.close()
+
+
+def upload_source(path):
+    """argparse type for the file given to "archive upload".
+
+    A directory, for --pack, is returned as its path; anything else is
+    opened as by argparse.FileType('rb').
+    """
+    if os.path.isdir(path):
+        return path
+    return argparse.FileType('rb')(path)
 
 
 class App(object):
     def job_list(self):
-        for vault in self.connection.list_vaults():
-            job_list = [job_oneline(self.connection,
-                                    self.cache,
-                                    vault,
-                                    job)
-                        for job in vault.list_jobs()]
-            if job_list:
-                print(*job_list, sep="\n")
+        # Jobs are listed for several vaults at once, but printed in vault
+        # order from this thread, which is the only one to use the cache.
+        for vault, jobs in iter_workers(
+                lambda vault: (vault, list_vault_jobs(vault)),
+                self.connection.list_vaults(), self.args.concurrency):
+            archive_names = self.cache_reader.get_archive_names_by_id(
+                vault.name, [job.archive_id for job in jobs
+                             if job.action == 'ArchiveRetrieval'])
+            for job in jobs:
+                print(job_oneline(self.connection, self.cache_reader, vault,
+                                  job, archive_names))
 
     def vault_list(self):
         print(*[vault.name for vault in self.connection.list_vaults()],
@@ -418,67 +2698,172 @@ class App(object):
     def vault_create(self):
         self.connection.create_vault(self.args.name)
 
-    def _vault_sync_reconcile(self, vault, job, fix=False):
-        response = job.get_output()
-        inventory_date = iso8601_to_unix_timestamp(response['InventoryDate'])
+    def _inventory_job_reconciled(self, vault, job):
+        state = self.cache.get_vault_sync(vault.name)
+        return state is not None and state.job_id == job.id
+
+    def _vault_sync_reconcile(self, vault, job, fix=False, stream=None):
+        """Reconcile the cache with the inventory that job retrieved.
+
+        Unless fixing, an inventory that has already been reconciled is not
+        downloaded again, one older than that is ignored, and one with the
+        same InventoryDate (which Glacier only changes when the vault
+        changes) only marks the archives already known to be in it as seen
+        more recently.
+        """
+        if not fix and self._inventory_job_reconciled(vault, job):
+            return
+        if stream is None:
+            stream = open_job_output(job)
+        reader = InventoryReader(stream)
+        archives = reader.archives()
+        # Reading up to the first archive parses the header fields that come
+        # before the archive list, which in Glacier's inventories include
+        # the InventoryDate.
+        first_archive = list(itertools.islice(archives, 1))
         job_creation_date = iso8601_to_unix_timestamp(job.creation_date)
-        seen_ids = []
-        for archive in response['ArchiveList']:
-            id = archive['ArchiveId']
-            name = archive['ArchiveDescription']
-            creation_date = iso8601_to_unix_timestamp(archive['CreationDate'])
-            self.cache.mark_seen_upstream(
-                vault=vault.name,
-                id=id,
-                name=name,
-                upstream_creation_date=creation_date,
-                upstream_inventory_date=inventory_date,
-                upstream_inventory_job_creation_date=job_creation_date,
-                fix=fix)
-            seen_ids.append(id)
-        self.cache.mark_only_seen(vault.name, inventory_date, seen_ids,
-                                  fix=fix)
+        state = self.cache.get_vault_sync(vault.name)
+        if state is not None and not fix and 'InventoryDate' in reader.header:
+            inventory_date = iso8601_to_unix_timestamp(
+                reader.header['InventoryDate'])
+            if inventory_date < state.inventory_date:
+                self.cache.ignore_inventory_job(vault.name, job.id)
+                return
+            if inventory_date == state.inventory_date:
+                self.cache.refresh_inventory(vault.name, job_creation_date,
+                                             job.id)
+                self.cache.mark_commit()
+                return
+        # Parsing is interleaved with reading the stream, so load_inventory
+        # includes any time spent in api.get_output for it.
+        with self.stats.phase('load_inventory'):
+            self.cache.load_inventory(
+                (archive['ArchiveId'], archive['ArchiveDescription'],
+                 archive.get('SHA256TreeHash'), archive.get('Size'),
+                 archive.get('CreationDate'))
+                for archive in itertools.chain(first_archive, archives))
+        inventory_date = iso8601_to_unix_timestamp(
+            reader.header['InventoryDate'])
+        with self.stats.phase('reconcile'):
+            self.cache.reconcile_inventory(
+                vault.name, inventory_date, job_creation_date, fix=fix,
+                job_id=job.id)
         self.cache.mark_commit()
 
-    def _vault_sync(self, vault_name, max_age_hours, fix, wait):
-        vault = self.connection.get_vault(vault_name)
+    @staticmethod
+    def _find_vault_inventory_job(vault, max_age_hours):
+        """Return (complete_job, pending_jobs, message) for vault.
+
+        If there is no recent enough inventory job, one is queued. Only the
+        connection is used, so that this can be run in a worker thread.
+        """
         inventory_jobs = find_inventory_jobs(vault,
                                              max_age_hours=max_age_hours)
-
         complete_job = find_complete_job(inventory_jobs)
         if complete_job:
-            self._vault_sync_reconcile(vault, complete_job, fix=fix)
+            return complete_job, None, None
         elif has_pending_job(inventory_jobs):
-            if wait:
-                complete_job = wait_until_job_completed(inventory_jobs)
-            else:
-                raise RetryConsoleError('job still pending for inventory on %r' %
-                                        vault.name)
+            return (None, inventory_jobs,
+                    'job still pending for inventory on %r' % vault.name)
         else:
             job_id = vault.retrieve_inventory()
-            job = vault.get_job(job_id)
-            if wait:
-                wait_until_job_completed([job])
-                self._vault_sync_reconcile(vault, job, fix=fix)
+            return (None, [vault.get_job(job_id)],
+                    'queued inventory job for %r' % vault.name)
+
+    def _vault_sync_vaults(self, vaults, max_age_hours, fix, wait,
+                           concurrency=1):
+        """Bring the cache up to date with the inventories of vaults.
+
+        Inventory jobs are looked for (and if necessary queued) for several
+        vaults at once, and completed inventories are downloaded to
+        temporary files at once, but they are all reconciled with the cache
+        from this thread, one after another, so that SQLite only ever has a
+        single writer.
+        """
+        import tempfile
+
+        def find_job(vault):
+            return (vault,) + self._find_vault_inventory_job(vault,
+                                                              max_age_hours)
+
+        complete = []
+        pending = collections.OrderedDict()
+        retry_list = []
+        for vault, complete_job, pending_jobs, message in iter_workers(
+                find_job, vaults, concurrency):
+            if complete_job:
+                complete.append((vault, complete_job))
             else:
-                raise RetryConsoleError('queued inventory job for %r' %
-                        vault.name)
+                pending[vault.name] = (vault, pending_jobs)
+                retry_list.append(message)
+
+        # Inventories already reconciled are not downloaded again
+        if not fix:
+            complete = [(vault, job) for vault, job in complete
+                        if not self._inventory_job_reconciled(vault, job)]
+        if len(complete) == 1:
+            vault, job = complete[0]
+            self._vault_sync_reconcile(vault, job, fix=fix)
+        elif complete:
+            def download(item):
+                vault, job = item
+                spool = tempfile.TemporaryFile()
+                retry(lambda: copy_job_output(job, spool),
+                      description='download of inventory for %r' %
+                      vault.name)
+                spool.seek(0)
+                return vault, job, spool
+
+            for vault, job, spool in iter_workers(download, complete,
+                                                  concurrency):
+                with spool:
+                    self._vault_sync_reconcile(vault, job, fix=fix,
+                                               stream=spool)
+
+        if pending and wait:
+            poller = self.make_job_poller()
+            for vault_name, (vault, pending_jobs) in pending.items():
+                poller.add(vault_name, pending_jobs)
+            for vault_name, job in poller.wait():
+                self._vault_sync_reconcile(pending[vault_name][0], job,
+                                           fix=fix)
+        elif pending:
+            success_list = ['synced vault %r' % vault.name
+                            for vault, job in complete]
+            raise RetryConsoleError('\n'.join(success_list + retry_list))
+
+    def _vault_sync(self, vault_name, max_age_hours, fix, wait):
+        self._vault_sync_vaults([self.connection.get_vault(vault_name)],
+                                max_age_hours=max_age_hours, fix=fix,
+                                wait=wait)
 
     def vault_sync(self):
-        return self._vault_sync(vault_name=self.args.name,
+        if self.args.all == bool(self.args.name):
+            raise ConsoleError('specify either a vault name or --all')
+        if self.args.all:
+            vaults = self.connection.list_vaults()
+        else:
+            vaults = [self.connection.get_vault(self.args.name)]
+        self._vault_sync_vaults(vaults,
                                 max_age_hours=self.args.max_age_hours,
                                 fix=self.args.fix,
-                                wait=self.args.wait)
+                                wait=self.args.wait,
+                                concurrency=self.args.concurrency)
 
     def archive_list(self):
         if self.args.force_ids:
-            archive_list = list(self.cache.get_archive_list_with_ids(
-                self.args.vault))
+            get_archive_list = self.cache_reader.get_archive_list_with_ids
         else:
-            archive_list = list(self.cache.get_archive_list(self.args.vault))
+            get_archive_list = self.cache_reader.get_archive_list
+        for line in get_archive_list(self.args.vault,
+                                     prefix=self.args.prefix,
+                                     glob=self.args.glob):
+            print(line)
 
-        if archive_list:
-            print(*archive_list, sep="\n")
+    def archive_duplicates(self):
+        for id in self.cache_reader.get_duplicate_archive_ids(
+                self.args.vault, by=self.args.by, keep=self.args.keep):
+            print('id:' + id)
 
     def archive_upload(self):
         # XXX: "Leading whitespace in archive descriptions is removed."
@@ -486,6 +2871,11 @@ class App(object):
         #       allowable characters are 7 bit ASCII without control codes,
         #       specifically ASCII values 32-126 decimal or 0x20-0x7E
         #       hexadecimal."
+        if self.args.pack:
+            return self._archive_upload_pack()
+        if not hasattr(self.args.file, 'read'):
+            raise ConsoleError('%r is a directory; use --pack to upload '
+                               'the files in it' % self.args.file)
         if self.args.name is not None:
             name = self.args.name
         else:
@@ -495,38 +2885,239 @@ class App(object):
                 raise RuntimeError('Archive name not specified. Use --name')
             name = os.path.basename(full_name)
 
-        vault = self.connection.get_vault(self.args.vault)
         file_obj = self.args.file
         if 'b' not in file_obj.mode and sys.version_info[0] == 3:
             # Workaround for argparse.FileType not fulfilling requested
             # binary mode for stdin (file '-') in Python 3 (issue #74).
             # Also see https://bugs.python.org/issue14156
             file_obj = file_obj.buffer
-        archive_id = vault.create_archive_from_file(
-            file_obj=file_obj, description=name)
-        self.cache.add_archive(self.args.vault, name, archive_id)
+        total_size = get_file_size(file_obj)
+        vault_name = self.args.vault
+        if total_size == 0:
+            # Checked before an upload is started and recorded for resuming;
+            # MultipartUploader also refuses what turns out to be empty.
+            raise ConsoleError('cannot upload an empty archive')
+
+        # Only uploads from regular files can be resumed, since they can be
+        # identified by path and size.
+        if total_size is None:
+            source = None
+        else:
+            source = os.path.abspath(file_obj.name)
 
-    @staticmethod
-    def _write_archive_retrieval_job(f, job, multipart_size):
-        if job.archive_size > multipart_size:
-            def fetch(start, end):
-                byte_range = start, end-1
-                f.write(job.get_output(byte_range).read())
-
-            whole_parts = job.archive_size // multipart_size
-            for first_byte in xrange(0, whole_parts * multipart_size,
-                                multipart_size):
-                fetch(first_byte, first_byte + multipart_size)
-            remainder = job.archive_size % multipart_size
-            if remainder:
-                fetch(job.archive_size - remainder, job.archive_size)
+        if self.args.skip_existing:
+            if source:
+                local_tree_hash, total_size = hash_file(file_obj)
+                file_obj.seek(0)
+            else:
+                # Keep what is read from a pipe to upload it afterwards
+                import tempfile
+                spool = tempfile.TemporaryFile()
+                local_tree_hash, total_size = hash_file(file_obj,
+                                                        copy_to=spool)
+                spool.seek(0)
+                file_obj = spool
+            for archive_id, archive_name in (
+                    self.cache.get_archives_by_content(
+                        vault_name, local_tree_hash, total_size)):
+                if archive_name == name:
+                    info('archive %r already in vault with the same ' % name +
+                         'contents (id %s); skipping upload' % archive_id)
+                    return
+
+        part_size = choose_part_size(self.args.part_size, total_size)
+        layer1 = self.connection.layer1
+        upload_id = None
+        uploaded_parts = {}
+        if source and not self.args.no_resume:
+            upload = self.cache.get_upload(vault_name, name, source,
+                                           total_size)
+            if upload:
+                from boto.glacier.exceptions import (
+                    UnexpectedHTTPResponseError)
+                upload_id, part_size = upload
+                try:
+                    uploaded_parts = MultipartUploader(
+                        layer1, vault_name, part_size).list_parts(upload_id)
+                except UnexpectedHTTPResponseError as e:
+                    # Glacier removes uploads after 24 hours of inactivity
+                    if e.status != 404:
+                        raise
+                    warn('multipart upload %r has expired; starting again' %
+                         upload_id)
+                    self.cache.delete_upload(vault_name, upload_id)
+                    upload_id = None
+                    part_size = choose_part_size(self.args.part_size,
+                                                 total_size)
+                else:
+                    info('resuming multipart upload %r (%d parts done)' %
+                         (upload_id, len(uploaded_parts)))
+
+        def on_start(upload_id):
+            self.cache.add_upload(vault_name, upload_id, name, source,
+                                  total_size, part_size)
+            # Needed to resume the upload even if this process is killed
+            self.cache.flush_writes()
+
+        uploader = MultipartUploader(
+            layer1, vault_name, part_size=part_size,
+            concurrency=self.args.concurrency,
+            progress=TransferProgress('uploaded', total=total_size,
+                                      enabled=self.args.progress))
+        if source:
+            try:
+                with self.cache.group_commit():
+                    archive_id = uploader.upload(
+                        file_obj, name, upload_id=upload_id,
+                        uploaded_parts=uploaded_parts, on_start=on_start)
+            except ConsoleError:
+                # The upload was aborted, so there is nothing to resume
+                if uploader.upload_id is not None:
+                    self.cache.delete_upload(vault_name, uploader.upload_id)
+                raise
+            self.cache.delete_upload(vault_name, uploader.upload_id)
         else:
+            archive_id = uploader.upload(file_obj, name)
+        self.cache.add_archive(vault_name, name, archive_id,
+                               tree_hash=uploader.tree_hash,
+                               size=uploader.size)
+
+    def _archive_upload_pack(self):
+        """Upload the files in a directory as tar archives of --pack-size.
+
+        Each pack is recorded in the cache together with the offset and size
+        of each file in it, so that single files can be retrieved with
+        "archive retrieve --member".
+        """
+        directory = self.args.file
+        if hasattr(directory, 'read'):
+            raise ConsoleError('--pack needs a directory to upload')
+        if self.args.skip_existing:
+            raise ConsoleError('--skip-existing cannot be used with --pack')
+        vault_name = self.args.vault
+        prefix = (self.args.name or
+                  os.path.basename(os.path.abspath(directory)))
+        timestamp = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+        count = 0
+        for members, size in plan_packs(directory, self.args.pack_size):
+            count += 1
+            name = '%s-%s-%04d.tar' % (prefix, timestamp, count)
+            uploader = MultipartUploader(
+                self.connection.layer1, vault_name,
+                part_size=choose_part_size(self.args.part_size, size),
+                concurrency=self.args.concurrency,
+                progress=TransferProgress('uploaded', total=size,
+                                          enabled=self.args.progress))
+            archive_id = uploader.upload(PackReader(members, size), name)
+            with self.cache.group_commit():
+                self.cache.add_archive(vault_name, name, archive_id,
+                                       tree_hash=uploader.tree_hash,
+                                       size=uploader.size)
+                self.cache.add_pack_members(
+                    vault_name, archive_id,
+                    [(path, offset, member_size)
+                     for path, filename, offset, member_size, mtime, mode
+                     in members])
+        if not count:
+            raise ConsoleError('no files to upload in %r' % directory)
+
+    def upload_list(self):
+        known = dict((upload.id, upload)
+                     for upload in self.cache.get_upload_list(self.args.vault))
+        for upload in list_multipart_uploads(self.connection.layer1,
+                                             self.args.vault):
+            upload_id = upload['MultipartUploadId']
+            source = known[upload_id].source if upload_id in known else ''
+            print(upload['CreationDate'], upload_id,
+                  upload['ArchiveDescription'] or '', source or '', sep='\t')
+
+    def upload_abort(self):
+        if not self.args.upload_ids and self.args.older_than_hours is None:
+            raise ConsoleError('specify upload ids or --older-than')
+        upload_ids = list(self.args.upload_ids)
+        if self.args.older_than_hours is not None:
+            cutoff = time.time() - self.args.older_than_hours * 60 * 60
+            upload_ids.extend(
+                upload['MultipartUploadId']
+                for upload in list_multipart_uploads(self.connection.layer1,
+                                                     self.args.vault)
+                if iso8601_to_unix_timestamp(upload['CreationDate']) < cutoff)
+        for upload_id in upload_ids:
+            self.connection.layer1.abort_multipart_upload(self.args.vault,
+                                                          upload_id)
+            self.cache.delete_upload(self.args.vault, upload_id)
+
+    @staticmethod
+    def _write_archive_retrieval_job(f, job, multipart_size, concurrency=1,
+                                     positional=False, progress=None,
+                                     done_ranges=None, record_range=None,
+                                     start=0, size=None):
+        """Write the output of job to f.
+
+        Only size bytes (by default, the archive size) from start in the
+        job's output are written, at the start of f. If positional is set, f
+        must be a regular file opened for writing at arbitrary offsets.
+        Ranges are then written as they arrive, and record_range(offset,
+        length, tree_hash) is called from this thread after each one is
+        written. Ranges in done_ranges ({offset: (length, tree_hash)}) whose
+        data in f still matches their tree hash are not fetched again.
+        """
+        if progress is None:
+            progress = TransferProgress('downloaded')
+        if size is None:
+            size = job.archive_size
+        output_start = start
+        if size > multipart_size:
+            def fetch(byte_range):
+                start, end = byte_range
+                data, tree_hash = retry(
+                    lambda: fetch_range_with_tree_hash(
+                        job, output_start + start, output_start + end),
+                    description='download of bytes %d-%d' % (
+                        output_start + start, output_start + end - 1))
+                progress.update(len(data))
+                return start, data, tree_hash
+
+            ranges = byte_ranges(size, multipart_size)
+            if positional:
+                # Each range is written at its offset as soon as it arrives,
+                # so that a slow range does not hold up the others.
+                if done_ranges:
+                    ranges = list(ranges)
+                    present = verified_ranges(f, ranges, done_ranges)
+                    ranges = [r for r in ranges if r not in present]
+                    progress.update(
+                        sum(end - start for start, end in present))
+                preallocate(f, size)
+                writer = PositionalWriter(f)
+
+                def fetch_and_write(byte_range):
+                    start, data, tree_hash = fetch(byte_range)
+                    writer.write(start, data)
+                    return start, len(data), tree_hash
+
+                for start, length, tree_hash in iter_workers(
+                        fetch_and_write, ranges, concurrency, ordered=False):
+                    if record_range:
+                        record_range(start, length, tree_hash)
+            else:
+                # Ranges are fetched in parallel but written in order, for
+                # output that cannot seek, such as a pipe.
+                for start, data, tree_hash in iter_workers(
+                        fetch, ranges, concurrency):
+                    f.write(data)
+        elif start == 0 and size == job.archive_size:
             f.write(job.get_output().read())
+        else:
+            data, tree_hash = fetch_range_with_tree_hash(job, start,
+                                                         start + size)
+            f.write(data)
+        progress.finish()
 
         # Make sure that the file now exactly matches the downloaded archive,
         # even if the file existed before and was longer.
         try:
-            f.truncate(job.archive_size)
+            f.truncate(size)
         except OSError as e:
             # Allow ESPIPE, since the "file" couldn't have existed before in
             # this case. Modern Pythons return EINVAL for
@@ -534,49 +3125,323 @@ class App(object):
             if e.errno not in [errno.ESPIPE, errno.EINVAL]:
                 raise
 
-    @classmethod
-    def _archive_retrieve_completed(cls, args, job, name):
-        if args.output_filename == '-':
-            cls._write_archive_retrieval_job(
-                sys.stdout.buffer, job, args.multipart_size)
+    def _retrieval_output(self, args, job, name):
+        """Return (filename, mode, done_ranges) for writing job's output.
+
+        Ranges already written by an interrupted run are recorded against
+        the job and the absolute path of the file they were written to, and
+        are returned as done_ranges if that file is still there.
+        """
+        if args.output_filename:
+            filename = args.output_filename
         else:
-            if args.output_filename:
-                filename = args.output_filename
-            else:
-                filename = os.path.basename(name)
-            with open(filename, 'wb') as f:
-                cls._write_archive_retrieval_job(f, job, args.multipart_size)
+            filename = os.path.basename(name)
+        done_ranges = self.cache.get_retrieved_ranges(
+            args.vault, job.id, os.path.abspath(filename))
+        if done_ranges and os.path.exists(filename):
+            return filename, 'r+b', done_ranges
+        return filename, 'wb', {}
+
+    def _write_archive_retrieval_file(self, args, job, filename, mode,
+                                      done_ranges, record_range, start=0,
+                                      size=None):
+        if size is None:
+            size = job.archive_size
+        progress = TransferProgress('downloaded', total=size,
+                                    enabled=args.progress)
+        with open(filename, mode) as f:
+            self._write_archive_retrieval_job(
+                f, job, args.multipart_size,
+                concurrency=args.concurrency, positional=True,
+                progress=progress, done_ranges=done_ranges,
+                record_range=record_range, start=start, size=size)
+
+    def _archive_retrieve_completed(self, args, job, name, part=None):
+        """Write the output of a completed retrieval job.
+
+        If part is given, only bytes part[0] to part[1]-1 of the archive are
+        downloaded and written, from a job that covers them.
+        """
+        if part is None:
+            start, size = 0, job.archive_size
+        else:
+            job_range = self.job_ranges.get(job.id)
+            start = part[0] - (job_range[0] if job_range else 0)
+            size = part[1] - part[0]
+        if args.output_filename == '-':
+            progress = TransferProgress('downloaded', total=size,
+                                        enabled=args.progress)
+            self._write_archive_retrieval_job(
+                sys.stdout.buffer, job, args.multipart_size,
+                concurrency=args.concurrency, progress=progress,
+                start=start, size=size)
+            return
 
-    def archive_retrieve_one(self, name):
+        filename, mode, done_ranges = self._retrieval_output(args, job, name)
+        checkpoint_filename = os.path.abspath(filename)
+
+        def record_range(offset, length, tree_hash):
+            self.cache.add_retrieved_range(
+                args.vault, job.id, checkpoint_filename, offset, length,
+                tree_hash)
+
+        with self.cache.group_commit():
+            self._write_archive_retrieval_file(args, job, filename, mode,
+                                               done_ranges, record_range,
+                                               start=start, size=size)
+        self.cache.delete_retrieved_ranges(
+            args.vault, job.id, checkpoint_filename)
+
+    def make_job_notifications(self):
+        queue_name = getattr(self.args, 'sqs_queue', None)
+        if queue_name:
+            return SQSJobNotifications(queue_name, self.args.region)
+        return None
+
+    def make_job_poller(self):
+        return JobPoller(self.make_job_notifications(),
+                         tiers=self.job_tiers)
+
+    def get_vault(self, name):
+        if name not in self._vaults:
+            self._vaults[name] = self.connection.get_vault(name)
+        return self._vaults[name]
+
+    @property
+    def job_ranges(self):
+        """{job_id: (start, end)} of partial retrieval jobs; see JobIndex"""
+        return track_job_ranges(self.connection.layer1)
+
+    @property
+    def job_tiers(self):
+        """{job_id: tier} of the jobs seen; see JobPoller"""
+        return track_job_tiers(self.connection.layer1)
+
+    def get_job_index(self, vault):
+        """Return the JobIndex for vault, listing its jobs only once.
+
+        If --job-cache-ttl is given, a listing stored in the cache by a
+        previous invocation within that many seconds is used instead of
+        listing the jobs again.
+        """
+        if vault.name in self._job_indexes:
+            return self._job_indexes[vault.name]
+        ttl = getattr(self.args, 'job_cache_ttl', 0)
+        jobs_data = None
+        if ttl:
+            jobs_data = self.cache.get_job_listing(vault.name, ttl)
+        if jobs_data is None:
+            # Start recording job ranges and tiers before the listing
+            job_ranges = self.job_ranges
+            jobs = list_vault_jobs(vault)
+            job_index = JobIndex(jobs, job_ranges)
+            self._job_indexes[vault.name] = job_index
+            self._save_job_index(vault, job_index)
+        else:
+            import boto.glacier.job
+            record_job_ranges(self.job_ranges, {'JobList': jobs_data})
+            record_job_tiers(self.job_tiers, {'JobList': jobs_data})
+            job_index = JobIndex((boto.glacier.job.Job(vault, job_data)
+                                  for job_data in jobs_data),
+                                 self.job_ranges)
+            self._job_indexes[vault.name] = job_index
+        return job_index
+
+    def _save_job_index(self, vault, job_index):
+        if getattr(self.args, 'job_cache_ttl', 0):
+            self.cache.set_job_listing(
+                vault.name,
+                [job_to_response_data(job, self.job_ranges.get(job.id),
+                                      self.job_tiers.get(job.id))
+                 for job in job_index.jobs])
+
+    def _retrieval_target(self, name):
+        """Return (archive_id, part, byte_range) to retrieve name.
+
+        part is the bytes of the archive to write out, or None for all of
+        it, and byte_range the range for a retrieval job: the --range given,
+        or for a pack member, the range Glacier can retrieve around it.
+        """
+        vault_name = self.args.vault
+        if self.args.member:
+            try:
+                archive_id, offset, size, archive_size = (
+                    self.cache.get_pack_member(vault_name, name))
+            except KeyError:
+                raise ConsoleError('pack member %r not found' % name)
+            part = offset, offset + size
+            if archive_size is None:
+                return archive_id, part, None
+            return (archive_id, part,
+                    aligned_byte_range(offset, offset + size, archive_size))
         try:
-            archive_id = self.cache.get_archive_id(self.args.vault, name)
+            archive_id = self.cache.get_archive_id(vault_name, name)
         except KeyError:
             raise ConsoleError('archive %r not found' % name)
+        if self.args.byte_range is None:
+            return archive_id, None, None
+        check_byte_range(self.args.byte_range,
+                         self.cache.get_archive_size(vault_name, name))
+        return archive_id, self.args.byte_range, self.args.byte_range
 
-        vault = self.connection.get_vault(self.args.vault)
-        retrieval_jobs = find_retrieval_jobs(vault, archive_id)
+    def archive_retrieve_one(self, name):
+        archive_id, part, byte_range = self._retrieval_target(name)
+        if part is not None and part[0] == part[1]:
+            # An empty pack member; there is nothing to retrieve
+            if self.args.output_filename != '-':
+                open(self.args.output_filename or os.path.basename(name),
+                     'wb').close()
+            return
+
+        vault = self.get_vault(self.args.vault)
+        job_index = self.get_job_index(vault)
+        retrieval_jobs = find_retrieval_jobs(vault, archive_id, job_index,
+                                             byte_range)
 
         complete_job = find_complete_job(retrieval_jobs)
         if complete_job:
-            self._archive_retrieve_completed(self.args, complete_job, name)
+            self._archive_retrieve_completed(self.args, complete_job, name,
+                                             part)
         elif has_pending_job(retrieval_jobs):
             if self.args.wait:
-                complete_job = wait_until_job_completed(retrieval_jobs)
-                self._archive_retrieve_completed(self.args, complete_job, name)
+                complete_job = wait_until_job_completed(
+                    retrieval_jobs, self.make_job_notifications(),
+                    self.job_tiers)
+                self._archive_retrieve_completed(self.args, complete_job,
+                                                 name, part)
             else:
                 raise RetryConsoleError('job still pending for archive %r' % name)
         else:
             # create an archive retrieval job
-            job = vault.retrieve_archive(archive_id)
+            job = initiate_archive_retrieval(vault, archive_id, byte_range,
+                                             self.args.tier)
+            job_index.add(job)
+            self._save_job_index(vault, job_index)
             if self.args.wait:
-                wait_until_job_completed([job])
-                self._archive_retrieve_completed(self.args, job, name)
+                complete_job = wait_until_job_completed(
+                    [job], self.make_job_notifications(), self.job_tiers)
+                self._archive_retrieve_completed(self.args, complete_job,
+                                                 name, part)
             else:
                 raise RetryConsoleError('queued retrieval job for archive %r' % name)
 
+    def _archive_retrieve_pipeline(self, names):
+        """Retrieve names, waiting for their jobs to complete.
+
+        Jobs are queued for all of the archives up front and then polled
+        together, and each archive is downloaded as soon as its job
+        completes, up to --parallel-archives at a time. The cache is only
+        used from this thread: download threads pass the ranges they have
+        written back here to be recorded.
+        """
+        from multiprocessing.pool import ThreadPool
+
+        args = self.args
+        vault = self.get_vault(args.vault)
+        job_index = self.get_job_index(vault)
+        ready = collections.deque()
+        waiting = collections.OrderedDict()
+        queued = False
+        for name in names:
+            try:
+                archive_id = self.cache.get_archive_id(args.vault, name)
+            except KeyError:
+                raise ConsoleError('archive %r not found' % name)
+            retrieval_jobs = find_retrieval_jobs(vault, archive_id,
+                                                 job_index)
+            complete_job = find_complete_job(retrieval_jobs)
+            if complete_job:
+                ready.append((name, complete_job))
+            elif has_pending_job(retrieval_jobs):
+                waiting[name] = retrieval_jobs
+            else:
+                job = initiate_archive_retrieval(vault, archive_id,
+                                                 tier=args.tier)
+                job_index.add(job)
+                waiting[name] = [job]
+                queued = True
+        if queued:
+            self._save_job_index(vault, job_index)
+        poller = self.make_job_poller()
+        for name, retrieval_jobs in waiting.items():
+            poller.add(name, retrieval_jobs)
+
+        events = queue.Queue()
+        pool = ThreadPool(args.parallel_archives)
+        active = 0
+        errors = []
+        try:
+            while active or ((ready or poller) and not errors):
+                while ready and active < args.parallel_archives and \
+                        not errors:
+                    name, job = ready.popleft()
+                    filename, mode, done_ranges = self._retrieval_output(
+                        args, job, name)
+
+                    def download(name=name, job=job, filename=filename,
+                                 mode=mode, done_ranges=done_ranges):
+                        def record_range(offset, length, tree_hash):
+                            events.put(('range', name, job, filename,
+                                        (offset, length, tree_hash)))
+
+                        try:
+                            self._write_archive_retrieval_file(
+                                args, job, filename, mode, done_ranges,
+                                record_range)
+                        except Exception as e:
+                            events.put(('failed', name, job, filename, e))
+                        else:
+                            events.put(('done', name, job, filename, None))
+
+                    pool.apply_async(download)
+                    active += 1
+
+                if poller and not errors:
+                    timeout = max(0, poller.next_check_time() - time.time())
+                elif active:
+                    timeout = None
+                else:
+                    break
+                try:
+                    if timeout is None:
+                        event = events.get()
+                    else:
+                        event = events.get(timeout=timeout)
+                except queue.Empty:
+                    ready.extend(poller.check())
+                    continue
+
+                kind, name, job, filename, value = event
+                checkpoint_filename = os.path.abspath(filename)
+                if kind == 'range':
+                    offset, length, tree_hash = value
+                    self.cache.add_retrieved_range(
+                        args.vault, job.id, checkpoint_filename, offset,
+                        length, tree_hash)
+                    continue
+                active -= 1
+                if kind == 'done':
+                    self.cache.delete_retrieved_ranges(
+                        args.vault, job.id, checkpoint_filename)
+                else:
+                    errors.append(value)
+        finally:
+            pool.close()
+            pool.join()
+        if errors:
+            raise errors[0]
+
     def archive_retrieve(self):
         if len(self.args.names) > 1 and self.args.output_filename:
             raise ConsoleError('cannot specify output filename with multi-archive retrieval')
+        if len(self.args.names) > 1 and self.args.byte_range:
+            raise ConsoleError('cannot specify --range with multi-archive '
+                               'retrieval')
+        if self.args.member and self.args.byte_range:
+            raise ConsoleError('cannot specify --range with --member')
+        if len(self.args.names) > 1 and self.args.wait and \
+                not self.args.member:
+            return self._archive_retrieve_pipeline(self.args.names)
         success_list = []
         retry_list = []
         for name in self.args.names:
@@ -590,29 +3455,62 @@ class App(object):
             message_list = success_list + retry_list
             raise RetryConsoleError("\n".join(message_list))
 
-    def archive_delete(self):
-        try:
-            archive_id = self.cache.get_archive_id(
-                self.args.vault, self.args.name)
-        except KeyError:
-            raise ConsoleError('archive %r not found' % self.args.name)
-        vault = self.connection.get_vault(self.args.vault)
-        vault.delete_archive(archive_id)
-        self.cache.delete_archive(self.args.vault, self.args.name)
+    def _archive_delete_refs(self):
+        refs = list(self.args.names)
+        if self.args.from_file == '-':
+            refs.extend(line.strip() for line in sys.stdin)
+        elif self.args.from_file:
+            with open(self.args.from_file) as f:
+                refs.extend(line.strip() for line in f)
+        refs = [ref for ref in refs if ref]
+        if self.args.ids:
+            refs = [ref if ref.startswith('id:') else 'id:' + ref
+                    for ref in refs]
+        return refs
 
-    def archive_checkpresent(self):
-        try:
-            last_seen = self.cache.get_archive_last_seen(
-                self.args.vault, self.args.name)
-        except KeyError:
-            if self.args.wait:
-                last_seen = None
-            else:
-                if not self.args.quiet:
-                    print(
-                        'archive %r not found' % self.args.name,
-                        file=sys.stderr)
-                return
+    def archive_delete(self):
+        """Delete the archives given as arguments and in --from-file.
+
+        The refs are resolved in one batch of cache queries before anything
+        is deleted, so an ambiguous name deletes nothing. Deletions are then
+        requested --concurrency at a time, each retried a few times, and
+        recorded in the cache in groups as they complete. Refs that are not
+        in the cache are reported at the end.
+        """
+        vault_name = self.args.vault
+        refs = self._archive_delete_refs()
+        if not refs:
+            raise ConsoleError('archive name not specified')
+        ids = self.cache.get_archive_ids_many(vault_name, refs)
+        not_found = [ref for ref in refs if ref not in ids]
+        archive_ids = collections.OrderedDict.fromkeys(
+            ids[ref] for ref in refs if ref in ids)
+        if archive_ids:
+            vault = self.connection.get_vault(vault_name)
+
+            def delete(archive_id):
+                retry(lambda: vault.delete_archive(archive_id),
+                      tries=DELETE_TRIES,
+                      description='deleting archive %s' % archive_id)
+                return archive_id
+
+            with self.cache.group_commit():
+                for archive_id in iter_workers(delete, archive_ids,
+                                               self.args.concurrency,
+                                               ordered=False):
+                    self.cache.delete_archive_by_id(vault_name, archive_id)
+        if not_found:
+            raise ConsoleError('\n'.join('archive %r not found' % ref
+                                         for ref in not_found))
+
+    def _checkpresent(self, refs, sync_state):
+        """Yield (ref, present, message) for each of refs.
+
+        The refs are looked up together. If any of them needs a vault sync
+        to be answered, one is attempted unless sync_state['attempted'] is
+        already set, so that a stream of batches causes at most one sync.
+        """
+        vault = self.args.vault
 
         def too_old(last_seen):
             return (not last_seen or
@@ -620,39 +3518,85 @@ class App(object):
                     (last_seen <
                         time.time() - self.args.max_age_hours * 60 * 60))
 
-        if too_old(last_seen):
-            # Not recent enough
-            try:
-                self._vault_sync(vault_name=self.args.vault,
-                                 max_age_hours=self.args.max_age_hours,
-                                 fix=False,
-                                 wait=self.args.wait)
-            except RetryConsoleError:
-                pass
+        last_seen = self.cache_reader.get_archive_last_seen_many(vault, refs)
+        results = {}
+        stale_refs = []
+        for ref in refs:
+            if ref not in last_seen and not self.args.wait:
+                results[ref] = (False, 'archive %r not found' % ref)
+            elif too_old(last_seen.get(ref)):
+                stale_refs.append(ref)
             else:
-                try:
-                    last_seen = self.cache.get_archive_last_seen(
-                        self.args.vault, self.args.name)
-                except KeyError:
-                    if not self.args.quiet:
-                        print(('archive %r not found, but it may ' +
-                                           'not be in the inventory yet')
-                                           % self.args.name, file=sys.stderr)
-                    return
+                results[ref] = (True, None)
 
-        if too_old(last_seen):
-            if not self.args.quiet:
-                print(('archive %r found, but has not been seen ' +
-                                   'recently enough to consider it present') %
-                                   self.args.name, file=sys.stderr)
-            return
+        if stale_refs:
+            # Not recent enough
+            if not sync_state.get('attempted'):
+                sync_state['attempted'] = True
+                try:
+                    self._vault_sync(vault_name=vault,
+                                     max_age_hours=self.args.max_age_hours,
+                                     fix=False,
+                                     wait=self.args.wait)
+                except RetryConsoleError:
+                    pass
+                else:
+                    sync_state['synced'] = True
+            if sync_state.get('synced'):
+                last_seen = self.cache.get_archive_last_seen_many(
+                    vault, stale_refs)
+            for ref in stale_refs:
+                if sync_state.get('synced') and ref not in last_seen:
+                    results[ref] = (False, ('archive %r not found, but it ' +
+                                            'may not be in the inventory yet')
+                                           % ref)
+                elif too_old(last_seen.get(ref)):
+                    results[ref] = (False, ('archive %r found, but has not ' +
+                                            'been seen recently enough to ' +
+                                            'consider it present') % ref)
+                else:
+                    results[ref] = (True, None)
 
-        print(self.args.name)
+        for ref in refs:
+            present, message = results[ref]
+            yield ref, present, message
 
+    def archive_checkpresent(self):
+        if self.args.batch:
+            return self._archive_checkpresent_batch()
+        if self.args.name is None:
+            raise ConsoleError('archive name not specified')
+        for ref, present, message in self._checkpresent(
+                [self.args.name], sync_state={}):
+            if present:
+                print(ref)
+            elif not self.args.quiet:
+                print(message, file=sys.stderr)
+
+    def _archive_checkpresent_batch(self):
+        """Check the archives named on stdin, one per line.
+
+        Each answer is written as a line of the form "present<TAB>name" or
+        "absent<TAB>name", in input order, as soon as each batch of input is
+        answered.
+        """
+        sync_state = {}
+        for refs in iter_line_batches(sys.stdin, CHECKPRESENT_BATCH_SIZE):
+            refs = [ref for ref in refs if ref]
+            for ref, present, message in self._checkpresent(refs,
+                                                            sync_state):
+                if message and not self.args.quiet:
+                    print(message, file=sys.stderr)
+                print('present' if present else 'absent', ref, sep='\t')
+            sys.stdout.flush()
 
     def parse_args(self, args=None):
         parser = argparse.ArgumentParser()
         parser.add_argument('--region', default='us-east-1')
+        parser.add_argument('--no-daemon', action='store_true')
+        parser.add_argument('--stats', action='store_true')
+        parser.add_argument('--trace', dest='trace_filename',
+                            metavar='FILE')
         subparsers = parser.add_subparsers()
         vault_subparser = subparsers.add_parser('vault').add_subparsers()
         vault_subparser.add_parser('list').set_defaults(func=self.vault_list)
@@ -661,22 +3605,44 @@ class App(object):
         vault_create_subparser.add_argument('name')
         vault_sync_subparser = vault_subparser.add_parser('sync')
         vault_sync_subparser.set_defaults(func=self.vault_sync)
-        vault_sync_subparser.add_argument('name', metavar='vault_name')
+        vault_sync_subparser.add_argument('name', metavar='vault_name',
+                                          nargs='?')
+        vault_sync_subparser.add_argument('--all', action='store_true')
+        vault_sync_subparser.add_argument(
+                '-j', '--concurrency', type=int,
+                default=DEFAULT_VAULT_CONCURRENCY)
         vault_sync_subparser.add_argument('--wait', action='store_true')
         vault_sync_subparser.add_argument('--fix', action='store_true')
         vault_sync_subparser.add_argument('--max-age', type=int, default=24,
                                           dest='max_age_hours')
+        vault_sync_subparser.add_argument('--sqs-queue')
         archive_subparser = subparsers.add_parser('archive').add_subparsers()
         archive_list_subparser = archive_subparser.add_parser('list')
         archive_list_subparser.set_defaults(func=self.archive_list)
         archive_list_subparser.add_argument('--force-ids', action='store_true')
+        archive_list_filter = (
+                archive_list_subparser.add_mutually_exclusive_group())
+        archive_list_filter.add_argument('--prefix')
+        archive_list_filter.add_argument('--glob')
         archive_list_subparser.add_argument('vault')
         archive_upload_subparser = archive_subparser.add_parser('upload')
         archive_upload_subparser.set_defaults(func=self.archive_upload)
         archive_upload_subparser.add_argument('vault')
-        archive_upload_subparser.add_argument('file',
-                                              type=argparse.FileType('rb'))
+        archive_upload_subparser.add_argument('file', type=upload_source)
         archive_upload_subparser.add_argument('--name')
+        archive_upload_subparser.add_argument('--part-size', type=int,
+                                              default=DEFAULT_PART_SIZE)
+        archive_upload_subparser.add_argument(
+                '-j', '--concurrency', type=int, default=DEFAULT_CONCURRENCY)
+        archive_upload_subparser.add_argument('--progress',
+                                              action='store_true')
+        archive_upload_subparser.add_argument('--no-resume',
+                                              action='store_true')
+        archive_upload_subparser.add_argument('--skip-existing',
+                                              action='store_true')
+        archive_upload_subparser.add_argument('--pack', action='store_true')
+        archive_upload_subparser.add_argument('--pack-size', type=int,
+                                              default=DEFAULT_PACK_SIZE)
         archive_retrieve_subparser = archive_subparser.add_parser('retrieve')
         archive_retrieve_subparser.set_defaults(func=self.archive_retrieve)
         archive_retrieve_subparser.add_argument('vault')
@@ -687,38 +3653,159 @@ class App(object):
         archive_retrieve_subparser.add_argument('-o', dest='output_filename',
                                                 metavar='OUTPUT_FILENAME')
         archive_retrieve_subparser.add_argument('--wait', action='store_true')
+        archive_retrieve_subparser.add_argument(
+                '-j', '--concurrency', type=int, default=DEFAULT_CONCURRENCY)
+        archive_retrieve_subparser.add_argument('--progress',
+                                                action='store_true')
+        archive_retrieve_subparser.add_argument('--job-cache-ttl', type=int,
+                                                default=0, metavar='SECONDS')
+        archive_retrieve_subparser.add_argument(
+                '--parallel-archives', type=int,
+                default=DEFAULT_PARALLEL_ARCHIVES)
+        archive_retrieve_subparser.add_argument('--sqs-queue')
+        archive_retrieve_subparser.add_argument('--member',
+                                                action='store_true')
+        archive_retrieve_subparser.add_argument(
+                '--range', dest='byte_range', type=parse_byte_range,
+                metavar='START-END')
+        archive_retrieve_subparser.add_argument(
+                '--tier', choices=sorted(JOB_TIER_DURATIONS))
         archive_delete_subparser = archive_subparser.add_parser('delete')
         archive_delete_subparser.set_defaults(func=self.archive_delete)
         archive_delete_subparser.add_argument('vault')
-        archive_delete_subparser.add_argument('name')
+        archive_delete_subparser.add_argument('names', nargs='*',
+                                              metavar='name')
+        archive_delete_subparser.add_argument('--from-file', metavar='FILE')
+        archive_delete_subparser.add_argument('--ids', action='store_true')
+        archive_delete_subparser.add_argument(
+                '-j', '--concurrency', type=int, default=DEFAULT_CONCURRENCY)
+        archive_duplicates_subparser = archive_subparser.add_parser(
+                'duplicates')
+        archive_duplicates_subparser.set_defaults(
+                func=self.archive_duplicates)
+        archive_duplicates_subparser.add_argument('vault')
+        archive_duplicates_subparser.add_argument(
+                '--by', choices=['name', 'content'], default='name')
+        archive_duplicates_subparser.add_argument(
+                '--keep', choices=['oldest', 'newest'], default='oldest')
         archive_checkpresent_subparser = archive_subparser.add_parser(
                 'checkpresent')
         archive_checkpresent_subparser.set_defaults(
                 func=self.archive_checkpresent)
         archive_checkpresent_subparser.add_argument('vault')
-        archive_checkpresent_subparser.add_argument('name')
+        archive_checkpresent_subparser.add_argument('name', nargs='?')
+        archive_checkpresent_subparser.add_argument('--batch',
+                                                    action='store_true')
         archive_checkpresent_subparser.add_argument('--wait',
                                                     action='store_true')
         archive_checkpresent_subparser.add_argument('--quiet',
                                                     action='store_true')
         archive_checkpresent_subparser.add_argument(
                 '--max-age', type=int, default=80, dest='max_age_hours')
+        upload_subparser = subparsers.add_parser('upload').add_subparsers()
+        upload_list_subparser = upload_subparser.add_parser('list')
+        upload_list_subparser.set_defaults(func=self.upload_list)
+        upload_list_subparser.add_argument('vault')
+        upload_abort_subparser = upload_subparser.add_parser('abort')
+        upload_abort_subparser.set_defaults(func=self.upload_abort)
+        upload_abort_subparser.add_argument('vault')
+        upload_abort_subparser.add_argument('upload_ids', nargs='*',
+                                            metavar='upload_id')
+        upload_abort_subparser.add_argument('--older-than', type=int,
+                                            dest='older_than_hours')
         job_subparser = subparsers.add_parser('job').add_subparsers()
-        job_subparser.add_parser('list').set_defaults(func=self.job_list)
+        job_list_subparser = job_subparser.add_parser('list')
+        job_list_subparser.set_defaults(func=self.job_list)
+        job_list_subparser.add_argument(
+                '-j', '--concurrency', type=int,
+                default=DEFAULT_VAULT_CONCURRENCY)
+        daemon_subparser = subparsers.add_parser('daemon')
+        daemon_subparser.set_defaults(func=self.daemon)
+        daemon_subparser.add_argument('--socket', dest='socket_path')
         return parser.parse_args(args)
 
     def __init__(self, args=None, connection=None, cache=None):
-        args = self.parse_args(args)
-
-        if connection is None:
-            connection = boto.glacier.connect_to_region(args.region)
-
-        if cache is None:
-            cache = Cache(get_connection_account(connection))
-
-        self.connection = connection
-        self.cache = cache
-        self.args = args
+        self.args = self.parse_args(args)
+        # The connection and cache are created on first use, so that
+        # commands answered from the cache alone never import boto or
+        # SQLAlchemy.
+        self._connection = connection
+        self._cache = cache
+        self._cache_reader = None
+        self._vaults = {}
+        self._job_indexes = {}
+        self.stats = NULL_STATS
+        if self.args.stats or self.args.trace_filename:
+            self.stats = Stats(
+                trace_file=(open(self.args.trace_filename, 'w')
+                            if self.args.trace_filename else None),
+                summary=self.args.stats)
+            if connection is not None:
+                self.stats.instrument_connection(connection)
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            with self.stats.phase('connect'):
+                import boto.glacier
+                self._connection = boto.glacier.connect_to_region(
+                    self.args.region)
+            if self.stats.enabled:
+                self.stats.instrument_connection(self._connection)
+        return self._connection
+
+    @property
+    def account_key(self):
+        # boto takes credentials from the environment in preference to its
+        # configuration files, so this gives the same key as the connection
+        # would without having to import boto.
+        key = os.getenv('AWS_ACCESS_KEY_ID')
+        if key is None:
+            key = get_connection_account(self.connection)
+        return key
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            with self.stats.phase('open_cache'):
+                self._cache = Cache(self.account_key, stats=self.stats)
+        return self._cache
+
+    @property
+    def cache_reader(self):
+        """Return an object for archive lookups only.
+
+        This is a CacheReader if possible, to avoid the cost of importing
+        SQLAlchemy, or the full cache if it is already open or the database
+        needs creating or upgrading first.
+        """
+        if self._cache is not None:
+            return self._cache
+        if self._cache_reader is None:
+            self._cache_reader = CacheReader.open(self.account_key,
+                                                  stats=self.stats)
+            if self._cache_reader is None:
+                return self.cache
+        return self._cache_reader
+
+    def daemon(self):
+        socket_path = self.args.socket_path or get_default_socket_path()
+        Daemon(self, socket_path).serve_forever()
+
+    def can_run_in_daemon(self):
+        """Return True if the command may be handed to a running daemon.
+
+        Only commands that take no local files or stdin and do not wait for
+        jobs qualify, since the daemon serves one request at a time from
+        its own working directory. Statistics are only collected in this
+        process, so --stats and --trace also rule the daemon out.
+        """
+        return (not self.args.no_daemon and
+                not self.stats.enabled and
+                self.args.func.__name__ in DAEMON_COMMANDS and
+                not getattr(self.args, 'wait', False) and
+                not getattr(self.args, 'batch', False) and
+                not getattr(self.args, 'from_file', None))
 
     def main(self):
         try:
@@ -733,10 +3820,22 @@ class App(object):
             message = insert_prefix_to_lines(PROGRAM_NAME + ': ', e.message)
             print(message, file=sys.stderr)
             sys.exit(1)
+        finally:
+            self.stats.close()
 
 
 def main():
-    App().main()
+    app = App()
+    if app.can_run_in_daemon():
+        try:
+            status = run_via_daemon(sys.argv[1:])
+        except ConsoleError as e:
+            print(insert_prefix_to_lines(PROGRAM_NAME + ': ', e.message),
+                  file=sys.stderr)
+            sys.exit(1)
+        if status is not None:
+            sys.exit(status)
+    app.main()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+
+"""Benchmarks for glacier-cli.
+
+Each benchmark prints one JSON object per line on stdout, so that results
+can be collected and compared between revisions. Benchmarks that need
+Glacier run App in this process against a local FakeGlacier service (see
+glacier_fake.py), with --latency added to every request.
+
+    python glacier_bench.py [--repeat N] [--latency MS] [benchmark...]
+"""
+
+from __future__ import print_function
+
+import argparse
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    # On Python 2 glacier prints both str and unicode, which only
+    # StringIO.StringIO accepts
+    from StringIO import StringIO as OutputBuffer
+except ImportError:
+    from io import StringIO as OutputBuffer
+
+import glacier
+import glacier_fake
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BENCH_ACCOUNT_KEY = 'bench'
+
+
+def report(benchmark, **results):
+    results['benchmark'] = benchmark
+    print(json.dumps(results, sort_keys=True))
+    sys.stdout.flush()
+
+
+def time_command(argv, repeat, env=None):
+    """Run argv repeat times and return the wall times in milliseconds"""
+    times = []
+    with open(os.devnull, 'wb') as devnull:
+        for _ in range(repeat):
+            start = time.time()
+            subprocess.check_call(argv, stdout=devnull, env=env, cwd=HERE)
+            times.append((time.time() - start) * 1000)
+    return times
+
+
+def summarise(times):
+    times = sorted(times)
+    return {
+        'min_ms': round(times[0], 2),
+        'median_ms': round(times[len(times) // 2], 2),
+        'runs': len(times),
+    }
+
+
+class BenchEnvironment(object):
+    """A temporary cache directory populated with archives"""
+    def __init__(self, archive_count=1000, vault='bench_vault'):
+        self.tmpdir = tempfile.mkdtemp(prefix='glacier-bench.')
+        self.vault = vault
+        self.env = dict(os.environ)
+        self.env['XDG_CACHE_HOME'] = self.tmpdir
+        self.env['AWS_ACCESS_KEY_ID'] = BENCH_ACCOUNT_KEY
+        self.db_path = os.path.join(self.tmpdir, 'glacier-cli', 'db')
+        cache = glacier.Cache(BENCH_ACCOUNT_KEY, db_path=self.db_path)
+        for i in range(archive_count):
+            cache.session.add(cache.Archive(
+                key=BENCH_ACCOUNT_KEY, vault=vault,
+                name='archive-%d' % i, id='id-%d' % i))
+        cache.session.commit()
+        cache.session.close()
+
+    def close(self):
+        shutil.rmtree(self.tmpdir)
+
+
+def bench_startup(args):
+    """Process startup: module import and a cache-only command"""
+    python = sys.executable
+    report('startup.import_glacier', **summarise(time_command(
+        [python, '-c', 'import glacier'], args.repeat)))
+    # What every invocation used to pay for before imports were made lazy
+    report('startup.import_dependencies', **summarise(time_command(
+        [python, '-c', 'import sqlalchemy.orm, boto.glacier, iso8601'],
+        args.repeat)))
+    bench_env = BenchEnvironment()
+    try:
+        report('startup.checkpresent', **summarise(time_command(
+            [python, 'glacier.py', 'archive', 'checkpresent',
+             bench_env.vault, 'archive-1'],
+            args.repeat, env=bench_env.env)))
+        report('startup.archive_list', **summarise(time_command(
+            [python, 'glacier.py', 'archive', 'list', bench_env.vault],
+            args.repeat, env=bench_env.env)))
+    finally:
+        bench_env.close()
+
+
+class FakeService(object):
+    """A FakeGlacier service to run App against in this process.
+
+    Each call to run() uses a new App, so that per-invocation costs such as
+    opening the cache are measured too, but by default they all share one
+    cache database.
+    """
+    def __init__(self, latency_ms, job_delay=0):
+        self.fake = glacier_fake.FakeGlacier(latency=latency_ms / 1000.0,
+                                             job_delay=job_delay).start()
+        self.connection = self.fake.connect(BENCH_ACCOUNT_KEY)
+        self.tmpdir = tempfile.mkdtemp(prefix='glacier-bench.')
+        self.db_count = 0
+        self.db_path = self.new_db_path()
+
+    def new_db_path(self):
+        """Return the path of a cache database that does not exist yet"""
+        self.db_count += 1
+        return os.path.join(self.tmpdir, 'db.%d' % self.db_count)
+
+    def path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def run(self, argv, db_path=None, stdin=u'', exit_codes=(0,)):
+        """Run glacier with argv and return its wall time in milliseconds.
+
+        Output is discarded. A SystemExit with a code outside exit_codes
+        (as for a retryable error when a job is queued) is an error.
+        """
+        saved = sys.stdin, sys.stdout, sys.stderr
+        start = time.time()
+        sys.stdin = io.StringIO(stdin)
+        sys.stdout = sys.stderr = OutputBuffer()
+        app = None
+        try:
+            app = glacier.App(argv, connection=self.connection,
+                              cache=glacier.Cache(
+                                  BENCH_ACCOUNT_KEY,
+                                  db_path=db_path or self.db_path))
+            try:
+                app.main()
+                code = 0
+            except SystemExit as e:
+                code = e.code
+        finally:
+            sys.stdin, sys.stdout, sys.stderr = saved
+            if app is not None:
+                app.cache.session.close()
+                app.cache.connection.close()
+                app.cache.engine.dispose()
+        if code not in exit_codes:
+            raise RuntimeError('%r exited with %r' % (argv, code))
+        return (time.time() - start) * 1000
+
+    def requests(self):
+        """Return and reset the number of requests made to the service"""
+        count = sum(self.fake.requests.values())
+        self.fake.reset_counters()
+        return count
+
+    def close(self):
+        self.fake.stop()
+        shutil.rmtree(self.tmpdir)
+
+
+def throughput(size, times):
+    """Return MB/s for transferring size bytes in the median of times"""
+    median_s = sorted(times)[len(times) // 2] / 1000
+    return round(size / float(glacier.MEGABYTE) / median_s, 2)
+
+
+def bench_upload(args):
+    """Upload throughput of a multipart upload"""
+    size = args.transfer_size * glacier.MEGABYTE
+    service = FakeService(args.latency)
+    try:
+        with open(service.path('data'), 'wb') as f:
+            f.write(os.urandom(size))
+        service.run(['vault', 'create', 'bench_vault'])
+        times = []
+        for _ in range(args.repeat):
+            times.append(service.run(
+                ['archive', 'upload', '--no-resume', 'bench_vault',
+                 service.path('data')]))
+            # Keep only one copy of the data in memory
+            service.fake.vaults['bench_vault'].archives.clear()
+        report('upload', size_mb=args.transfer_size,
+               latency_ms=args.latency, mb_per_s=throughput(size, times),
+               requests=service.requests() // len(times), **summarise(times))
+    finally:
+        service.close()
+
+
+def bench_download(args):
+    """Download throughput of a completed archive retrieval job"""
+    size = args.transfer_size * glacier.MEGABYTE
+    service = FakeService(args.latency)
+    try:
+        service.fake.add_archive('bench_vault', 'data', os.urandom(size))
+        service.run(['vault', 'sync', 'bench_vault'], exit_codes=(75,))
+        service.run(['vault', 'sync', 'bench_vault'])
+        argv = ['archive', 'retrieve', '-o', service.path('data'),
+                'bench_vault', 'data']
+        # Queue the job; it completes at once
+        service.run(argv, exit_codes=(75,))
+        service.requests()
+        times = []
+        for _ in range(args.repeat):
+            times.append(service.run(argv))
+            # Otherwise the next run would find the ranges already there
+            os.unlink(service.path('data'))
+        report('download', size_mb=args.transfer_size,
+               latency_ms=args.latency, mb_per_s=throughput(size, times),
+               requests=service.requests() // len(times), **summarise(times))
+    finally:
+        service.close()
+
+
+def bench_sync(args):
+    """Vault sync time against inventory size"""
+    for archive_count in args.inventory_sizes:
+        service = FakeService(args.latency)
+        try:
+            service.fake.add_archives('bench_vault', archive_count)
+            # Queue the inventory job; it completes at once
+            service.run(['vault', 'sync', 'bench_vault'], exit_codes=(75,))
+            times = [service.run(['vault', 'sync', 'bench_vault'],
+                                 db_path=service.new_db_path())
+                     for _ in range(args.repeat)]
+            report('sync.new_cache', archives=archive_count,
+                   latency_ms=args.latency, **summarise(times))
+            # The same inventory again, into a cache that already has it
+            service.run(['vault', 'sync', 'bench_vault'])
+            times = [service.run(['vault', 'sync', '--fix', 'bench_vault'])
+                     for _ in range(args.repeat)]
+            report('sync.existing_cache', archives=archive_count,
+                   latency_ms=args.latency, **summarise(times))
+        finally:
+            service.close()
+
+
+def bench_checkpresent(args):
+    """Checkpresent latency, from the cache and after a vault sync"""
+    archive_count = 10000
+    service = FakeService(args.latency)
+    try:
+        service.fake.add_archives('bench_vault', archive_count)
+        service.run(['vault', 'sync', 'bench_vault'], exit_codes=(75,))
+        service.run(['vault', 'sync', 'bench_vault'])
+        service.requests()
+        times = [service.run(['archive', 'checkpresent', 'bench_vault',
+                              'archive-1'])
+                 for _ in range(args.repeat)]
+        report('checkpresent.cached', archives=archive_count,
+               requests=service.requests() // len(times), **summarise(times))
+        refs = u''.join(u'archive-%d\n' % i
+                        for i in range(0, archive_count * 2, 2))
+        times = [service.run(['archive', 'checkpresent', '--batch',
+                              'bench_vault'], stdin=refs)
+                 for _ in range(args.repeat)]
+        report('checkpresent.batch', archives=archive_count,
+               refs=archive_count, requests=service.requests() // len(times),
+               **summarise(times))
+        # A cache that has never seen the vault must sync it first
+        times = [service.run(['archive', 'checkpresent', '--wait',
+                              'bench_vault', 'archive-1'],
+                             db_path=service.new_db_path())
+                 for _ in range(args.repeat)]
+        report('checkpresent.sync', archives=archive_count,
+               latency_ms=args.latency,
+               requests=service.requests() // len(times), **summarise(times))
+    finally:
+        service.close()
+
+
+BENCHMARKS = {
+    'checkpresent': bench_checkpresent,
+    'download': bench_download,
+    'startup': bench_startup,
+    'sync': bench_sync,
+    'upload': bench_upload,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=5, metavar='MS',
+                        help='added to each request to the fake service')
+    parser.add_argument('--transfer-size', type=int, default=64,
+                        metavar='MB', help='archive size for upload and '
+                        'download')
+    parser.add_argument('--inventory-sizes', default=[1000, 10000, 100000],
+                        type=lambda s: [int(n) for n in s.split(',')],
+                        metavar='N,N,...', help='archive counts for sync')
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help='one of: %s' % ', '.join(sorted(BENCHMARKS)))
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark %r' % name)
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        BENCHMARKS[name](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,697 @@
+#!/usr/bin/env python
+
+"""A local stand-in for the Amazon Glacier API.
+
+FakeGlacier serves enough of the Glacier REST API on localhost for boto,
+and so glacier-cli, to use it unmodified: vaults, multipart uploads,
+archive deletion and archive and inventory retrieval jobs. Jobs complete
+job_delay seconds after they are initiated, every request can be delayed
+by latency seconds to stand in for the network, and vaults can be filled
+with any number of small synthetic archives so that inventories of
+arbitrary size can be retrieved.
+
+    with FakeGlacier(latency=0.01) as fake:
+        fake.add_archives('vault', 100000)
+        app = glacier.App(argv, connection=fake.connect())
+
+Nothing is persisted and request signatures are not checked.
+"""
+
+from __future__ import print_function
+
+import collections
+import json
+import re
+import socket
+import sys
+import threading
+import time
+import uuid
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, unquote, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import unquote
+    from urlparse import parse_qs, urlparse
+
+import glacier
+
+
+FAKE_ACCOUNT_ID = '123456789012'
+FAKE_REGION = 'fake-region-1'
+
+# Synthetic archives are listed in the inventory in chunks of this many, so
+# that large inventories are streamed rather than built in memory.
+INVENTORY_CHUNK_SIZE = 1000
+
+# Glacier lists at most this many jobs per ListJobs response, and a Marker
+# to continue from if there are more.
+JOB_LIST_LIMIT = 50
+
+
+def iso8601(timestamp):
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(timestamp))
+
+
+def parse_range(value, size):
+    """Return (start, end) of a 'start-end' byte range, end exclusive"""
+    start, end = value.split('-')
+    start, end = int(start), min(int(end) + 1, size)
+    if not 0 <= start < end:
+        raise FakeGlacierError(416, 'InvalidParameterValueException',
+                               'invalid range %r' % value)
+    return start, end
+
+
+def is_tree_hash_aligned(start, end, size):
+    return (start % glacier.MEGABYTE == 0 and
+            ((end - start) % glacier.MEGABYTE == 0 or end == size))
+
+
+class FakeGlacierError(Exception):
+    def __init__(self, status, code, message):
+        super(FakeGlacierError, self).__init__(message)
+        self.status = status
+        self.code = code
+        self.message = message
+
+
+class FakeArchive(object):
+    def __init__(self, id, description, data, creation_date):
+        self.id = id
+        self.description = description
+        self.data = data
+        self.size = len(data)
+        self.tree_hash = glacier.tree_hash_hex(data)
+        self.creation_date = creation_date
+
+    def inventory_entry(self):
+        return {
+            'ArchiveId': self.id,
+            'ArchiveDescription': self.description,
+            'CreationDate': iso8601(self.creation_date),
+            'Size': self.size,
+            'SHA256TreeHash': self.tree_hash,
+        }
+
+
+class FakeUpload(object):
+    def __init__(self, id, description, part_size, creation_date):
+        self.id = id
+        self.description = description
+        self.part_size = part_size
+        self.creation_date = creation_date
+        # {start: (data, tree_hash)}
+        self.parts = {}
+
+
+class FakeJob(object):
+    def __init__(self, id, vault, action, creation_date, completion_date,
+                 archive=None, byte_range=None, inventory=None,
+                 inventory_date=None, description=None, tier='Standard'):
+        self.id = id
+        self.vault = vault
+        self.action = action
+        self.creation_date = creation_date
+        self.completion_date = completion_date
+        self.archive = archive
+        self.byte_range = byte_range
+        # A snapshot of the vault's archives when the job was initiated
+        self.inventory = inventory
+        self.inventory_date = inventory_date
+        self.description = description
+        self.tier = tier
+
+    def completed(self, now):
+        return now >= self.completion_date
+
+    def archive_range(self):
+        if self.byte_range is None:
+            return 0, self.archive.size
+        return self.byte_range
+
+    def describe(self, now):
+        completed = self.completed(now)
+        response = {
+            'Action': self.action,
+            'ArchiveId': None,
+            'ArchiveSHA256TreeHash': None,
+            'ArchiveSizeInBytes': None,
+            'Completed': completed,
+            'CompletionDate': (iso8601(self.completion_date) if completed
+                               else None),
+            'CreationDate': iso8601(self.creation_date),
+            'InventorySizeInBytes': None,
+            'JobDescription': self.description,
+            'JobId': self.id,
+            'RetrievalByteRange': None,
+            'SHA256TreeHash': None,
+            'SNSTopic': None,
+            'StatusCode': 'Succeeded' if completed else 'InProgress',
+            'StatusMessage': 'Succeeded' if completed else None,
+            'Tier': self.tier,
+            'VaultARN': self.vault.arn,
+        }
+        if self.archive is not None:
+            start, end = self.archive_range()
+            response.update({
+                'ArchiveId': self.archive.id,
+                'ArchiveSHA256TreeHash': self.archive.tree_hash,
+                'ArchiveSizeInBytes': self.archive.size,
+                'RetrievalByteRange': '%d-%d' % (start, end - 1),
+            })
+            if is_tree_hash_aligned(start, end, self.archive.size):
+                response['SHA256TreeHash'] = glacier.tree_hash_hex(
+                    self.archive.data[start:end])
+        return response
+
+    def iter_inventory(self):
+        """Yield the inventory as JSON in chunks of bytes"""
+        header = json.dumps({
+            'VaultARN': self.vault.arn,
+            'InventoryDate': iso8601(self.inventory_date),
+        })
+        yield (header[:-1] + ', "ArchiveList": [').encode('utf-8')
+        for i in range(0, len(self.inventory), INVENTORY_CHUNK_SIZE):
+            chunk = ', '.join(
+                json.dumps(archive.inventory_entry())
+                for archive in self.inventory[i:i + INVENTORY_CHUNK_SIZE])
+            yield ((', ' if i else '') + chunk).encode('utf-8')
+        yield b']}'
+
+
+class FakeVault(object):
+    def __init__(self, name, creation_date):
+        self.name = name
+        self.arn = 'arn:aws:glacier:%s:%s:vaults/%s' % (
+            FAKE_REGION, FAKE_ACCOUNT_ID, name)
+        self.creation_date = creation_date
+        # Glacier's InventoryDate only changes when the vault does
+        self.inventory_date = creation_date
+        self.archives = collections.OrderedDict()
+        self.uploads = collections.OrderedDict()
+        self.jobs = collections.OrderedDict()
+
+    def describe(self):
+        return {
+            'CreationDate': iso8601(self.creation_date),
+            'LastInventoryDate': iso8601(self.inventory_date),
+            'NumberOfArchives': len(self.archives),
+            'SizeInBytes': sum(a.size for a in self.archives.values()),
+            'VaultARN': self.arn,
+            'VaultName': self.name,
+        }
+
+
+class FakeGlacier(object):
+    """An in-memory Glacier service listening on localhost.
+
+    latency is slept at the start of every request, and jobs complete
+    job_delay seconds after they are initiated (as measured by clock).
+    requests counts the requests served by operation name, and bytes_in
+    and bytes_out the request and response body bytes.
+    """
+    ROUTES = [
+        ('GET', r'vaults', 'list_vaults'),
+        ('GET', r'vaults/([^/]+)', 'describe_vault'),
+        ('PUT', r'vaults/([^/]+)', 'create_vault'),
+        ('DELETE', r'vaults/([^/]+)', 'delete_vault'),
+        ('GET', r'vaults/([^/]+)/multipart-uploads',
+         'list_multipart_uploads'),
+        ('POST', r'vaults/([^/]+)/multipart-uploads',
+         'initiate_multipart_upload'),
+        ('GET', r'vaults/([^/]+)/multipart-uploads/([^/]+)', 'list_parts'),
+        ('PUT', r'vaults/([^/]+)/multipart-uploads/([^/]+)', 'upload_part'),
+        ('POST', r'vaults/([^/]+)/multipart-uploads/([^/]+)',
+         'complete_multipart_upload'),
+        ('DELETE', r'vaults/([^/]+)/multipart-uploads/([^/]+)',
+         'abort_multipart_upload'),
+        ('DELETE', r'vaults/([^/]+)/archives/([^/]+)', 'delete_archive'),
+        ('GET', r'vaults/([^/]+)/jobs', 'list_jobs'),
+        ('POST', r'vaults/([^/]+)/jobs', 'initiate_job'),
+        ('GET', r'vaults/([^/]+)/jobs/([^/]+)', 'describe_job'),
+        ('GET', r'vaults/([^/]+)/jobs/([^/]+)/output', 'get_job_output'),
+    ]
+
+    def __init__(self, latency=0, job_delay=0, clock=time.time):
+        self.latency = latency
+        self.job_delay = job_delay
+        self.clock = clock
+        self.vaults = collections.OrderedDict()
+        self.requests = collections.Counter()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.lock = threading.Lock()
+        self.server = None
+        self.thread = None
+        # The boto connections returned by connect()
+        self.connections = []
+        self.routes = [(method, re.compile(r'/[^/]+/%s$' % pattern), name)
+                       for method, pattern, name in self.ROUTES]
+
+    def start(self):
+        fake = self
+
+        class Handler(FakeGlacierRequestHandler):
+            glacier = fake
+
+        self.server = FakeGlacierServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving, once every connection to the service is closed.
+
+        boto keeps the connections it has made in a pool for reuse, so
+        those are closed here rather than left for the garbage collector.
+        """
+        for connection in self.connections:
+            for pool in connection.layer1._pool.host_to_pool.values():
+                while pool.queue:
+                    conn, _ = pool.queue.pop()
+                    conn.close()
+        self.server.shutdown()
+        self.server.close_requests()
+        self.server.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def connect(self, aws_access_key_id='fake'):
+        """Return a boto Layer2 connection to this service"""
+        import boto.glacier.layer2
+        import boto.regioninfo
+        region = boto.regioninfo.RegionInfo(
+            name=FAKE_REGION, endpoint='127.0.0.1',
+            connection_cls=boto.glacier.layer2.Layer2)
+        connection = boto.glacier.layer2.Layer2(
+            aws_access_key_id=aws_access_key_id,
+            aws_secret_access_key='fake', region=region, is_secure=False,
+            port=self.port)
+        # Never send requests for localhost through an http_proxy
+        connection.layer1.use_proxy = False
+        self.connections.append(connection)
+        return connection
+
+    def reset_counters(self):
+        with self.lock:
+            self.requests.clear()
+            self.bytes_in = self.bytes_out = 0
+
+    def _create_vault(self, name):
+        if name not in self.vaults:
+            self.vaults[name] = FakeVault(name, self.clock())
+        return self.vaults[name]
+
+    def _get_vault(self, name):
+        try:
+            return self.vaults[name]
+        except KeyError:
+            raise FakeGlacierError(404, 'ResourceNotFoundException',
+                                   'Vault not found: %s' % name)
+
+    def _add_archive(self, vault, description, data):
+        now = self.clock()
+        archive = FakeArchive(uuid.uuid4().hex, description, data, now)
+        vault.archives[archive.id] = archive
+        vault.inventory_date = now
+        return archive
+
+    def add_archive(self, vault_name, description, data):
+        """Store an archive directly and return its id"""
+        with self.lock:
+            vault = self._create_vault(vault_name)
+            return self._add_archive(vault, description, data).id
+
+    def add_archives(self, vault_name, count, size=64):
+        """Store count synthetic archives of size bytes each"""
+        with self.lock:
+            vault = self._create_vault(vault_name)
+            for i in range(count):
+                self._add_archive(vault, 'archive-%d' % i,
+                                  (b'%d:' % i).ljust(size, b'.'))
+
+    def dispatch(self, method, path, query, headers, body):
+        """Return (status, headers, body) for a request.
+
+        body is bytes, or an iterable of bytes to be sent chunked.
+        """
+        for route_method, pattern, name in self.routes:
+            if route_method != method:
+                continue
+            match = pattern.match(path)
+            if match:
+                break
+        else:
+            raise FakeGlacierError(404, 'UnknownOperationException',
+                                   '%s %s' % (method, path))
+        args = [unquote(group) for group in match.groups()]
+        with self.lock:
+            self.requests[name] += 1
+            self.bytes_in += len(body)
+        return getattr(self, name)(query, headers, body, *args)
+
+    def _json(self, status, value, headers=None):
+        headers = dict(headers or {})
+        headers['Content-Type'] = 'application/json'
+        return status, headers, json.dumps(value).encode('utf-8')
+
+    def list_vaults(self, query, headers, body):
+        with self.lock:
+            vault_list = [vault.describe() for vault in self.vaults.values()]
+        return self._json(200, {'VaultList': vault_list, 'Marker': None})
+
+    def describe_vault(self, query, headers, body, vault_name):
+        with self.lock:
+            return self._json(200, self._get_vault(vault_name).describe())
+
+    def create_vault(self, query, headers, body, vault_name):
+        with self.lock:
+            self._create_vault(vault_name)
+        return 201, {'Location': '/%s/vaults/%s' % (
+            FAKE_ACCOUNT_ID, vault_name)}, b''
+
+    def delete_vault(self, query, headers, body, vault_name):
+        with self.lock:
+            vault = self._get_vault(vault_name)
+            if vault.archives:
+                raise FakeGlacierError(400, 'InvalidParameterValueException',
+                                       'Vault not empty')
+            del self.vaults[vault_name]
+        return 204, {}, b''
+
+    def list_multipart_uploads(self, query, headers, body, vault_name):
+        with self.lock:
+            vault = self._get_vault(vault_name)
+            uploads = [{
+                'ArchiveDescription': upload.description,
+                'CreationDate': iso8601(upload.creation_date),
+                'MultipartUploadId': upload.id,
+                'PartSizeInBytes': upload.part_size,
+                'VaultARN': vault.arn,
+            } for upload in vault.uploads.values()]
+        return self._json(200, {'UploadsList': uploads, 'Marker': None})
+
+    def initiate_multipart_upload(self, query, headers, body, vault_name):
+        upload = FakeUpload(uuid.uuid4().hex,
+                            headers.get('x-amz-archive-description'),
+                            int(headers['x-amz-part-size']), self.clock())
+        with self.lock:
+            self._get_vault(vault_name).uploads[upload.id] = upload
+        return 201, {
+            'x-amz-multipart-upload-id': upload.id,
+            'Location': '/%s/vaults/%s/multipart-uploads/%s' % (
+                FAKE_ACCOUNT_ID, vault_name, upload.id),
+        }, b''
+
+    def _get_upload(self, vault_name, upload_id):
+        try:
+            return self._get_vault(vault_name).uploads[upload_id]
+        except KeyError:
+            raise FakeGlacierError(404, 'ResourceNotFoundException',
+                                   'Upload not found: %s' % upload_id)
+
+    def list_parts(self, query, headers, body, vault_name, upload_id):
+        with self.lock:
+            upload = self._get_upload(vault_name, upload_id)
+            parts = [{
+                'RangeInBytes': '%d-%d' % (start, start + len(data) - 1),
+                'SHA256TreeHash': tree_hash,
+            } for start, (data, tree_hash) in sorted(upload.parts.items())]
+        return self._json(200, {
+            'ArchiveDescription': upload.description,
+            'CreationDate': iso8601(upload.creation_date),
+            'Marker': None,
+            'MultipartUploadId': upload.id,
+            'PartSizeInBytes': upload.part_size,
+            'Parts': parts,
+        })
+
+    def upload_part(self, query, headers, body, vault_name, upload_id):
+        match = re.match(r'bytes (\d+)-(\d+)/\*$',
+                         headers.get('Content-Range', ''))
+        if not match:
+            raise FakeGlacierError(400, 'InvalidParameterValueException',
+                                   'missing or invalid Content-Range')
+        start, end = int(match.group(1)), int(match.group(2)) + 1
+        tree_hash = glacier.tree_hash_hex(body)
+        if end - start != len(body):
+            raise FakeGlacierError(400, 'InvalidParameterValueException',
+                                   'Content-Range does not match the body')
+        if tree_hash != headers.get('x-amz-sha256-tree-hash'):
+            raise FakeGlacierError(400, 'InvalidParameterValueException',
+                                   'tree hash mismatch')
+        with self.lock:
+            upload = self._get_upload(vault_name, upload_id)
+            if start % upload.part_size:
+                raise FakeGlacierError(400, 'InvalidParameterValueException',
+                                       'part is not aligned to part size')
+            upload.parts[start] = (body, tree_hash)
+        return 204, {'x-amz-sha256-tree-hash': tree_hash}, b''
+
+    def complete_multipart_upload(self, query, headers, body, vault_name,
+                                  upload_id):
+        with self.lock:
+            vault = self._get_vault(vault_name)
+            upload = self._get_upload(vault_name, upload_id)
+            parts = sorted(upload.parts.items())
+            data = b''.join(part_data for start, (part_data, tree_hash)
+                            in parts)
+            offset = 0
+            for start, (part_data, tree_hash) in parts:
+                if start != offset:
+                    raise FakeGlacierError(
+                        400, 'InvalidParameterValueException',
+                        'missing part at %d' % offset)
+                offset += len(part_data)
+            if len(data) != int(headers['x-amz-archive-size']):
+                raise FakeGlacierError(400, 'InvalidParameterValueException',
+                                       'archive size mismatch')
+            archive = self._add_archive(vault, upload.description, data)
+            if archive.tree_hash != headers['x-amz-sha256-tree-hash']:
+                del vault.archives[archive.id]
+                raise FakeGlacierError(400, 'InvalidParameterValueException',
+                                       'tree hash mismatch')
+            del vault.uploads[upload_id]
+        return 201, {
+            'x-amz-archive-id': archive.id,
+            'x-amz-sha256-tree-hash': archive.tree_hash,
+            'Location': '/%s/vaults/%s/archives/%s' % (
+                FAKE_ACCOUNT_ID, vault_name, archive.id),
+        }, b''
+
+    def abort_multipart_upload(self, query, headers, body, vault_name,
+                               upload_id):
+        with self.lock:
+            self._get_upload(vault_name, upload_id)
+            del self.vaults[vault_name].uploads[upload_id]
+        return 204, {}, b''
+
+    def delete_archive(self, query, headers, body, vault_name, archive_id):
+        with self.lock:
+            vault = self._get_vault(vault_name)
+            if vault.archives.pop(archive_id, None) is None:
+                raise FakeGlacierError(404, 'ResourceNotFoundException',
+                                       'Archive not found: %s' % archive_id)
+            vault.inventory_date = self.clock()
+        return 204, {}, b''
+
+    def list_jobs(self, query, headers, body, vault_name):
+        completed = query.get('completed')
+        status_code = query.get('statuscode')
+        now = self.clock()
+        with self.lock:
+            jobs = [job.describe(now)
+                    for job in self._get_vault(vault_name).jobs.values()]
+        if completed is not None:
+            jobs = [job for job in jobs
+                    if job['Completed'] == (completed == 'true')]
+        if status_code is not None:
+            jobs = [job for job in jobs if job['StatusCode'] == status_code]
+        start = 0
+        if query.get('marker'):
+            start = [job['JobId'] for job in jobs].index(query['marker'])
+        end = start + min(int(query.get('limit', JOB_LIST_LIMIT)),
+                          JOB_LIST_LIMIT)
+        marker = jobs[end]['JobId'] if end < len(jobs) else None
+        return self._json(200, {'JobList': jobs[start:end], 'Marker': marker})
+
+    def initiate_job(self, query, headers, body, vault_name):
+        job_data = json.loads(body.decode('utf-8'))
+        now = self.clock()
+        with self.lock:
+            vault = self._get_vault(vault_name)
+            kwargs = {
+                'id': uuid.uuid4().hex,
+                'vault': vault,
+                'creation_date': now,
+                'completion_date': now + self.job_delay,
+                'description': job_data.get('Description'),
+                'tier': job_data.get('Tier', 'Standard'),
+            }
+            if job_data['Type'] == 'archive-retrieval':
+                try:
+                    archive = vault.archives[job_data['ArchiveId']]
+                except KeyError:
+                    raise FakeGlacierError(
+                        404, 'ResourceNotFoundException',
+                        'Archive not found: %s' % job_data['ArchiveId'])
+                byte_range = job_data.get('RetrievalByteRange')
+                if byte_range is not None:
+                    byte_range = parse_range(byte_range, archive.size)
+                job = FakeJob(action='ArchiveRetrieval', archive=archive,
+                              byte_range=byte_range, **kwargs)
+            elif job_data['Type'] == 'inventory-retrieval':
+                job = FakeJob(action='InventoryRetrieval',
+                              inventory=list(vault.archives.values()),
+                              inventory_date=vault.inventory_date, **kwargs)
+            else:
+                raise FakeGlacierError(400, 'InvalidParameterValueException',
+                                       'unknown job type %r' %
+                                       job_data['Type'])
+            vault.jobs[job.id] = job
+        return 202, {
+            'x-amz-job-id': job.id,
+            'Location': '/%s/vaults/%s/jobs/%s' % (
+                FAKE_ACCOUNT_ID, vault_name, job.id),
+        }, b''
+
+    def _get_job(self, vault_name, job_id):
+        with self.lock:
+            try:
+                return self._get_vault(vault_name).jobs[job_id]
+            except KeyError:
+                raise FakeGlacierError(404, 'ResourceNotFoundException',
+                                       'Job not found: %s' % job_id)
+
+    def describe_job(self, query, headers, body, vault_name, job_id):
+        job = self._get_job(vault_name, job_id)
+        return self._json(200, job.describe(self.clock()))
+
+    def get_job_output(self, query, headers, body, vault_name, job_id):
+        job = self._get_job(vault_name, job_id)
+        if not job.completed(self.clock()):
+            raise FakeGlacierError(400, 'InvalidParameterValueException',
+                                   'The job is not currently available '
+                                   'for download: %s' % job_id)
+        if job.archive is None:
+            return 200, {'Content-Type': 'application/json'}, \
+                job.iter_inventory()
+
+        job_start, job_end = job.archive_range()
+        output_size = job_end - job_start
+        response_headers = {'Content-Type': 'application/octet-stream'}
+        status = 200
+        start, end = 0, output_size
+        match = re.match(r'bytes=(\d+)-(\d+)$', headers.get('Range', ''))
+        if match:
+            status = 206
+            start, end = parse_range('%s-%s' % match.groups(), output_size)
+            response_headers['Content-Range'] = 'bytes %d-%d/%d' % (
+                start, end - 1, output_size)
+        data = job.archive.data[job_start + start:job_start + end]
+        if is_tree_hash_aligned(start, end, output_size):
+            response_headers['x-amz-sha256-tree-hash'] = (
+                glacier.tree_hash_hex(data))
+        return status, response_headers, data
+
+
+class FakeGlacierServer(ThreadingMixIn, HTTPServer):
+    """Serve each connection from its own thread, keeping track of them.
+
+    close_requests() closes the connections still open and waits for their
+    threads to finish, so that none is left behind once the service stops.
+    """
+    daemon_threads = True
+
+    def __init__(self, server_address, handler_class):
+        HTTPServer.__init__(self, server_address, handler_class)
+        self.requests = set()
+        self.requests_changed = threading.Condition()
+
+    def process_request(self, request, client_address):
+        with self.requests_changed:
+            self.requests.add(request)
+        ThreadingMixIn.process_request(self, request, client_address)
+
+    def shutdown_request(self, request):
+        HTTPServer.shutdown_request(self, request)
+        with self.requests_changed:
+            self.requests.discard(request)
+            self.requests_changed.notify_all()
+
+    def handle_error(self, request, client_address):
+        # A client that goes away mid-request is not an error
+        if not isinstance(sys.exc_info()[1], socket.error):
+            HTTPServer.handle_error(self, request, client_address)
+
+    def close_requests(self):
+        with self.requests_changed:
+            for request in self.requests:
+                try:
+                    request.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+            while self.requests:
+                self.requests_changed.wait()
+
+
+class FakeGlacierRequestHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so that boto's connection pool is used as against Glacier
+    protocol_version = 'HTTP/1.1'
+    # Otherwise a response body sent after its headers waits for a delayed
+    # ACK, adding tens of milliseconds to every request
+    disable_nagle_algorithm = True
+    glacier = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle_request(self):
+        time.sleep(self.glacier.latency)
+        url = urlparse(self.path)
+        query = dict((key, values[-1])
+                     for key, values in parse_qs(url.query).items())
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            status, headers, response_body = self.glacier.dispatch(
+                self.command, url.path, query, self.headers, body)
+        except FakeGlacierError as e:
+            status, headers, response_body = self.glacier._json(
+                e.status, {'code': e.code, 'message': e.message,
+                           'type': 'Client'})
+        self.send_response(status)
+        self.send_header('x-amzn-RequestId', uuid.uuid4().hex)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if isinstance(response_body, bytes):
+            self.send_header('Content-Length', str(len(response_body)))
+            self.end_headers()
+            self.wfile.write(response_body)
+            sent = len(response_body)
+        else:
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            sent = 0
+            for chunk in response_body:
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+                sent += len(chunk)
+            self.wfile.write(b'0\r\n\r\n')
+        with self.glacier.lock:
+            self.glacier.bytes_out += sent
+
+    do_GET = do_PUT = do_POST = do_DELETE = handle_request
@@ -23,14 +23,27 @@
 
 from __future__ import print_function
 
+import gc
+import io
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
 import sys
+import tarfile
+import tempfile
+import threading
 import unittest
 
+import boto.glacier.job
+import boto.glacier.utils
 import mock
-from mock import Mock, patch, sentinel
+from mock import MagicMock, Mock, patch, sentinel
 import nose.tools
 
 import glacier
+import glacier_fake
 
 
 EX_TEMPFAIL = 75
@@ -44,21 +57,101 @@ def patch_builtin(name, *args, **kwargs):
     return patch(target, *args, **kwargs)
 
 
+def job_data(**kwargs):
+    """Return a job description as Glacier's ListJobs gives it"""
+    data = dict((response_name, default) for response_name, attr_name, default
+                in boto.glacier.job.Job.ResponseDataElements)
+    data.update(kwargs)
+    return data
+
+
+class MockResponse(dict):
+    """Stand-in for boto.glacier.response.GlacierResponse"""
+    def __init__(self, data, tree_hash=None):
+        super(MockResponse, self).__init__()
+        self.data = data
+        if tree_hash is not None:
+            self['TreeHash'] = tree_hash
+
+    def read(self):
+        return self.data
+
+
 class TestCase(unittest.TestCase):
+    def setUp(self):
+        # Output of the jobs made by mock_inventory_job, by job id
+        self.job_outputs = {}
+
     def init_app(self, args, memory_cache=False):
         self.connection = Mock()
         if memory_cache:
             self.cache = glacier.Cache(0, db_path=':memory:')
         else:
-            self.cache = Mock()
+            # MagicMock, since cache.group_commit() is used as a context
+            # manager
+            self.cache = MagicMock()
         self.app = glacier.App(
             args=args,
             connection=self.connection,
             cache=self.cache)
+        self.addCleanup(self.close_app_file, self.app)
 
-    def run_app(self, args):
-        self.init_app(args)
-        self.app.main()
+    def close_app_file(self, app):
+        """Close the file argparse opened for app, if any"""
+        file_obj = getattr(app.args, 'file', None)
+        if getattr(file_obj, 'name', None) not in (None, '<stdin>'):
+            file_obj.close()
+
+    def run_app(self, args, connection=None, cache=None, stdin=None):
+        """Run glacier with args and return its exit status
+
+        The app uses connection and cache if given, and the mocks made by
+        init_app otherwise.  Its stderr is discarded.
+        """
+        with patch('sys.stderr', io.StringIO()), \
+                patch('sys.stdin', io.StringIO(stdin or u'')):
+            if connection is None:
+                self.init_app(args)
+                app = self.app
+            else:
+                app = glacier.App(args=list(args), connection=connection,
+                                  cache=cache)
+            try:
+                app.main()
+            except SystemExit as e:
+                return e.code
+            finally:
+                self.close_app_file(app)
+        return 0
+
+    def make_tmpdir(self):
+        """Make a temporary directory that is removed after the test"""
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        return tmpdir
+
+    def mock_jobs(self, vault, jobs):
+        """Make vault list jobs, a list of job_data(), in ListJobs pages"""
+        def list_jobs(vault_name, completed=None, marker=None):
+            listed = [job for job in jobs
+                      if completed is None or job['Completed'] == completed]
+            start = int(marker or 0)
+            end = start + glacier_fake.JOB_LIST_LIMIT
+            return {'JobList': listed[start:end],
+                    'Marker': str(end) if end < len(listed) else None}
+
+        vault.layer1.list_jobs.side_effect = list_jobs
+
+    def mock_job_output(self, vault, outputs):
+        """Make vault's jobs output the data in outputs, {job_id: data}"""
+        def get_job_output(vault_name, job_id, byte_range=None):
+            data = outputs[job_id]
+            if byte_range is None:
+                return MockResponse(data)
+            start, end = byte_range
+            return MockResponse(data[start:end + 1])
+
+        vault.layer1.get_job_output.side_effect = get_job_output
 
     def test_vault_list(self):
         self.init_app(['vault', 'list'])
@@ -71,9 +164,36 @@ class TestCase(unittest.TestCase):
         print_mock.assert_called_once_with(sentinel.vault_name, sep=u'\n')
 
     def test_vault_create(self):
-        self.run_app(['vault', 'create', 'vault_name'])
+        self.assertEqual(self.run_app(['vault', 'create', 'vault_name']), 0)
         self.connection.create_vault.assert_called_once_with('vault_name')
 
+    def test_job_list(self):
+        self.init_app(['job', 'list'], memory_cache=True)
+        self.cache.add_archive('vault_name', 'archive_name', 'id_known')
+        mock_vault = Mock()
+        mock_vault.name = 'vault_name'
+        # The last job is on the second page of the listing
+        pending_count = glacier_fake.JOB_LIST_LIMIT - 1
+        jobs = [('ArchiveRetrieval', 'id_known', 'InProgress')] * \
+            pending_count + [('ArchiveRetrieval', 'id_unknown', 'Succeeded'),
+                             ('InventoryRetrieval', None, 'Failed')]
+        self.mock_jobs(mock_vault, [
+            job_data(Action=action, ArchiveId=archive_id, StatusCode=status,
+                     CreationDate='1970-01-01T00:00:00Z')
+            for action, archive_id, status in jobs])
+        self.connection.list_vaults.return_value = [mock_vault]
+        print_mock = Mock()
+        with patch_builtin('print', print_mock), \
+                patch.object(self.cache, 'get_archive_name') as mock_name:
+            self.app.main()
+        mock_name.assert_not_called()
+        self.assertEqual(print_mock.call_args_list, [
+            mock.call('a/p 1970-01-01T00:00:00Z vault_name archive_name')
+        ] * pending_count + [
+            mock.call('a/d 1970-01-01T00:00:00Z vault_name id:id_unknown'),
+            mock.call('i/e 1970-01-01T00:00:00Z vault_name '),
+        ])
+
     def test_archive_list(self):
         self.init_app(['archive', 'list', 'vault_name'])
         archive_list = [sentinel.archive_one, sentinel.archive_two]
@@ -81,7 +201,10 @@ class TestCase(unittest.TestCase):
         print_mock = Mock()
         with patch_builtin('print', print_mock):
             self.app.main()
-        print_mock.assert_called_once_with(*archive_list, sep="\n")
+        self.cache.get_archive_list.assert_called_once_with(
+            'vault_name', prefix=None, glob=None)
+        self.assertEqual(print_mock.call_args_list,
+                         [mock.call(archive) for archive in archive_list])
 
     def test_archive_list_force_ids(self):
         self.init_app(
@@ -95,48 +218,230 @@ class TestCase(unittest.TestCase):
         with patch_builtin('print', print_mock):
             self.app.main()
 
-        # print should have been called with a list of the items in some
-        # arbitrary order. Testing this correctly involves being agnostic with
-        # the order of args in *args. Does mock provide any other way of doing
-        # this other than by introspecting mock_calls like this?
-        nose.tools.assert_equals(print_mock.call_count, 1)
+        # print should have been called once per item, in some arbitrary
+        # order.
+        nose.tools.assert_equals(print_mock.call_count, 3)
         nose.tools.assert_equals(
-            sorted(print_mock.mock_calls[0][1]),
+            sorted(call[1][0] for call in print_mock.mock_calls),
             sorted([
                 u'id:id_1\tarchive_name_1',
                 u'id:id_2\tarchive_name_1',
                 u'id:id_3\tarchive_name_3',
             ]),
         )
-        nose.tools.assert_equals(
-            print_mock.mock_calls[0][2],
-            {'sep': "\n"}
-        )
+
+    def test_archive_list_filters(self):
+        self.init_app(['archive', 'list', 'vault_name'], memory_cache=True)
+        for name, id in [('a*b', 'id_1'), ('a*b', 'id_2'), ('a*bc', 'id_3'),
+                         ('axb', 'id_4'), ('b', 'id_5')]:
+            self.cache.add_archive('vault_name', name, id)
+
+        def archive_list(**kwargs):
+            return list(self.cache.get_archive_list('vault_name', **kwargs))
+
+        self.assertEqual(archive_list(prefix='a*'), [
+            'id:id_1\ta*b', 'id:id_2\ta*b', 'a*bc'])
+        self.assertEqual(archive_list(glob='a?b'), [
+            'id:id_1\ta*b', 'id:id_2\ta*b', 'axb'])
+        self.assertEqual(archive_list(), [
+            'id:id_1\ta*b', 'id:id_2\ta*b', 'a*bc', 'axb', 'b'])
+
+    def init_upload_mocks(self):
+        layer1 = self.connection.layer1
+        layer1.initiate_multipart_upload.return_value = {
+            'UploadId': sentinel.upload_id}
+        layer1.complete_multipart_upload.return_value = {
+            'ArchiveId': sentinel.archive_id}
+        return layer1
+
+    def test_archive_duplicates(self):
+        self.init_app(['archive', 'duplicates', 'vault_name'],
+                      memory_cache=True)
+        for id, name, tree_hash, creation_date in [
+                ('id_1', 'a', 'hash_1', '2013-01-02T00:00:00Z'),
+                ('id_2', 'a', 'hash_1', '2013-01-01T00:00:00Z'),
+                ('id_3', 'a', 'hash_2', '2013-01-03T00:00:00Z'),
+                ('id_4', 'b', 'hash_2', '2013-01-04T00:00:00Z'),
+                ('id_5', 'c', None, '2013-01-05T00:00:00Z')]:
+            self.cache.session.add(self.cache.Archive(
+                key=self.cache.key, vault='vault_name', id=id, name=name,
+                tree_hash=tree_hash, size=1, creation_date=creation_date))
+        self.cache.session.commit()
+        self.cache.delete_archive('vault_name', 'c')
+
+        def duplicates(**kwargs):
+            return sorted(self.cache.get_duplicate_archive_ids(
+                'vault_name', **kwargs))
+
+        self.assertEqual(duplicates(), ['id_1', 'id_3'])
+        self.assertEqual(duplicates(keep='newest'), ['id_1', 'id_2'])
+        self.assertEqual(duplicates(by='content'), ['id_1', 'id_4'])
+        self.assertEqual(duplicates(by='content', keep='newest'),
+                         ['id_2', 'id_3'])
+        print_mock = Mock()
+        with patch_builtin('print', print_mock):
+            self.app.main()
+        self.assertEqual(sorted(print_mock.call_args_list),
+                         [mock.call('id:id_1'), mock.call('id:id_3')])
+
+    def test_archive_duplicates_delete(self):
+        # The output of archive duplicates works as archive delete refs,
+        # both one per run (as glacier-list-duplicates.sh is used with
+        # xargs) and all at once with --from-file.
+        cache = glacier.Cache(0, db_path=':memory:')
+        for id in ['id_1', 'id_2', 'id_3']:
+            cache.add_archive('vault_name', 'a', id)
+        connection = Mock()
+        stdout = io.StringIO()
+        with patch('sys.stdout', stdout):
+            self.assertEqual(
+                self.run_app(['archive', 'duplicates', 'vault_name'],
+                             connection=connection, cache=cache), 0)
+        refs = stdout.getvalue().splitlines()
+        self.assertEqual(len(refs), 2)
+        self.assertEqual(
+            self.run_app(['archive', 'delete', 'vault_name', refs[0]],
+                         connection=connection, cache=cache), 0)
+        self.assertEqual(
+            self.run_app(['archive', 'delete', '--from-file', '-',
+                          'vault_name'],
+                         connection=connection, cache=cache,
+                         stdin=u'\n'.join(refs[1:]) + u'\n'), 0)
+        mock_vault = connection.get_vault.return_value
+        self.assertEqual(
+            sorted(c[0][0] for c in mock_vault.delete_archive.call_args_list),
+            sorted(ref[len('id:'):] for ref in refs))
+        self.assertEqual(list(cache.get_archive_list('vault_name')), ['a'])
 
     def test_archive_upload(self):
-        file_obj = Mock()
+        file_obj = io.BytesIO(b'data')
         file_obj.name = 'filename'
         file_obj.mode = 'rb'
         open_mock = Mock(return_value=file_obj)
         with patch_builtin('open', open_mock):
-            self.run_app(['archive', 'upload', 'vault_name', 'filename'])
-        self.connection.get_vault.assert_called_with('vault_name')
-        mock_vault = self.connection.get_vault.return_value
-        mock_vault.create_archive_from_file.assert_called_once_with(
-            file_obj=file_obj, description='filename')
+            self.init_app(['archive', 'upload', 'vault_name', 'filename'])
+        layer1 = self.init_upload_mocks()
+        self.app.main()
+        tree_hash = boto.glacier.utils.tree_hash_from_str(b'data')
+        tree_hash = tree_hash.decode('ascii')
+        layer1.initiate_multipart_upload.assert_called_once_with(
+            'vault_name', glacier.DEFAULT_PART_SIZE, 'filename')
+        layer1.upload_part.assert_called_once_with(
+            'vault_name', sentinel.upload_id,
+            glacier.hashlib.sha256(b'data').hexdigest(), tree_hash,
+            (0, 3), b'data')
+        layer1.complete_multipart_upload.assert_called_once_with(
+            'vault_name', sentinel.upload_id, tree_hash, 4)
+        self.cache.add_archive.assert_called_once_with(
+            'vault_name', 'filename', sentinel.archive_id,
+            tree_hash=tree_hash, size=4)
 
     def test_archive_stdin_upload(self):
-        self.run_app(['archive', 'upload', 'vault_name', '-'])
-        self.connection.get_vault.assert_called_once_with('vault_name')
-        vault = self.connection.get_vault.return_value
-        expected_file_obj = sys.stdin if PY2 else sys.stdin.buffer
-        vault.create_archive_from_file.assert_called_once_with(
-            file_obj=expected_file_obj, description='<stdin>')
+        stdin = io.BytesIO(b'data')
+        stdin.name = '<stdin>'
+        stdin.mode = 'rb'
+        if not PY2:
+            stdin = io.TextIOWrapper(stdin)
+        stdin.mode = 'r'
+        with patch('sys.stdin', stdin):
+            self.init_app(['archive', 'upload', 'vault_name', '-'])
+        layer1 = self.init_upload_mocks()
+        self.app.main()
+        layer1.initiate_multipart_upload.assert_called_once_with(
+            'vault_name', glacier.DEFAULT_PART_SIZE, '<stdin>')
+        self.assertEqual(layer1.upload_part.call_args[0][5], b'data')
+        self.cache.add_archive.assert_called_once_with(
+            'vault_name', '<stdin>', sentinel.archive_id,
+            tree_hash=glacier.tree_hash_hex(b'data'), size=4)
+
+    def test_archive_upload_skip_existing(self):
+        tmpdir = self.make_tmpdir()
+        filename = os.path.join(tmpdir, 'archive_name')
+        with open(filename, 'wb') as f:
+            f.write(b'data')
+        args = ['archive', 'upload', '--skip-existing', 'vault_name',
+                filename]
+        self.init_app(args, memory_cache=True)
+        self.cache.add_archive('vault_name', 'archive_name', 'id_other',
+                               tree_hash=glacier.tree_hash_hex(b'other'),
+                               size=5)
+        self.cache.add_archive('vault_name', 'other_name', 'id_same_data',
+                               tree_hash=glacier.tree_hash_hex(b'data'),
+                               size=4)
+        layer1 = self.connection.layer1
+        layer1.initiate_multipart_upload.return_value = {
+            'UploadId': 'upload_id'}
+        layer1.complete_multipart_upload.return_value = {
+            'ArchiveId': 'id_new'}
+        self.app.main()
+        self.app.args.file.close()
+        layer1.complete_multipart_upload.assert_called_once_with(
+            'vault_name', 'upload_id', glacier.tree_hash_hex(b'data'), 4)
+
+        # Now that the cache knows of an archive of this name and contents,
+        # a second upload is skipped.
+        self.app = glacier.App(args=args, connection=self.connection,
+                               cache=self.cache)
+        with patch('glacier.info') as mock_info:
+            self.app.main()
+        self.app.args.file.close()
+        layer1.initiate_multipart_upload.assert_called_once_with(
+            'vault_name', glacier.DEFAULT_PART_SIZE, 'archive_name')
+        mock_info.assert_called_once_with(
+            "archive 'archive_name' already in vault with the same contents "
+            "(id id_new); skipping upload")
+
+    def test_archive_upload_parallel_parts(self):
+        data = b'x' * (2 * glacier.MEGABYTE) + b'y' * 1000
+        file_obj = io.BytesIO(data)
+        file_obj.name = 'filename'
+        file_obj.mode = 'rb'
+        with patch_builtin('open', Mock(return_value=file_obj)):
+            self.init_app(['archive', 'upload', '--part-size', '1048576',
+                           '-j', '3', 'vault_name', 'filename'])
+        layer1 = self.init_upload_mocks()
+        # Parts are uploaded from worker threads, so they are recorded by a
+        # plain function under a lock rather than by a shared Mock.
+        uploaded = []
+        lock = threading.Lock()
+
+        def upload_part(vault_name, upload_id, linear_hash, tree_hash,
+                        byte_range, part_data):
+            with lock:
+                uploaded.append(byte_range)
+
+        layer1.upload_part = upload_part
+        self.app.main()
+        self.assertEqual(sorted(uploaded), [
+            (0, glacier.MEGABYTE - 1),
+            (glacier.MEGABYTE, 2 * glacier.MEGABYTE - 1),
+            (2 * glacier.MEGABYTE, 2 * glacier.MEGABYTE + 999),
+        ])
+        expected_tree_hash = boto.glacier.utils.compute_hashes_from_fileobj(
+            io.BytesIO(data))[1].decode('ascii')
+        layer1.complete_multipart_upload.assert_called_once_with(
+            'vault_name', sentinel.upload_id, expected_tree_hash, len(data))
+
+    def test_archive_upload_failure_aborts(self):
+        file_obj = io.BytesIO(b'data')
+        file_obj.name = 'filename'
+        file_obj.mode = 'rb'
+        with patch_builtin('open', Mock(return_value=file_obj)):
+            self.init_app(['archive', 'upload', 'vault_name', 'filename'])
+        layer1 = self.init_upload_mocks()
+        layer1.upload_part.side_effect = IOError('network down')
+        with patch('glacier.time.sleep'):
+            with patch('glacier.warn'):
+                self.assertRaises(IOError, self.app.main)
+        self.assertEqual(layer1.upload_part.call_count, 5)
+        layer1.abort_multipart_upload.assert_called_once_with(
+            'vault_name', sentinel.upload_id)
+        self.assertFalse(self.cache.add_archive.called)
 
     def test_archive_retrieve_no_job(self):
         self.init_app(['archive', 'retrieve', 'vault_name', 'archive_name'])
         mock_vault = Mock()
-        mock_vault.list_jobs.return_value = []
+        self.mock_jobs(mock_vault, [])
         self.connection.get_vault.return_value = mock_vault
         mock_exit = Mock()
         mock_print = Mock()
@@ -154,30 +459,910 @@ class TestCase(unittest.TestCase):
     def test_archive_retrieve_with_job(self):
         self.init_app(['archive', 'retrieve', 'vault_name', 'archive_name'])
         self.cache.get_archive_id.return_value = sentinel.archive_id
-        mock_job = Mock(
-            archive_id=sentinel.archive_id,
-            completed=True,
-            completion_date='1970-01-01T00:00:00Z',
-            archive_size=1)
         mock_vault = Mock()
-        mock_vault.list_jobs.return_value = [mock_job]
+        mock_vault.name = 'vault_name'
+        self.mock_jobs(mock_vault, [job_data(
+            JobId='job_id', Action='ArchiveRetrieval',
+            ArchiveId=sentinel.archive_id, ArchiveSizeInBytes=1,
+            Completed=True, CompletionDate='1970-01-01T00:00:00Z')])
         self.connection.get_vault.return_value = mock_vault
         mock_open = mock.mock_open()
         with patch_builtin('open', mock_open):
             self.app.main()
         self.cache.get_archive_id.assert_called_once_with(
             'vault_name', 'archive_name')
-        mock_job.get_output.assert_called_once_with()
-        mock_job.get_output.return_value.read.assert_called_once_with()
+        get_job_output = mock_vault.layer1.get_job_output
+        get_job_output.assert_called_once_with('vault_name', 'job_id', None)
+        get_job_output.return_value.read.assert_called_once_with()
         mock_open.assert_called_once_with('archive_name', u'wb')
         mock_open.return_value.write.assert_called_once_with(
-            mock_job.get_output.return_value.read.return_value)
+            get_job_output.return_value.read.return_value)
+
+    def test_archive_retrieve_job_index(self):
+        names = ['archive_name_%d' % i for i in range(3)]
+        self.init_app(['archive', 'retrieve', '--job-cache-ttl', '60',
+                       'vault_name'] + names, memory_cache=True)
+        for i, name in enumerate(names):
+            self.cache.add_archive('vault_name', name, 'id_%d' % i)
+        mock_vault = self.connection.get_vault.return_value
+        mock_vault.name = 'vault_name'
+
+        def job(archive_id):
+            return job_data(
+                Action='ArchiveRetrieval', ArchiveId=archive_id,
+                ArchiveSizeInBytes=1, JobId='job_' + archive_id,
+                StatusCode='InProgress')
+
+        # The pending job for id_0 is on the second page of the listing
+        self.mock_jobs(mock_vault, [
+            job('other_%d' % i) for i in range(glacier_fake.JOB_LIST_LIMIT)
+        ] + [job('id_0')])
+        mock_vault.retrieve_archive.side_effect = (
+            lambda archive_id: boto.glacier.job.Job(mock_vault,
+                                                    job(archive_id)))
+        with patch('sys.exit'), patch_builtin('print'):
+            self.app.main()
+        self.connection.get_vault.assert_called_once_with('vault_name')
+        self.assertEqual(mock_vault.layer1.list_jobs.call_count, 2)
+        self.assertEqual(mock_vault.retrieve_archive.call_args_list,
+                         [mock.call('id_1'), mock.call('id_2')])
+
+        # Another invocation within the TTL finds the same jobs pending
+        # without listing them again or queueing any more.
+        self.app = glacier.App(
+            args=['archive', 'retrieve', '--job-cache-ttl', '60',
+                  'vault_name'] + names,
+            connection=self.connection, cache=self.cache)
+        mock_print = Mock()
+        with patch('sys.exit'), patch_builtin('print', mock_print):
+            self.app.main()
+        self.assertEqual(mock_vault.layer1.list_jobs.call_count, 2)
+        self.assertEqual(mock_vault.retrieve_archive.call_count, 2)
+        mock_print.assert_called_once_with(
+            "glacier: job still pending for archive 'archive_name_0'\n"
+            "glacier: job still pending for archive 'archive_name_1'\n"
+            "glacier: job still pending for archive 'archive_name_2'",
+            file=sys.stderr)
+
+    def test_archive_upload_resume(self):
+        part_size = glacier.MEGABYTE
+        data = b'a' * part_size + b'b' * part_size + b'c' * 10
+        tmpdir = self.make_tmpdir()
+        filename = os.path.join(tmpdir, 'filename')
+        with open(filename, 'wb') as f:
+            f.write(data)
+        args = ['archive', 'upload', '--part-size', str(part_size), '-j', '1',
+                'vault_name', filename]
+        self.init_app(args, memory_cache=True)
+        layer1 = self.init_upload_mocks()
+        layer1.initiate_multipart_upload.return_value = {
+            'UploadId': 'upload_id'}
+        layer1.complete_multipart_upload.return_value = {
+            'ArchiveId': 'archive_id'}
+
+        def upload_part(vault_name, upload_id, linear_hash, tree_hash,
+                        byte_range, part_data):
+            if byte_range[0] >= 2 * part_size:
+                raise IOError('connection reset')
+
+        layer1.upload_part.side_effect = upload_part
+        with patch('glacier.time.sleep'), patch('glacier.warn'):
+            self.assertRaises(IOError, self.app.main)
+        self.assertFalse(layer1.abort_multipart_upload.called)
+        self.assertEqual(
+            self.cache.get_upload('vault_name', 'filename', filename,
+                                  len(data)),
+            ('upload_id', part_size))
+
+        layer1.reset_mock()
+        layer1.upload_part.side_effect = None
+        layer1.list_parts.return_value = {
+            'Parts': [
+                {'RangeInBytes': '0-1048575',
+                 'SHA256TreeHash': glacier.tree_hash_hex(data[:part_size])},
+                {'RangeInBytes': '1048576-2097151',
+                 'SHA256TreeHash': glacier.tree_hash_hex(
+                     data[part_size:2 * part_size])},
+            ],
+            'Marker': None,
+        }
+        with patch_builtin('print'):
+            self.assertEqual(self.run_app(args, connection=self.connection,
+                                          cache=self.cache), 0)
+        self.assertFalse(layer1.initiate_multipart_upload.called)
+        layer1.list_parts.assert_called_once_with(
+            'vault_name', 'upload_id', marker=None)
+        self.assertEqual(layer1.upload_part.call_count, 1)
+        self.assertEqual(layer1.upload_part.call_args[0][4],
+                         (2 * part_size, 2 * part_size + 9))
+        self.assertEqual(self.cache.get_upload_list('vault_name'), [])
+        self.assertEqual(
+            self.cache.get_archive_id('vault_name', 'filename'),
+            'archive_id')
+
+    def test_archive_upload_empty(self):
+        tmpdir = self.make_tmpdir()
+        filename = os.path.join(tmpdir, 'filename')
+        open(filename, 'wb').close()
+        args = ['archive', 'upload', 'vault_name', filename]
+        self.init_app(args, memory_cache=True)
+        layer1 = self.init_upload_mocks()
+        layer1.initiate_multipart_upload.return_value = {
+            'UploadId': 'upload_id'}
+        stderr = io.StringIO()
+        with patch('sys.stderr', stderr):
+            self.assertRaises(SystemExit, self.app.main)
+        self.assertEqual(stderr.getvalue(),
+                         'glacier: cannot upload an empty archive\n')
+        self.assertFalse(layer1.initiate_multipart_upload.called)
+
+        # A file that is only found to be empty once the upload has started
+        # leaves no upload behind to resume either.
+        with patch('glacier.get_file_size', return_value=1):
+            self.assertEqual(self.run_app(args, connection=self.connection,
+                                          cache=self.cache), 1)
+        layer1.abort_multipart_upload.assert_called_once_with(
+            'vault_name', 'upload_id')
+        self.assertEqual(self.cache.get_upload_list('vault_name'), [])
+
+    def test_upload_abort_older_than(self):
+        self.init_app(['upload', 'abort', '--older-than', '24', 'vault_name'])
+        self.connection.layer1.list_multipart_uploads.return_value = {
+            'UploadsList': [
+                {'MultipartUploadId': 'old',
+                 'CreationDate': '1970-01-01T00:00:00Z'},
+                {'MultipartUploadId': 'new',
+                 'CreationDate': glacier.time.strftime(
+                     '%Y-%m-%dT%H:%M:%SZ', glacier.time.gmtime())},
+            ],
+            'Marker': None,
+        }
+        self.app.main()
+        self.connection.layer1.abort_multipart_upload.assert_called_once_with(
+            'vault_name', 'old')
+        self.cache.delete_upload.assert_called_once_with('vault_name', 'old')
+
+    def mock_ranged_job(self, vault, data, archive_id=sentinel.archive_id):
+        """Make vault list one completed job that outputs data"""
+        vault.name = 'vault_name'
+        self.mock_jobs(vault, [job_data(
+            JobId='job_id', Action='ArchiveRetrieval', ArchiveId=archive_id,
+            ArchiveSizeInBytes=len(data), Completed=True,
+            CompletionDate='1970-01-01T00:00:00Z', StatusCode='Succeeded')])
+        self.mock_job_output(vault, {'job_id': data})
+
+    def test_archive_retrieve_parallel_ranges(self):
+        data = b''.join(bytes(bytearray([i])) * 5 for i in range(10))
+        tmpdir = self.make_tmpdir()
+        output_filename = os.path.join(tmpdir, 'output')
+        with open(output_filename, 'wb') as f:
+            f.write(b'z' * 100)
+        self.init_app(['archive', 'retrieve', '--multipart-size', '4',
+                       '-j', '4', '-o', output_filename,
+                       'vault_name', 'archive_name'])
+        mock_vault = self.connection.get_vault.return_value
+        self.mock_ranged_job(mock_vault, data)
+        self.cache.get_archive_id.return_value = sentinel.archive_id
+        self.cache.get_retrieved_ranges.return_value = {}
+        self.app.main()
+        with open(output_filename, 'rb') as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(mock_vault.layer1.get_job_output.call_count, 13)
+
+    def test_archive_retrieve_parallel_ranges_stdout(self):
+        data = b''.join(bytes(bytearray([i])) * 5 for i in range(10))
+        self.init_app(['archive', 'retrieve', '--multipart-size', '4',
+                       '-j', '4', '-o-', 'vault_name', 'archive_name'])
+        self.mock_ranged_job(self.connection.get_vault.return_value, data)
+        self.cache.get_archive_id.return_value = sentinel.archive_id
+        stdout = Mock(buffer=io.BytesIO())
+        with patch('sys.stdout', stdout):
+            self.app.main()
+        self.assertEqual(stdout.buffer.getvalue(), data)
+
+    def test_archive_retrieve_pipeline(self):
+        tmpdir = self.make_tmpdir()
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(tmpdir)
+        names = ['ready', 'pending', 'new']
+        self.init_app(['archive', 'retrieve', '--wait', '--multipart-size',
+                       '1000', 'vault_name'] + names, memory_cache=True)
+        data = dict((name, name.encode('ascii') * 1000) for name in names)
+        for name in names:
+            self.cache.add_archive('vault_name', name, 'id_' + name)
+        mock_vault = self.connection.get_vault.return_value
+        mock_vault.name = 'vault_name'
+
+        def job(name, completed):
+            return job_data(
+                JobId='job_' + name, Action='ArchiveRetrieval',
+                ArchiveId='id_' + name, ArchiveSizeInBytes=len(data[name]),
+                Completed=completed, CreationDate='1970-01-01T00:00:00Z',
+                CompletionDate='1970-01-01T01:00:00Z' if completed else None,
+                StatusCode='Succeeded' if completed else 'InProgress')
+
+        def list_jobs(vault_name, completed=None, marker=None):
+            if completed:
+                jobs = [job(name, True) for name in names]
+            else:
+                jobs = [job('ready', True), job('pending', False)]
+            return {'JobList': jobs, 'Marker': None}
+
+        mock_vault.layer1.list_jobs.side_effect = list_jobs
+        self.mock_job_output(mock_vault, dict(
+            ('job_' + name, data[name]) for name in names))
+        mock_vault.retrieve_archive.return_value = boto.glacier.job.Job(
+            mock_vault, job('new', False))
+        with patch('glacier.JOB_POLL_MIN_INTERVAL', 0):
+            self.app.main()
+        mock_vault.retrieve_archive.assert_called_once_with('id_new')
+        # Both pending jobs are found complete by one listing
+        self.assertEqual(mock_vault.layer1.list_jobs.call_args_list, [
+            mock.call('vault_name', completed=None, marker=None),
+            mock.call('vault_name', completed=True, marker=None)])
+        mock_vault.get_job.assert_not_called()
+        for name in names:
+            with open(os.path.join(tmpdir, name), 'rb') as f:
+                self.assertEqual(f.read(), data[name])
+
+    def test_job_poller(self):
+        now = [glacier.iso8601_to_unix_timestamp('2020-01-01T00:00:00Z')]
+        mock_vault = Mock()
+        mock_vault.name = 'vault_name'
+        self.mock_jobs(mock_vault, [])
+
+        def job(id):
+            return Mock(id=id, completed=False, vault=mock_vault,
+                        creation_date='2020-01-01T00:00:00Z')
+
+        class FakeNotifications(object):
+            def __init__(self):
+                self.completed = set()
+
+            def receive(self, job_ids):
+                return self.completed & job_ids
+
+        notifications = FakeNotifications()
+        poller = glacier.JobPoller(notifications, clock=lambda: now[0],
+                                   tiers={'job_expedited': 'Expedited'})
+        poller.add('standard', [job('job_standard')])
+        poller.add('expedited', [job('job_expedited')])
+        # Checks start early for the job expected soon, and are spaced out
+        # for the job expected in hours.
+        self.assertEqual(poller.next_check_time() - now[0],
+                         glacier.JOB_NOTIFICATION_INTERVAL)
+        self.assertEqual(poller.groups['expedited']['next_check'] - now[0],
+                         glacier.JOB_TIER_DURATIONS['Expedited'] / 2)
+        self.assertEqual(poller.groups['standard']['next_check'] - now[0],
+                         glacier.JOB_POLL_MAX_INTERVAL)
+
+        now[0] += glacier.JOB_TIER_DURATIONS['Expedited'] / 2
+        self.assertEqual(poller.check(), [])
+        mock_vault.layer1.list_jobs.assert_called_once_with(
+            'vault_name', completed=True, marker=None)
+
+        notifications.completed.add('job_standard')
+        now[0] += glacier.JOB_NOTIFICATION_INTERVAL
+        self.assertEqual(poller.check(),
+                         [('standard', mock_vault.get_job.return_value)])
+        mock_vault.get_job.assert_called_once_with('job_standard')
+        self.assertEqual(list(poller.groups), ['expedited'])
+
+    def test_job_poller_pages(self):
+        mock_vault = Mock()
+        mock_vault.name = 'vault_name'
+        jobs = [job_data(JobId='job_%d' % i, Action='ArchiveRetrieval',
+                         Completed=True, StatusCode='Succeeded',
+                         CompletionDate='2020-01-01T00:00:00Z')
+                for i in range(glacier_fake.JOB_LIST_LIMIT + 1)]
+        self.mock_jobs(mock_vault, jobs)
+        now = [0]
+        poller = glacier.JobPoller(clock=lambda: now[0])
+        poller.add('last', [Mock(id=jobs[-1]['JobId'], completed=False,
+                                 vault=mock_vault,
+                                 creation_date='1970-01-01T00:00:00Z')])
+        now[0] += glacier.JOB_TIER_DURATIONS['Standard']
+        # The completed job is on the second page of completed jobs
+        [(key, complete_job)] = poller.check()
+        self.assertEqual((key, complete_job.id), ('last', jobs[-1]['JobId']))
+        self.assertEqual(mock_vault.layer1.list_jobs.call_count, 2)
+
+    def test_archive_retrieve_resume(self):
+        data = b''.join(bytes(bytearray([i])) * 5 for i in range(10))
+        tmpdir = self.make_tmpdir()
+        output_filename = os.path.join(tmpdir, 'output')
+        args = ['archive', 'retrieve', '--multipart-size', '4', '-j', '2',
+                '-o', output_filename, 'vault_name', 'archive_name']
+        self.init_app(args, memory_cache=True)
+        self.cache.add_archive('vault_name', 'archive_name', 'archive_id')
+        mock_vault = self.connection.get_vault.return_value
+        self.mock_ranged_job(mock_vault, data, archive_id='archive_id')
+        get_job_output = mock_vault.layer1.get_job_output
+        get_output = get_job_output.side_effect
+
+        def failing_get_output(vault_name, job_id, byte_range=None):
+            if byte_range[0] >= 24:
+                raise IOError('connection reset')
+            return get_output(vault_name, job_id, byte_range)
+
+        get_job_output.side_effect = failing_get_output
+        with patch('glacier.time.sleep'), patch('glacier.warn'):
+            self.assertRaises(IOError, self.app.main)
+        self.assertEqual(
+            sorted(self.cache.get_retrieved_ranges(
+                'vault_name', 'job_id', output_filename)),
+            [0, 4, 8, 12, 16, 20])
+
+        # Corrupt one range that was already written; it must be fetched
+        # again along with the ranges that were never written.
+        with open(output_filename, 'r+b') as f:
+            f.seek(4)
+            f.write(b'XXXX')
+        get_job_output.reset_mock()
+        get_job_output.side_effect = get_output
+        self.app = glacier.App(
+            args=args, connection=self.connection, cache=self.cache)
+        self.app.main()
+        with open(output_filename, 'rb') as f:
+            self.assertEqual(f.read(), data)
+        fetched = sorted(call[0][2][0]
+                         for call in get_job_output.call_args_list)
+        self.assertEqual(fetched, [4, 24, 28, 32, 36, 40, 44, 48])
+        self.assertEqual(self.cache.get_retrieved_ranges(
+            'vault_name', 'job_id', output_filename), {})
+
+    def mock_inventory_job(self, archive_list,
+                           inventory_date='1970-01-10T00:00:00Z',
+                           job_id='inventory_job_id'):
+        """Return a completed inventory job for mock_jobs.
+
+        Its output is given by self.open_job_output.
+        """
+        self.job_outputs[job_id] = json.dumps({
+            'VaultARN': 'arn',
+            'InventoryDate': inventory_date,
+            'ArchiveList': archive_list,
+        }).encode('utf-8')
+        return job_data(
+            JobId=job_id, Action='InventoryRetrieval', Completed=True,
+            CompletionDate=glacier.time.strftime(
+                '%Y-%m-%dT%H:%M:%SZ', glacier.time.gmtime()),
+            CreationDate='1970-01-10T00:00:00Z', StatusCode='Succeeded')
+
+    def open_job_output(self, job):
+        """Stand-in for glacier.open_job_output"""
+        return io.BytesIO(self.job_outputs[job.id])
+
+    def test_vault_sync_reconcile(self):
+        self.init_app(['vault', 'sync', 'vault_name'],
+                      memory_cache=True)
+        self.cache.add_archive('vault_name', 'same', 'id_same')
+        self.cache.add_archive('vault_name', 'old_name', 'id_renamed')
+        self.cache.add_archive('vault_name', 'deleted', 'id_deleted')
+        self.cache.delete_archive('vault_name', 'deleted')
+        self.cache.add_archive('vault_name', 'gone', 'id_gone')
+        self.cache.add_archive('vault_name', 'recent', 'id_recent')
+        self.cache.session.query(self.cache.Archive).filter_by(
+            id='id_gone').one().last_seen_upstream = 1
+        self.cache.session.commit()
+        inventory = [
+            {'ArchiveId': 'id_new', 'ArchiveDescription': 'new',
+             'CreationDate': '1970-01-01T00:00:00Z',
+             'SHA256TreeHash': 'hash_new', 'Size': 3},
+            {'ArchiveId': 'id_same', 'ArchiveDescription': 'same',
+             'CreationDate': '1970-01-01T00:00:00Z',
+             'SHA256TreeHash': 'hash_same', 'Size': 4},
+            {'ArchiveId': 'id_renamed', 'ArchiveDescription': 'new_name',
+             'CreationDate': '1970-01-01T00:00:00Z'},
+            {'ArchiveId': 'id_deleted', 'ArchiveDescription': 'deleted',
+             'CreationDate': '1970-01-01T00:00:00Z'},
+        ]
+        mock_vault = self.connection.get_vault.return_value
+        mock_vault.name = 'vault_name'
+        self.mock_jobs(mock_vault, [self.mock_inventory_job(inventory)])
+        with patch('glacier.warn') as mock_warn, patch('glacier.info'), \
+                patch('glacier.open_job_output', self.open_job_output):
+            self.app.main()
+        # The names come from the cache as unicode, whose %r on Python 2
+        # has a u prefix
+        self.assertEqual(mock_warn.call_args_list, [
+            mock.call('archive %r appears to have changed name from %r to %r'
+                      % (u'id_renamed', u'old_name', u'new_name')),
+            mock.call('archive %r deletion not yet in inventory' %
+                      u'deleted'),
+            mock.call('archive disappeared: %r' % u'gone'),
+            mock.call('new archive not yet in inventory: %r' % u'recent'),
+        ])
+        self.assertEqual(self.cache.get_archive_id('vault_name', 'new'),
+                         'id_new')
+        self.assertEqual(
+            self.cache.get_archive_name('vault_name', 'id:id_renamed'),
+            'old_name')
+        self.assertEqual(
+            self.cache.get_archive_last_seen('vault_name', 'same'),
+            9 * 24 * 60 * 60)
+        self.assertEqual(
+            self.cache.get_archives_by_content('vault_name', 'hash_new', 3),
+            [('id_new', 'new')])
+        self.assertEqual(
+            self.cache.get_archives_by_content('vault_name', 'hash_same', 4),
+            [('id_same', 'same')])
+
+    def test_archive_checkpresent_batch(self):
+        self.init_app(['archive', 'checkpresent', '--batch', 'vault_name'],
+                      memory_cache=True)
+        self.cache.add_archive('vault_name', 'recent', 'id_recent')
+        self.cache.add_archive('vault_name', 'old', 'id_old')
+        self.cache.session.query(self.cache.Archive).filter_by(
+            id='id_old').one().last_seen_upstream = 1
+        self.cache.session.commit()
+        stdin = io.StringIO(u'recent\nold\nmissing\nid:id_recent\n')
+        stdout = io.StringIO()
+        with patch('sys.stdin', stdin), patch('sys.stdout', stdout), \
+                patch('sys.stderr'), \
+                patch('glacier.CHECKPRESENT_BATCH_SIZE', 2), \
+                patch.object(self.app, '_vault_sync',
+                             side_effect=glacier.RetryConsoleError('x')) \
+                as mock_sync:
+            self.app.main()
+        self.assertEqual(mock_sync.call_count, 1)
+        self.assertEqual(stdout.getvalue(),
+                         'present\trecent\nabsent\told\n'
+                         'absent\tmissing\npresent\tid:id_recent\n')
+
+    def daemon_request(self, daemon, argv, aws_access_key_id=None):
+        rfile = io.BytesIO((json.dumps({
+            'argv': argv,
+            'aws_access_key_id': aws_access_key_id,
+        }) + '\n').encode('utf-8'))
+        wfile = io.BytesIO()
+        daemon.handle(rfile, wfile)
+        messages = [json.loads(line.decode('utf-8'))
+                    for line in wfile.getvalue().splitlines()]
+        output = {'stdout': '', 'stderr': ''}
+        for message in messages[:-1]:
+            for name, data in message.items():
+                output[name] += data
+        return output['stdout'], output['stderr'], messages[-1]
+
+    def test_daemon(self):
+        self.init_app(['daemon'], memory_cache=True)
+        self.cache.add_archive('vault_name', 'archive_name_1', 'id_1')
+        self.cache.add_archive('vault_name', 'archive_name_2', 'id_2')
+        # Collect files leaked by earlier tests now, so their
+        # ResourceWarnings do not land in the captured stderr.
+        gc.collect()
+        with patch.dict(os.environ):
+            os.environ.pop('AWS_ACCESS_KEY_ID', None)
+            daemon = glacier.Daemon(self.app, '/nonexistent')
+            self.assertEqual(
+                self.daemon_request(daemon, ['archive', 'list', 'vault_name']),
+                ('archive_name_1\narchive_name_2\n', '', {'exit': 0}))
+            stdout, stderr, result = self.daemon_request(
+                daemon, ['archive', 'list'])
+            self.assertIn('usage:', stderr)
+            self.assertEqual(result, {'exit': 2})
+            self.assertEqual(
+                self.daemon_request(daemon, ['daemon']),
+                ('', '', {'refused': 'command cannot be run in the daemon'}))
+            self.assertEqual(
+                self.daemon_request(daemon, ['vault', 'list'],
+                                    aws_access_key_id='other'),
+                ('', '', {'refused':
+                          'daemon is running with different credentials'}))
+        self.assertIsNone(glacier.run_via_daemon(['vault', 'list'],
+                                                 socket_path='/nonexistent'))
+
+    def test_vault_sync_incremental(self):
+        self.init_app(['vault', 'sync', 'vault_name'], memory_cache=True)
+        mock_vault = self.connection.get_vault.return_value
+        mock_vault.name = 'vault_name'
+        inventory = [{'ArchiveId': 'id_1', 'ArchiveDescription': 'name_1',
+                      'CreationDate': '1970-01-01T00:00:00Z'}]
+
+        def sync(job):
+            self.mock_jobs(mock_vault, [job])
+            self.app = glacier.App(args=['vault', 'sync', 'vault_name'],
+                                   connection=self.connection,
+                                   cache=self.cache)
+            open_job_output = Mock(side_effect=self.open_job_output)
+            with patch('glacier.open_job_output', open_job_output), \
+                    patch.object(self.cache, 'load_inventory',
+                                 wraps=self.cache.load_inventory) as load:
+                self.app.main()
+            return open_job_output.call_count, load.call_count
+
+        def last_seen():
+            return self.cache.get_archive_last_seen('vault_name', 'name_1')
+
+        self.assertEqual(sync(self.mock_inventory_job(inventory)), (1, 1))
+        self.assertEqual(last_seen(), 9 * 24 * 60 * 60)
+        # The same job again is not downloaded
+        self.assertEqual(sync(self.mock_inventory_job(inventory)), (0, 0))
+        # A newer job for the same inventory only updates last seen times
+        newer_job = self.mock_inventory_job(inventory, job_id='newer_job_id')
+        newer_job['CreationDate'] = '1970-01-20T00:00:00Z'
+        self.assertEqual(sync(newer_job), (1, 0))
+        self.assertEqual(last_seen(), (19 - 3) * 24 * 60 * 60)
+        # An older inventory is ignored
+        older_job = self.mock_inventory_job(
+            [], inventory_date='1970-01-09T00:00:00Z', job_id='older_job_id')
+        self.assertEqual(sync(older_job), (1, 0))
+        self.assertEqual(last_seen(), (19 - 3) * 24 * 60 * 60)
+        # and not downloaded again
+        self.assertEqual(sync(older_job), (0, 0))
+        self.assertEqual(last_seen(), (19 - 3) * 24 * 60 * 60)
+
+    def test_vault_sync_all(self):
+        self.init_app(['vault', 'sync', '--all'], memory_cache=True)
+        vaults = []
+        for i in range(3):
+            vault = Mock()
+            vault.name = 'vault_%d' % i
+            self.mock_jobs(vault, [self.mock_inventory_job(
+                [{'ArchiveId': 'id_%d' % i, 'ArchiveDescription': 'name',
+                  'CreationDate': '1970-01-01T00:00:00Z'}],
+                job_id='inventory_job_%d' % i)])
+            vaults.append(vault)
+        self.mock_jobs(vaults[2], [job_data(
+            Action='InventoryRetrieval', Completed=False,
+            StatusCode='InProgress')])
+        self.connection.list_vaults.return_value = vaults
+        with patch('glacier.open_job_output', self.open_job_output), \
+                patch('sys.stderr'):
+            with self.assertRaises(SystemExit) as cm:
+                self.app.main()
+        self.assertEqual(cm.exception.code, EX_TEMPFAIL)
+        for i in range(2):
+            self.assertEqual(
+                self.cache.get_archive_id('vault_%d' % i, 'name'),
+                'id_%d' % i)
+        self.assertRaises(KeyError, self.cache.get_archive_id,
+                          'vault_2', 'name')
+
+    def test_inventory_reader(self):
+        inventory = {
+            'VaultARN': 'arn:aws:glacier:vault',
+            'ArchiveList': [
+                {'ArchiveId': 'id_%d' % i,
+                 'ArchiveDescription': u'caf\xe9 %d' % i,
+                 'Size': 1000 + i}
+                for i in range(20)
+            ],
+            'InventoryDate': '2020-01-01T00:00:00Z',
+        }
+        data = json.dumps(inventory, indent=1, ensure_ascii=False)
+        for read_size in [1, 7, 4096]:
+            reader = glacier.InventoryReader(
+                io.BytesIO(data.encode('utf-8')), read_size=read_size)
+            self.assertEqual(list(reader.archives()),
+                             inventory['ArchiveList'])
+            self.assertEqual(reader.header, {
+                'VaultARN': 'arn:aws:glacier:vault',
+                'InventoryDate': '2020-01-01T00:00:00Z',
+            })
+
+    def test_inventory_reader_truncated(self):
+        reader = glacier.InventoryReader(
+            io.BytesIO(b'{"ArchiveList": [{"ArchiveId": "a"}, {"Arch'))
+        archives = reader.archives()
+        self.assertEqual(next(archives), {'ArchiveId': 'a'})
+        self.assertRaises(ValueError, next, archives)
+
+    def test_cache_schema_upgrade(self):
+        tmpdir = self.make_tmpdir()
+        db_path = os.path.join(tmpdir, 'db')
+        # An unversioned database as created by earlier releases
+        connection = sqlite3.connect(db_path)
+        connection.execute(
+            'CREATE TABLE archive (id VARCHAR NOT NULL, name VARCHAR, '
+            'vault VARCHAR NOT NULL, key VARCHAR NOT NULL, '
+            'last_seen_upstream INTEGER, created_here INTEGER, '
+            'deleted_here INTEGER, PRIMARY KEY (id))')
+        connection.execute(
+            "INSERT INTO archive (id, name, vault, key) "
+            "VALUES ('id_1', 'name_1', 'vault_name', 'key')")
+        connection.commit()
+        connection.close()
+
+        cache = glacier.Cache('key', db_path=db_path)
+        self.assertEqual(cache.get_archive_id('vault_name', 'name_1'), 'id_1')
+        cache.session.close()
+
+        connection = sqlite3.connect(db_path)
+        self.addCleanup(connection.close)
+        self.assertEqual(
+            connection.execute('PRAGMA user_version').fetchone()[0],
+            glacier.Cache.SCHEMA_VERSION)
+        self.assertEqual(
+            connection.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        plan = connection.execute(
+            "EXPLAIN QUERY PLAN SELECT id FROM archive WHERE key = 'key' AND "
+            "vault = 'vault_name' AND name = 'name_1' "
+            "AND deleted_here IS NULL").fetchall()
+        self.assertIn('archive_key_vault_name', str(plan))
+
+    def test_cache_concurrent_writers(self):
+        # Each process adds archives and deletes every other one it added,
+        # reading the cache between writes, so that read and write
+        # transactions from different processes interleave.
+        script = (
+            'import sys, glacier\n'
+            'cache = glacier.Cache("key", db_path=sys.argv[1])\n'
+            'worker = sys.argv[2]\n'
+            'for i in range(20):\n'
+            '    name = "%s-%d" % (worker, i)\n'
+            '    cache.get_archive_list("vault_name")\n'
+            '    cache.add_archive("vault_name", name, name)\n'
+            '    if i % 2:\n'
+            '        cache.get_archive_id("vault_name", name)\n'
+            '        cache.delete_archive("vault_name", name)\n'
+            'with cache.group_commit():\n'
+            '    for i in range(20, 40):\n'
+            '        name = "%s-%d" % (worker, i)\n'
+            '        cache.add_archive("vault_name", name, name)\n')
+        tmpdir = self.make_tmpdir()
+        db_path = os.path.join(tmpdir, 'db')
+        workers = [str(i) for i in range(8)]
+        processes = [
+            subprocess.Popen([sys.executable, '-c', script, db_path, worker],
+                             cwd=os.path.dirname(os.path.abspath(__file__)),
+                             stderr=subprocess.PIPE)
+            for worker in workers]
+        for process in processes:
+            stderr = process.communicate()[1]
+            self.assertEqual(process.returncode, 0, stderr.decode())
+        cache = glacier.Cache('key', db_path=db_path)
+        self.assertEqual(
+            sorted(cache.get_archive_list('vault_name')),
+            sorted('%s-%d' % (worker, i) for worker in workers
+                   for i in range(40) if i >= 20 or not i % 2))
+
+    def test_cache_reader(self):
+        tmpdir = self.make_tmpdir()
+        db_path = os.path.join(tmpdir, 'db')
+        self.assertIsNone(glacier.CacheReader.open('key', db_path=db_path))
+        cache = glacier.Cache('key', db_path=db_path)
+        cache.add_archive('vault_name', 'archive_name_1', 'id_1')
+        cache.add_archive('vault_name', 'archive_name_1', 'id_2')
+        cache.add_archive('vault_name', 'id:archive_name_3', 'id_3')
+        cache.add_archive('vault_name', 'archive_name_4', 'id_4')
+        cache.delete_archive('vault_name', 'archive_name_4')
+        reader = glacier.CacheReader.open('key', db_path=db_path)
+        self.addCleanup(reader.connection.close)
+        self.assertEqual(list(reader.get_archive_list('vault_name')),
+                         list(cache.get_archive_list('vault_name')))
+        self.assertEqual(
+            list(reader.get_archive_list_with_ids('vault_name')),
+            list(cache.get_archive_list_with_ids('vault_name')))
+        self.assertEqual(
+            reader.get_archive_id('vault_name', 'name:id:archive_name_3'),
+            'id_3')
+        self.assertEqual(
+            reader.get_archive_last_seen('vault_name', 'id:id_3'),
+            cache.get_archive_last_seen('vault_name', 'id:id_3'))
+        self.assertRaises(KeyError, reader.get_archive_id,
+                          'vault_name', 'archive_name_4')
+        self.assertRaises(glacier.ConsoleError, reader.get_archive_id,
+                          'vault_name', 'archive_name_1')
+
+    def test_fake_glacier_round_trip(self):
+        tmpdir = self.make_tmpdir()
+        filename = os.path.join(tmpdir, 'data')
+        data = os.urandom(2 * glacier.MEGABYTE + 1)
+        with open(filename, 'wb') as f:
+            f.write(data)
+        cache = glacier.Cache(0, db_path=':memory:')
+        with glacier_fake.FakeGlacier() as fake:
+            connection = fake.connect()
+            fake.add_archives('vault_name', 3)
+            self.assertEqual(
+                self.run_app(['archive', 'upload', '--part-size',
+                              str(glacier.MEGABYTE), '--name', 'data',
+                              'vault_name', filename],
+                             connection=connection, cache=cache), 0)
+            self.assertEqual(fake.requests['upload_part'], 3)
+            argv = ['vault', 'sync', 'vault_name']
+            self.assertEqual(
+                self.run_app(argv, connection=connection, cache=cache),
+                EX_TEMPFAIL)
+            self.assertEqual(
+                self.run_app(argv, connection=connection, cache=cache), 0)
+            self.assertEqual(
+                sorted(cache.get_archive_list('vault_name')),
+                ['archive-0', 'archive-1', 'archive-2', 'data'])
+            os.unlink(filename)
+            argv = ['archive', 'retrieve', '--multipart-size',
+                    str(glacier.MEGABYTE), '-o', filename, 'vault_name',
+                    'data']
+            self.assertEqual(
+                self.run_app(argv, connection=connection, cache=cache),
+                EX_TEMPFAIL)
+            self.assertEqual(
+                self.run_app(argv, connection=connection, cache=cache), 0)
+        with open(filename, 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    def test_stats_trace(self):
+        tmpdir = self.make_tmpdir()
+        trace_filename = os.path.join(tmpdir, 'trace')
+        cache = glacier.Cache(0, db_path=':memory:')
+        with glacier_fake.FakeGlacier() as fake:
+            connection = fake.connect()
+            fake.add_archives('vault_name', 3)
+            app = glacier.App(args=['vault', 'sync', 'vault_name'],
+                              connection=connection, cache=cache)
+            self.assertIs(app.stats, glacier.NULL_STATS)
+            with patch('sys.stderr'):
+                self.assertRaises(SystemExit, app.main)
+            app = glacier.App(
+                args=['--trace', trace_filename, 'vault', 'sync',
+                      'vault_name'],
+                connection=connection, cache=cache)
+            self.assertFalse(app.can_run_in_daemon())
+            app.main()
+        with open(trace_filename) as f:
+            records = [json.loads(line) for line in f]
+        summary = records.pop()
+        self.assertEqual(summary['event'], 'summary')
+        self.assertEqual(summary['counters']['api_calls'], 3)
+        self.assertEqual(
+            sorted(summary['phases']),
+            ['api.describe_vault', 'api.describe_vault.body',
+             'api.get_output', 'api.get_output.body', 'api.list_jobs',
+             'api.list_jobs.body', 'load_inventory', 'reconcile'])
+        self.assertEqual(summary['phases']['reconcile']['count'], 1)
+        self.assertEqual(
+            len(records),
+            sum(phase['count'] for phase in summary['phases'].values()))
+
+    def test_archive_upload_pack(self):
+        tmpdir = self.make_tmpdir()
+        directory = os.path.join(tmpdir, 'files')
+        os.makedirs(os.path.join(directory, 'sub'))
+        contents = {'a': b'a' * 3000, 'sub/b': b'', 'sub/c': os.urandom(5000),
+                    'z' * 120: b'long name'}
+        for path, data in contents.items():
+            with open(os.path.join(directory, path), 'wb') as f:
+                f.write(data)
+        output = os.path.join(tmpdir, 'output')
+        cache = glacier.Cache(0, db_path=':memory:')
+        with glacier_fake.FakeGlacier() as fake:
+            connection = fake.connect()
+            self.assertEqual(
+                self.run_app(['vault', 'create', 'vault_name'],
+                             connection=connection, cache=cache), 0)
+            self.assertEqual(
+                self.run_app(['archive', 'upload', '--pack', '--pack-size',
+                              '10240', 'vault_name', directory],
+                             connection=connection, cache=cache), 0)
+            archives = list(fake.vaults['vault_name'].archives.values())
+            self.assertEqual(len(archives), 2)
+            packed = {}
+            for archive in archives:
+                self.assertTrue(archive.description.startswith('files-'))
+                with tarfile.open(fileobj=io.BytesIO(archive.data)) as tar:
+                    for member in tar.getmembers():
+                        packed[member.name] = tar.extractfile(member).read()
+            self.assertEqual(packed, contents)
+            argv = ['archive', 'retrieve', '--member', '-o', output,
+                    'vault_name', 'sub/c']
+            self.assertEqual(
+                self.run_app(argv, connection=connection, cache=cache),
+                EX_TEMPFAIL)
+            fake.reset_counters()
+            self.assertEqual(
+                self.run_app(argv, connection=connection, cache=cache), 0)
+            # Only the member is downloaded, not the whole pack
+            self.assertEqual(fake.requests['get_job_output'], 1)
+            self.assertLess(fake.bytes_out, 5000 + 4096)
+            self.assertEqual(
+                self.run_app(['archive', 'retrieve', '--member',
+                              'vault_name', 'missing'],
+                             connection=connection, cache=cache), 1)
+        with open(output, 'rb') as f:
+            self.assertEqual(f.read(), contents['sub/c'])
+
+    def test_archive_retrieve_range(self):
+        tmpdir = self.make_tmpdir()
+        output = os.path.join(tmpdir, 'output')
+        data = os.urandom(3 * glacier.MEGABYTE + 100)
+        cache = glacier.Cache(0, db_path=':memory:')
+
+        def retrieve(*args):
+            return self.run_app(
+                ['archive', 'retrieve', '-o', output] + list(args) +
+                ['vault_name', 'data'],
+                connection=connection, cache=cache)
+
+        def output_data():
+            with open(output, 'rb') as f:
+                return f.read()
+
+        with glacier_fake.FakeGlacier() as fake:
+            connection = fake.connect()
+            archive_id = fake.add_archive('vault_name', 'data', data)
+            cache.add_archive('vault_name', 'data', archive_id,
+                              size=len(data))
+            first_mb = '%d-%d' % (glacier.MEGABYTE, 2 * glacier.MEGABYTE - 1)
+            self.assertEqual(retrieve('--range', first_mb), EX_TEMPFAIL)
+            self.assertEqual(retrieve('--range', first_mb), 0)
+            self.assertEqual(output_data(),
+                             data[glacier.MEGABYTE:2 * glacier.MEGABYTE])
+            # The ranged job does not do for the whole archive
+            self.assertEqual(retrieve(), EX_TEMPFAIL)
+            self.assertEqual(fake.requests['initiate_job'], 2)
+            self.assertEqual(retrieve(), 0)
+            self.assertEqual(output_data(), data)
+            # but the whole archive's job does for any range
+            self.assertEqual(retrieve('--range', '%d-%d' % (
+                2 * glacier.MEGABYTE, len(data) - 1)), 0)
+            self.assertEqual(fake.requests['initiate_job'], 2)
+            self.assertEqual(output_data(), data[2 * glacier.MEGABYTE:])
+            self.assertEqual(retrieve('--range', '0-1000'), 1)
+
+    def test_archive_retrieve_tier(self):
+        cache = glacier.Cache(0, db_path=':memory:')
+        argv = ['archive', 'retrieve', 'vault_name', 'data']
+        with glacier_fake.FakeGlacier(job_delay=60) as fake:
+            archive_id = fake.add_archive('vault_name', 'data', b'data')
+            cache.add_archive('vault_name', 'data', archive_id)
+            self.assertEqual(
+                self.run_app(argv[:2] + ['--tier', 'Expedited'] + argv[2:],
+                             connection=fake.connect(), cache=cache),
+                EX_TEMPFAIL)
+            [fake_job] = fake.vaults['vault_name'].jobs.values()
+            self.assertEqual(fake_job.tier, 'Expedited')
+            # Another invocation finds the tier in the job listing, and
+            # expects the job to complete as soon as an Expedited job does.
+            app = glacier.App(args=argv, connection=fake.connect(),
+                              cache=cache)
+            [job] = app.get_job_index(app.get_vault('vault_name')).jobs
+            self.assertEqual(app.job_tiers, {fake_job.id: 'Expedited'})
+            poller = app.make_job_poller()
+            poller.add('data', [job])
+            self.assertEqual(
+                poller.groups['data']['expected'],
+                glacier.iso8601_to_unix_timestamp(job.creation_date) +
+                glacier.JOB_TIER_DURATIONS['Expedited'])
+        self.assertEqual(len(fake.vaults['vault_name'].jobs), 1)
 
     def test_archive_delete(self):
-        self.run_app(['archive', 'delete', 'vault_name', 'archive_name'])
-        self.cache.get_archive_id.assert_called_once_with(
-            'vault_name', 'archive_name')
+        self.init_app(['archive', 'delete', 'vault_name', 'archive_name'])
+        self.cache.get_archive_ids_many.return_value = {
+            'archive_name': 'archive_id'}
+        self.app.main()
+        self.cache.get_archive_ids_many.assert_called_once_with(
+            'vault_name', ['archive_name'])
         self.connection.get_vault.assert_called_with('vault_name')
         mock_vault = self.connection.get_vault.return_value
-        mock_vault.delete_archive.assert_called_once_with(
-            self.cache.get_archive_id.return_value)
+        mock_vault.delete_archive.assert_called_once_with('archive_id')
+        self.cache.delete_archive_by_id.assert_called_once_with(
+            'vault_name', 'archive_id')
+
+    def test_archive_delete_many(self):
+        cache = glacier.Cache(0, db_path=':memory:')
+        with glacier_fake.FakeGlacier() as fake:
+            connection = fake.connect()
+            fake.add_archives('vault_name', 10)
+            for argv in [['vault', 'sync', 'vault_name']] * 2:
+                self.run_app(argv, connection=connection, cache=cache)
+            ids = [cache.get_archive_id('vault_name', 'archive-%d' % i)
+                   for i in range(10)]
+            fake.reset_counters()
+            app = glacier.App(
+                args=['archive', 'delete', '--ids', '--from-file', '-',
+                      '-j', '3', 'vault_name', 'id:' + ids[0], 'missing'],
+                connection=connection, cache=cache)
+            self.assertFalse(app.can_run_in_daemon())
+            stderr = io.StringIO()
+            with patch('sys.stdin', io.StringIO(
+                    ''.join(id + '\n' for id in ids[:6]) + '\n')), \
+                    patch('sys.stderr', stderr):
+                self.assertRaises(SystemExit, app.main)
+            self.assertEqual(fake.requests['delete_archive'], 6)
+            self.assertEqual(len(fake.vaults['vault_name'].archives), 4)
+        self.assertEqual(stderr.getvalue(),
+                         'glacier: archive %r not found\n' % u'id:missing')
+        self.assertEqual(sorted(cache.get_archive_list('vault_name')),
+                         ['archive-%d' % i for i in range(6, 10)])